@@ -7,7 +7,10 @@ setup(
     description='A vcenter driver based on pyvmomi, fabric and pywinrm',
     url='https://github.com/Osirium/vcdriver',
     license='MIT',
-    install_requires=['colorama', 'Fabric3', 'pyvmomi', 'pywinrm2', 'six'],
+    install_requires=[
+        'colorama', 'Fabric3', 'futures; python_version < "3"', 'pyvmomi',
+        'pywinrm2', 'requests', 'selectors34; python_version < "3"', 'six'
+    ],
     packages=find_packages(),
     classifiers=[
         'Development Status :: 5 - Production/Stable',
@@ -0,0 +1,125 @@
+import threading
+import time
+
+import pytest
+
+from vcdriver.admission import (
+    admit,
+    AdmissionController,
+    get_controller,
+    set_controller,
+)
+from vcdriver.exceptions import TimeoutError
+from vcdriver.helpers import deadline
+
+
+def hold(controller, *args, **kwargs):
+    admitted = threading.Event()
+    release = threading.Event()
+
+    def run():
+        with controller.admit(*args, **kwargs):
+            admitted.set()
+            release.wait()
+    thread = threading.Thread(target=run)
+    thread.start()
+    assert admitted.wait(1)
+    return release, thread
+
+
+def test_admit_without_controller():
+    assert get_controller() is None
+    with admit('clone'):
+        pass
+
+
+def test_set_controller():
+    controller = AdmissionController({'clone': 2}, 1, 3)
+    set_controller(controller)
+    try:
+        assert get_controller() is controller
+        with admit('clone', 'host', 'ds'):
+            assert controller.metrics()['in_flight'] == {
+                'operation-clone': 1, 'host-host': 1, 'datastore-ds': 1
+            }
+            with admit('clone'):
+                pass
+            assert controller.metrics()['in_flight']['operation-clone'] == 1
+    finally:
+        set_controller(None)
+    assert str(controller) == repr(controller) == (
+        "AdmissionController({'clone': 2}, host=1, datastore=3)"
+    )
+
+
+def test_admission_queue():
+    controller = AdmissionController({'clone': 1})
+    release, thread = hold(controller, 'clone')
+    admitted = []
+
+    def run():
+        with controller.admit('clone'):
+            admitted.append(True)
+    waiter = threading.Thread(target=run)
+    waiter.start()
+    time.sleep(0.1)
+    assert controller.metrics()['queue_depth'] == 1
+    assert not admitted
+    # Other operations are not limited
+    with controller.admit('power', 'host', 'ds'):
+        pass
+    release.set()
+    thread.join()
+    waiter.join()
+    assert admitted == [True]
+    metrics = controller.metrics()
+    assert metrics['queue_depth'] == 0
+    assert metrics['in_flight'] == {}
+    assert metrics['admitted'] == 3
+    assert metrics['max_wait_seconds'] >= 0.1
+    assert metrics['wait_seconds'] >= metrics['max_wait_seconds']
+
+
+def test_admission_fairness():
+    controller = AdmissionController({'clone': 2}, host_limit=1)
+    release, thread = hold(controller, 'clone', 'host-1')
+
+    def run():
+        with controller.admit('clone', 'host-1'):
+            pass
+    blocked = threading.Thread(target=run)
+    blocked.start()
+    time.sleep(0.1)
+    # The queued clone holds the second clone slot, but not other hosts
+    with deadline(0.1):
+        with pytest.raises(TimeoutError):
+            with controller.admit('clone', 'host-2'):
+                pass
+        with controller.admit('power', 'host-2'):
+            pass
+    release.set()
+    thread.join()
+    blocked.join()
+    assert controller.metrics()['admitted'] == 3
+
+
+def test_admission_lock_dir(tmpdir):
+    first = AdmissionController({'clone': 1}, lock_dir=str(tmpdir))
+    second = AdmissionController(
+        {'clone': 1}, host_limit=1, lock_dir=str(tmpdir), _poll_interval=0.01
+    )
+    release, thread = hold(first, 'clone')
+    with deadline(0.1):
+        with pytest.raises(TimeoutError):
+            with second.admit('clone', 'host-1'):
+                pass
+    # The host slot taken before the timeout was released
+    with deadline(0.1):
+        with second.admit('power', 'host-1'):
+            pass
+    timer = threading.Timer(0.05, release.set)
+    timer.start()
+    with second.admit('clone'):
+        pass
+    thread.join()
+    timer.join()
@@ -114,7 +114,9 @@ def test_read(config_files):
             'vcdriver_vm_ssh_username': '',
             'vcdriver_vm_ssh_password': '',
             'vcdriver_vm_winrm_username': '',
-            'vcdriver_vm_winrm_password': ''
+            'vcdriver_vm_winrm_password': '',
+            'vcdriver_vm_guest_username': '',
+            'vcdriver_vm_guest_password': ''
         }
     }
     load('config_file_3.cfg')
@@ -135,7 +137,9 @@ def test_read(config_files):
             'vcdriver_vm_ssh_username': '',
             'vcdriver_vm_ssh_password': '',
             'vcdriver_vm_winrm_username': '',
-            'vcdriver_vm_winrm_password': ''
+            'vcdriver_vm_winrm_password': '',
+            'vcdriver_vm_guest_username': '',
+            'vcdriver_vm_guest_password': ''
         }
     }
 
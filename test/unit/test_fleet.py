@@ -0,0 +1,584 @@
+import datetime
+import os
+import threading
+
+import mock
+import pytest
+from pyVmomi import vim
+
+from vcdriver.config import load
+from vcdriver.exceptions import (
+    FleetError,
+    NoObjectFound,
+    SshError,
+    TooManyObjectsFound,
+    WinRmError,
+)
+from vcdriver.fleet import (
+    FleetResult,
+    fan_out,
+    fleet_create_snapshot,
+    fleet_power_off,
+    fleet_power_on,
+    fleet_remove_snapshot,
+    fleet_reset,
+    fleet_set_autostart,
+    fleet_revert_snapshot,
+    fleet_snapshot,
+    fleet_ssh,
+    fleet_wait_for_ips,
+    fleet_wait_for_port,
+    fleet_winrm,
+)
+from vcdriver.vm import VirtualMachine
+
+
+def test_fleet_result():
+    result = FleetResult(VirtualMachine(name='vm'))
+    assert result.status == FleetResult.CANCELLED
+    assert result.return_code is None
+    assert str(result) == repr(result) == 'vm: cancelled (0:00:00)'
+    result.value = (0, 'out', 'err')
+    assert (result.return_code, result.stdout, result.stderr) == (
+        0, 'out', 'err'
+    )
+    result.error = SshError('command', 1, 'out', 'err')
+    assert (result.return_code, result.stdout, result.stderr) == (
+        1, 'out', 'err'
+    )
+
+
+def test_fan_out_collect_all():
+    vms = [VirtualMachine(name=str(i)) for i in range(5)]
+
+    def function(vm):
+        if vm.name == '2':
+            raise Exception('boom')
+        return vm.name
+
+    results = fan_out(vms, function, max_workers=2)
+    assert [result.vm for result in results] == vms
+    assert [result.status for result in results] == [
+        FleetResult.SUCCEEDED, FleetResult.SUCCEEDED, FleetResult.FAILED,
+        FleetResult.SUCCEEDED, FleetResult.SUCCEEDED
+    ]
+    assert [result.value for result in results] == ['0', '1', None, '3', '4']
+    assert str(results[2].error) == 'boom'
+
+
+def test_fan_out_runs_concurrently():
+    barrier = threading.Event()
+    arrived = []
+
+    def function(vm):
+        arrived.append(vm)
+        if len(arrived) == 3:
+            barrier.set()
+        assert barrier.wait(5)
+
+    vms = [VirtualMachine() for _ in range(3)]
+    results = fan_out(vms, function, max_workers=3, quiet=True)
+    assert all(result.status == FleetResult.SUCCEEDED for result in results)
+
+
+def test_fan_out_fail_fast():
+    def function(vm):
+        raise Exception
+
+    results = fan_out(
+        [VirtualMachine() for _ in range(5)], function, max_workers=1,
+        fail_fast=True, quiet=True
+    )
+    assert results[0].status == FleetResult.FAILED
+    assert results[-1].status == FleetResult.CANCELLED
+
+
+@mock.patch('vcdriver.fleet.run_ssh_command')
+@mock.patch('vcdriver.fleet.connect_ssh')
+def test_fleet_ssh(connect_ssh, run_ssh_command):
+    os.environ['vcdriver_vm_ssh_username'] = 'user'
+    os.environ['vcdriver_vm_ssh_password'] = 'pass'
+    load()
+    ok, ko, missing = [VirtualMachine() for _ in range(3)]
+    for vm in (ok, ko):
+        vm.__setattr__('_vm_object', mock.MagicMock())
+        vm._ip = '127.0.0.1'
+    connect_ssh.side_effect = [Exception, mock.MagicMock(), mock.MagicMock()]
+    run_ssh_command.side_effect = lambda client, *args: (
+        (0, 'out', '') if run_ssh_command.call_count == 1 else (1, '', 'err')
+    )
+    results = fleet_ssh([ok, ko, missing], 'uptime', max_workers=1)
+    assert [result.status for result in results] == [
+        FleetResult.SUCCEEDED, FleetResult.FAILED, FleetResult.FAILED
+    ]
+    assert results[0].stdout == 'out'
+    assert isinstance(results[1].error, SshError)
+    assert results[1].stderr == 'err'
+    assert isinstance(results[2].error, NoObjectFound)
+    connect_ssh.assert_called_with('127.0.0.1', 'user', 'pass', timeout=10)
+    run_ssh_command.assert_called_with(mock.ANY, 'uptime', False, 'pass')
+
+
+@mock.patch.object(VirtualMachine, 'winrm')
+def test_fleet_winrm(winrm):
+    os.environ['vcdriver_vm_winrm_username'] = 'user'
+    os.environ['vcdriver_vm_winrm_password'] = 'pass'
+    load()
+    winrm.side_effect = [(0, 'out', ''), WinRmError('ls', 1, '', 'err')]
+    vms = fleet(2) + [VirtualMachine()]
+    results = fleet_winrm(vms, 'ls', max_workers=1, quiet=True)
+    assert [result.return_code for result in results] == [0, 1, None]
+    assert isinstance(results[2].error, NoObjectFound)
+    assert winrm.call_count == 2
+    winrm.assert_called_with(
+        'ls', {}, quiet=True, vcdriver_vm_winrm_username='user',
+        vcdriver_vm_winrm_password='pass'
+    )
+
+
+def task_info(error=None, result=None, seconds=2):
+    queue_time = datetime.datetime(2018, 1, 1)
+    return mock.Mock(
+        state=vim.TaskInfo.State.error if error else
+        vim.TaskInfo.State.success,
+        error=error,
+        result=result,
+        queueTime=queue_time,
+        completeTime=queue_time + datetime.timedelta(seconds=seconds)
+    )
+
+
+def fleet(size):
+    vms = [VirtualMachine(name=str(i), timeout=i + 1) for i in range(size)]
+    for vm in vms:
+        vm.__setattr__('_vm_object', mock.MagicMock())
+    return vms
+
+
+@mock.patch('vcdriver.fleet.connection')
+@mock.patch('vcdriver.fleet.wait_for_vcenter_tasks')
+@mock.patch.object(VirtualMachine, 'find_snapshot')
+def test_fleet_create_snapshot(find_snapshot, wait_for_tasks, connection):
+    vms = fleet(3) + [VirtualMachine(name='undeployed')]
+    find_snapshot.side_effect = [
+        NoObjectFound(vim.vm.Snapshot, 'snap'),
+        mock.MagicMock(),
+        NoObjectFound(vim.vm.Snapshot, 'snap'),
+    ]
+    wait_for_tasks.return_value = [task_info(), task_info(Exception('ko'))]
+    for vm in vms:
+        vm._snapshots = 'cache'
+    results = fleet_create_snapshot(vms, 'snap', True, max_workers=1)
+    assert [result.status for result in results] == [
+        FleetResult.SUCCEEDED, FleetResult.FAILED, FleetResult.FAILED,
+        FleetResult.SUCCEEDED
+    ]
+    assert results[0].elapsed == 2
+    assert isinstance(results[1].error, TooManyObjectsFound)
+    assert str(results[2].error) == 'ko'
+    vms[0]._vm_object.CreateSnapshot.assert_called_once_with(
+        'snap', '', True, False
+    )
+    wait_for_tasks.assert_called_once_with(
+        connection.return_value,
+        [vms[0]._vm_object.CreateSnapshot.return_value,
+         vms[2]._vm_object.CreateSnapshot.return_value],
+        'Creating snapshot "snap" on 4 vms',
+        3
+    )
+    assert all(vm._snapshots is None for vm in vms)
+
+
+@mock.patch('vcdriver.fleet.connection')
+@mock.patch('vcdriver.fleet.wait_for_vcenter_tasks')
+@mock.patch.object(VirtualMachine, 'find_snapshot')
+def test_fleet_revert_and_remove_snapshot(
+        find_snapshot, wait_for_tasks, connection
+):
+    vms = fleet(2) + [VirtualMachine(name='undeployed')]
+    wait_for_tasks.side_effect = lambda connection, tasks, *args: [
+        task_info(result='done') for _ in tasks
+    ]
+    results = fleet_revert_snapshot(vms, 'snap', timeout=10, quiet=True)
+    assert [result.value for result in results] == ['done', 'done', None]
+    assert wait_for_tasks.call_args[0][2:] == (
+        'Restoring snapshot "snap" on 3 vms', 10
+    )
+    snapshot = find_snapshot.return_value
+    assert snapshot.RevertToSnapshot_Task.call_count == 2
+    fleet_remove_snapshot(vms, 'snap', remove_children=True, quiet=True)
+    snapshot.RemoveSnapshot_Task.assert_called_with(True)
+    assert wait_for_tasks.call_args[0][2:] == (
+        'Delete snapshot "snap" from 3 vms', 2
+    )
+
+
+@mock.patch('vcdriver.fleet.get_properties')
+@mock.patch('vcdriver.fleet.connection', mock.MagicMock())
+@mock.patch('vcdriver.fleet.vim.host.AutoStartManager')
+def test_fleet_set_autostart(auto_start_manager, get_properties):
+    vms = fleet(3) + [VirtualMachine(name='undeployed')]
+    first, second = mock.MagicMock(), mock.MagicMock()
+    second.configManager.autoStartManager.ReconfigureAutostart.side_effect = (
+        Exception('ko')
+    )
+    get_properties.return_value = [
+        {'summary.runtime.host': host} for host in (first, second, first)
+    ]
+    results = fleet_set_autostart(vms, start_delay=5, quiet=True)
+    assert [result.status for result in results] == [
+        FleetResult.SUCCEEDED, FleetResult.FAILED, FleetResult.SUCCEEDED,
+        FleetResult.SUCCEEDED
+    ]
+    assert str(results[1].error) == 'ko'
+    reconfigure = first.configManager.autoStartManager.ReconfigureAutostart
+    reconfigure.assert_called_once_with(auto_start_manager.Config.return_value)
+    auto_start_manager.SystemDefaults.assert_called_with(
+        enabled=True, startDelay=5
+    )
+    assert [
+        (call[1]['key'], call[1]['startOrder'])
+        for call in auto_start_manager.AutoPowerInfo.call_args_list
+    ] == [(vms[0]._vm_object, 1), (vms[2]._vm_object, 2), (
+        vms[1]._vm_object, 1
+    )]
+
+
+@mock.patch('vcdriver.fleet.get_properties')
+def test_fleet_set_autostart_nothing_deployed(get_properties):
+    results = fleet_set_autostart([VirtualMachine()])
+    assert results[0].status == FleetResult.SUCCEEDED
+    assert get_properties.call_count == 0
+
+
+@mock.patch('vcdriver.fleet.get_properties')
+@mock.patch('vcdriver.fleet.connection')
+@mock.patch('vcdriver.fleet.wait_for_vcenter_tasks')
+@mock.patch.object(VirtualMachine, 'find_snapshot')
+def test_fleet_snapshot(
+        find_snapshot, wait_for_tasks, connection, get_properties
+):
+    vms = fleet(2)
+    get_properties.return_value = [
+        {'runtime.powerState': 'poweredOn'},
+        {'runtime.powerState': 'poweredOff'}
+    ]
+    find_snapshot.side_effect = NoObjectFound(vim.vm.Snapshot, 'snap')
+    wait_for_tasks.side_effect = lambda connection, tasks, *args: [
+        task_info() for _ in tasks
+    ]
+    with fleet_snapshot(vms, name='snap', quiet=True) as phases:
+        find_snapshot.side_effect = None
+        assert len(phases['create']) == 2
+        vms[0]._vm_object.CreateSnapshot.assert_called_once_with(
+            'snap', '', True, False
+        )
+    assert sorted(phases) == ['create', 'remove', 'revert']
+    assert vms[0]._vm_object.PowerOnVM_Task.call_count == 0
+    assert get_properties.call_args[0][1:] == (
+        [vm._vm_object for vm in vms],
+        vim.VirtualMachine,
+        ['runtime.powerState']
+    )
+
+
+@mock.patch('vcdriver.fleet.get_all_vcenter_objects')
+@mock.patch('vcdriver.fleet.get_properties')
+@mock.patch('vcdriver.fleet.connection')
+@mock.patch('vcdriver.fleet.wait_for_vcenter_tasks')
+@mock.patch.object(VirtualMachine, 'find_snapshot')
+def test_fleet_snapshot_disk_keep(
+        find_snapshot,
+        wait_for_tasks,
+        connection,
+        get_properties,
+        get_all_vcenter_objects
+):
+    vms = fleet(2)
+    # The kept snapshot of the first vm was taken while it was running
+    vms[0].__setattr__('_snapshots', ({'vcdriver-disk': [
+        mock.Mock(state=vim.VirtualMachine.PowerState.poweredOn)
+    ]}, {}))
+    datacenter = mock.MagicMock()
+    get_all_vcenter_objects.return_value = [datacenter]
+    get_properties.side_effect = [
+        [{'runtime.powerState': 'poweredOff'},
+         {'runtime.powerState': 'poweredOff'}],
+        [{'runtime.powerState': 'poweredOff'}],
+    ]
+    find_snapshot.side_effect = [
+        mock.MagicMock(), NoObjectFound(vim.vm.Snapshot, 'snap'),
+        NoObjectFound(vim.vm.Snapshot, 'snap'),
+    ]
+    wait_for_tasks.side_effect = [
+        [task_info()],
+        [task_info(), task_info()],
+        [task_info(result=mock.Mock(attempted=[
+            mock.Mock(vm=vms[0]._vm_object, task=None)
+        ], notAttempted=[]))],
+        [],
+    ]
+    with fleet_snapshot(vms, strategy='disk', keep=True, quiet=True) as phases:
+        find_snapshot.side_effect = None
+        assert [result.vm for result in phases['create']] == [vms[1]]
+        vms[1]._vm_object.CreateSnapshot.assert_called_once_with(
+            'vcdriver-disk', '', False, False
+        )
+    assert sorted(phases) == ['create', 'power_on', 'revert']
+    assert [result.vm for result in phases['power_on']] == [vms[0]]
+    assert phases['power_on'][0].status == FleetResult.SUCCEEDED
+    datacenter.PowerOnMultiVM_Task.assert_called_once_with(
+        vm=[vms[0]._vm_object]
+    )
+
+
+@mock.patch('vcdriver.fleet.get_properties')
+@mock.patch('vcdriver.fleet.connection', mock.MagicMock())
+@mock.patch('vcdriver.fleet.fleet_create_snapshot', mock.MagicMock())
+@mock.patch('vcdriver.fleet.fleet_revert_snapshot', mock.MagicMock())
+@mock.patch('vcdriver.fleet.fleet_power_on')
+@mock.patch.object(VirtualMachine, 'find_snapshot')
+def test_fleet_snapshot_keep_power_state(
+        find_snapshot, fleet_power_on, get_properties
+):
+    vms = fleet(4)
+    # The kept snapshots recorded the opposite of the current power states
+    for vm, state in zip(vms[:2], ['poweredOff', 'poweredOn']):
+        vm.__setattr__('_snapshots', ({'kept': [mock.Mock(state=state)]}, {}))
+    get_properties.return_value = [{'runtime.powerState': 'poweredOn'}, {}]
+    find_snapshot.side_effect = lambda name: mock.MagicMock()
+    with fleet_snapshot(
+            vms[:2], strategy='disk', keep=True, name='kept', quiet=True
+    ):
+        pass
+    fleet_power_on.assert_called_once_with([vms[1]], quiet=True)
+    # The snapshots of the last two vms are created now
+    find_snapshot.side_effect = NoObjectFound(vim.vm.Snapshot, 'kept')
+    fleet_power_on.reset_mock()
+    with fleet_snapshot(
+            vms[2:], strategy='disk', keep=True, name='kept', quiet=True
+    ):
+        pass
+    fleet_power_on.assert_called_once_with([vms[2]], quiet=True)
+
+
+@mock.patch('vcdriver.fleet.get_all_vcenter_objects')
+@mock.patch('vcdriver.fleet.get_properties')
+@mock.patch('vcdriver.fleet.connection')
+@mock.patch('vcdriver.fleet.wait_for_vcenter_tasks')
+def test_fleet_power_on(
+        wait_for_tasks, connection, get_properties, get_all_vcenter_objects
+):
+    vms = fleet(7) + [VirtualMachine(name='undeployed')]
+    objects = [vm._vm_object for vm in vms]
+    get_properties.return_value = [
+        {'runtime.powerState': state} for state in [
+            'poweredOff', 'poweredOn', 'poweredOff', 'suspended',
+            'poweredOff', 'poweredOff', 'poweredOff'
+        ]
+    ]
+    first, second = mock.MagicMock(), mock.MagicMock()
+    get_all_vcenter_objects.side_effect = [
+        [first, second],
+        [objects[0], objects[2], objects[5], objects[6], mock.MagicMock()],
+        [objects[3]],
+    ]
+    wait_for_tasks.side_effect = [
+        [
+            task_info(result=mock.Mock(
+                attempted=[
+                    mock.Mock(vm=objects[0], task='task0'),
+                    mock.Mock(vm=objects[5], task=None),
+                    mock.Mock(vm=objects[6], task='task6'),
+                ],
+                notAttempted=[mock.Mock(vm=objects[2], fault='no resources')]
+            ), seconds=3),
+            task_info(Exception('ko')),
+        ],
+        [
+            task_info(vim.fault.InvalidPowerState(), seconds=5),
+            task_info(Exception('late')),
+        ],
+    ]
+    results = fleet_power_on(vms, quiet=True)
+    assert [result.status for result in results] == [
+        FleetResult.SUCCEEDED, FleetResult.SUCCEEDED, FleetResult.FAILED,
+        FleetResult.FAILED, FleetResult.FAILED, FleetResult.SUCCEEDED,
+        FleetResult.FAILED, FleetResult.SUCCEEDED
+    ]
+    assert results[0].elapsed == 5
+    assert results[5].elapsed == 3
+    assert results[2].error == 'no resources'
+    assert str(results[3].error) == 'ko'
+    assert str(results[6].error) == 'late'
+    assert isinstance(results[4].error, NoObjectFound)
+    first.PowerOnMultiVM_Task.assert_called_once_with(
+        vm=[objects[0], objects[2], objects[5], objects[6]]
+    )
+    second.PowerOnMultiVM_Task.assert_called_once_with(vm=[objects[3]])
+    assert wait_for_tasks.call_args_list[0][0][2:] == ('Power on 6 vms', 7)
+    assert wait_for_tasks.call_args_list[1][0][1] == ['task0', 'task6']
+    get_all_vcenter_objects.assert_called_with(
+        connection.return_value, vim.VirtualMachine, second
+    )
+
+
+@mock.patch('vcdriver.fleet.get_all_vcenter_objects')
+@mock.patch('vcdriver.fleet.get_properties')
+@mock.patch('vcdriver.fleet.connection', mock.MagicMock())
+@mock.patch('vcdriver.fleet.wait_for_vcenter_tasks')
+def test_fleet_power_on_nothing_to_do(
+        wait_for_tasks, get_properties, get_all_vcenter_objects
+):
+    get_properties.return_value = [{'runtime.powerState': 'poweredOn'}]
+    wait_for_tasks.return_value = []
+    results = fleet_power_on(fleet(1) + [VirtualMachine()], timeout=5)
+    assert [result.status for result in results] == [FleetResult.SUCCEEDED] * 2
+    assert get_all_vcenter_objects.call_count == 0
+    assert wait_for_tasks.call_args_list[0][0][1:] == (
+        [], 'Power on 0 vms', 5
+    )
+
+
+@mock.patch('vcdriver.fleet.get_properties')
+@mock.patch('vcdriver.fleet.connection', mock.MagicMock())
+@mock.patch('vcdriver.fleet.wait_for_vcenter_tasks')
+def test_fleet_power_off_and_reset(wait_for_tasks, get_properties):
+    vms = fleet(3) + [VirtualMachine()]
+    get_properties.return_value = [
+        {'runtime.powerState': state}
+        for state in ['poweredOn', 'poweredOff', 'suspended']
+    ]
+    wait_for_tasks.side_effect = lambda connection, tasks, *args: [
+        task_info(vim.fault.InvalidPowerState()) for _ in tasks
+    ]
+    results = fleet_power_off(vms, quiet=True)
+    assert all(result.status == FleetResult.SUCCEEDED for result in results)
+    assert [vm._vm_object.PowerOffVM_Task.call_count for vm in vms[:3]] == [
+        1, 0, 1
+    ]
+    assert wait_for_tasks.call_args[0][2] == 'Power off 2 vms'
+    fleet_reset(vms, quiet=True)
+    assert [vm._vm_object.ResetVM_Task.call_count for vm in vms[:3]] == [
+        1, 0, 0
+    ]
+    assert wait_for_tasks.call_args[0][2] == 'Reset 1 vms'
+
+
+@mock.patch('vcdriver.fleet.get_properties', mock.MagicMock())
+@mock.patch('vcdriver.fleet.connection')
+@mock.patch('vcdriver.fleet.wait_for_vcenter_tasks')
+@mock.patch.object(VirtualMachine, 'find_snapshot')
+def test_fleet_snapshot_create_fail(find_snapshot, wait_for_tasks, connection):
+    vms = [VirtualMachine(name='undeployed')] + fleet(2)
+    snapshot = mock.MagicMock()
+    find_snapshot.side_effect = [
+        NoObjectFound(vim.vm.Snapshot, 'snap'),
+        NoObjectFound(vim.vm.Snapshot, 'snap'),
+        snapshot,
+    ]
+    wait_for_tasks.side_effect = [
+        [task_info(), task_info(Exception('ko'))],
+        [task_info()],
+    ]
+    with pytest.raises(FleetError) as error:
+        with fleet_snapshot(vms, max_workers=1, quiet=True):
+            pass  # pragma: no cover
+    assert str(error.value).endswith(
+        'failed on 1 of 3 virtual machines: 1 (ko)'
+    )
+    assert [result.vm for result in error.value.results] == vms
+    assert vms[1]._vm_object.CreateSnapshot.call_count == 1
+    snapshot.RemoveSnapshot_Task.assert_called_once_with(False)
+
+
+@mock.patch('vcdriver.fleet.get_properties')
+@mock.patch('vcdriver.fleet.connection')
+@mock.patch('vcdriver.fleet.wait_for_vcenter_tasks')
+@mock.patch.object(VirtualMachine, 'find_snapshot')
+def test_fleet_snapshot_revert_fail(
+        find_snapshot, wait_for_tasks, connection, get_properties
+):
+    vms = fleet(1)
+    find_snapshot.side_effect = NoObjectFound(vim.vm.Snapshot, 'snap')
+    wait_for_tasks.side_effect = [
+        [task_info()], [task_info(Exception('ko'))], [task_info()],
+    ]
+    with pytest.raises(FleetError) as error:
+        with fleet_snapshot(vms, name='snap', quiet=True):
+            find_snapshot.side_effect = None
+    assert 'Revert snapshot "snap"' in str(error.value)
+
+
+@mock.patch('vcdriver.fleet.get_properties')
+@mock.patch('vcdriver.fleet.connection')
+@mock.patch('vcdriver.fleet.wait_for_vcenter_tasks')
+@mock.patch.object(VirtualMachine, 'find_snapshot')
+def test_fleet_snapshot_revert_fail_after_body_error(
+        find_snapshot, wait_for_tasks, connection, get_properties, capsys
+):
+    vms = fleet(1)
+    find_snapshot.side_effect = NoObjectFound(vim.vm.Snapshot, 'snap')
+    wait_for_tasks.side_effect = [
+        [task_info()], [task_info(Exception('ko'))], [task_info()],
+    ]
+    with pytest.raises(ValueError):
+        with fleet_snapshot(vms, name='snap', quiet=True):
+            find_snapshot.side_effect = None
+            raise ValueError('body')
+    assert 'Revert snapshot "snap"' in capsys.readouterr().out
+    assert wait_for_tasks.call_count == 3
+
+
+@mock.patch('vcdriver.fleet.get_properties', mock.MagicMock())
+@mock.patch('vcdriver.fleet.connection', mock.MagicMock())
+@mock.patch('vcdriver.fleet.wait_for_vcenter_tasks')
+@mock.patch.object(VirtualMachine, 'find_snapshot')
+def test_fleet_snapshot_keep_create_fail(find_snapshot, wait_for_tasks):
+    find_snapshot.side_effect = NoObjectFound(vim.vm.Snapshot, 'snap')
+    wait_for_tasks.return_value = [task_info(Exception('ko'))]
+    with pytest.raises(FleetError):
+        with fleet_snapshot(fleet(1), keep=True, quiet=True):
+            pass  # pragma: no cover
+    assert wait_for_tasks.call_count == 1
+
+
+@mock.patch('vcdriver.fleet.connection')
+@mock.patch('vcdriver.fleet.wait_for_properties')
+def test_fleet_wait_for_ips(wait_for_properties, connection):
+    vms = fleet(3) + [VirtualMachine()]
+    vms[0].__setattr__('_ip', '10.0.0.1')
+    wait_for_properties.return_value = [
+        {'guest.ipAddress': '10.0.0.2'}, {'guest.ipAddress': '10.0.0.3'}
+    ]
+    assert fleet_wait_for_ips(vms) == [
+        '10.0.0.1', '10.0.0.2', '10.0.0.3', None
+    ]
+    args = wait_for_properties.call_args[0]
+    assert args[1] == [vm._vm_object for vm in vms[1:3]]
+    assert args[4]({'guest.ipAddress': '10.0.0.2'})
+    assert args[5:] == ('Get IP of 2 vms', 3, False)
+    assert fleet_wait_for_ips(vms[:1] + vms[3:]) == ['10.0.0.1', None]
+    assert wait_for_properties.call_count == 1
+    wait_for_properties.return_value = [{'guest.ipAddress': '10.0.0.2'}]
+    assert fleet_wait_for_ips(vms[1:2], timeout=10, quiet=True) == [
+        '10.0.0.2'
+    ]
+    assert wait_for_properties.call_args[0][6:] == (10, True)
+
+
+@mock.patch('vcdriver.fleet.probe_ports')
+@mock.patch('vcdriver.fleet.fleet_wait_for_ips')
+def test_fleet_wait_for_port(fleet_wait_for_ips, probe_ports):
+    vms = fleet(3)
+    fleet_wait_for_ips.return_value = ['10.0.0.1', None, '10.0.0.3']
+    probe_ports.side_effect = [[False, True], [True]]
+    fleet_wait_for_port(vms, 22, banner=b'SSH-', quiet=True)
+    fleet_wait_for_ips.assert_called_once_with(vms, 3, quiet=True)
+    assert probe_ports.call_args_list == [
+        mock.call([('10.0.0.1', 22), ('10.0.0.3', 22)], banner=b'SSH-'),
+        mock.call([('10.0.0.1', 22)], banner=b'SSH-'),
+    ]
+    fleet_wait_for_ips.return_value = []
+    fleet_wait_for_port([], 5985, timeout=1)
+    assert probe_ports.call_count == 2
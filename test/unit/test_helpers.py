@@ -1,3 +1,10 @@
+import errno
+import os
+import socket
+import struct
+import threading
+import time
+
 import mock
 import pytest
 from pyVmomi import vim, vmodl
@@ -9,13 +16,36 @@ from vcdriver.exceptions import (
     IpError,
 )
 from vcdriver.helpers import (
+    call_timeout,
+    cancel_vcenter_tasks,
+    check_ssh_service,
+    check_winrm_service,
+    connect_ssh,
+    deadline,
+    diff_manifests,
+    file_lock,
     get_all_vcenter_objects,
+    get_inventory_properties,
+    get_local_manifest,
+    get_properties,
     get_vcenter_object_by_name,
+    grace_period,
+    guest_file_url,
+    last_wait_stats,
+    parse_manifest,
+    probe_ports,
+    propagate_deadline,
+    remaining_time,
+    RetryPolicy,
+    run_ssh_command,
     timeout_loop,
     validate_ip,
     validate_ipv4,
     validate_ipv6,
+    wait_for_properties,
     wait_for_vcenter_task,
+    wait_for_vcenter_tasks,
+    wait_until,
 )
 
 
@@ -83,6 +113,73 @@ def test_get_vcenter_object_by_name():
         )
 
 
+def test_get_properties():
+    vm1 = vim.VirtualMachine('vm-1')
+    vm2 = vim.VirtualMachine('vm-2')
+    vm3 = vim.VirtualMachine('vm-3')
+    collector = mock.MagicMock()
+    connection_mock = mock.MagicMock()
+    connection_mock.RetrieveContent.return_value.propertyCollector = collector
+
+    def object_content(obj, **properties):
+        prop_set = []
+        for name, value in properties.items():
+            prop = mock.Mock(val=value)
+            prop.name = name
+            prop_set.append(prop)
+        return mock.Mock(obj=obj, propSet=prop_set)
+
+    collector.RetrievePropertiesEx.return_value = mock.Mock(
+        objects=[object_content(vm2, name='two')], token='more'
+    )
+    collector.ContinueRetrievePropertiesEx.return_value = mock.Mock(
+        objects=[object_content(vm1, name='one')], token=None
+    )
+    assert get_properties(
+        connection_mock, [vm1, vm2, vm3], vim.VirtualMachine, ('name',)
+    ) == [{'name': 'one'}, {'name': 'two'}, {}]
+    spec = collector.RetrievePropertiesEx.call_args[0][0][0]
+    assert [obj_spec.obj for obj_spec in spec.objectSet] == [vm1, vm2, vm3]
+    assert spec.propSet[0].pathSet == ['name']
+    collector.ContinueRetrievePropertiesEx.assert_called_once_with('more')
+
+
+def test_get_inventory_properties():
+    collector = mock.MagicMock()
+    connection_mock = mock.MagicMock()
+    content = connection_mock.RetrieveContent.return_value
+    content.propertyCollector = collector
+    view = vim.view.ContainerView('session[1]view-1', stub=mock.Mock())
+    content.viewManager.CreateContainerView.return_value = view
+    data_store = vim.Datastore('ds-1')
+    pod = vim.StoragePod('pod-1')
+
+    def object_content(obj, **properties):
+        prop_set = []
+        for name, value in properties.items():
+            prop = mock.Mock(val=value)
+            prop.name = name
+            prop_set.append(prop)
+        return mock.Mock(obj=obj, propSet=prop_set)
+
+    collector.RetrievePropertiesEx.return_value = mock.Mock(
+        objects=[object_content(data_store, name='ds')], token='more'
+    )
+    collector.ContinueRetrievePropertiesEx.return_value = mock.Mock(
+        objects=[object_content(pod)], token=None
+    )
+    assert get_inventory_properties(connection_mock, [
+        (vim.Datastore, ('name',)), (vim.StoragePod, ['name'])
+    ]) == [(data_store, {'name': 'ds'}), (pod, {})]
+    content.viewManager.CreateContainerView.assert_called_once_with(
+        content.rootFolder, [vim.Datastore, vim.StoragePod], True
+    )
+    spec = collector.RetrievePropertiesEx.call_args[0][0][0]
+    assert spec.objectSet[0].obj is view
+    assert spec.propSet[0].pathSet == ['name']
+    assert view._stub.InvokeMethod.call_args[0][1].name == 'Destroy'
+
+
 def test_timeout_loop_success():
     timeout_loop(1, '', 1, False, lambda: True)
 
@@ -92,6 +189,123 @@ def test_timeout_loop_fail():
         timeout_loop(1, '', 1, False, lambda: False)
 
 
+@mock.patch('vcdriver.helpers.time.sleep')
+def test_timeout_loop_retry_policy(sleep):
+    results = iter([False, False, True])
+    stats = timeout_loop(
+        10, '', RetryPolicy(1, 3, 2), True, lambda: next(results)
+    )
+    assert [call[0][0] for call in sleep.call_args_list] == [1, 2]
+    assert stats['attempts'] == 3
+    assert last_wait_stats() == stats
+
+
+def test_retry_policy():
+    policy = RetryPolicy(1, 8, 2)
+    assert [policy.interval(i) for i in range(1, 6)] == [1, 2, 4, 8, 8]
+    assert policy.interval(3, eta=6) == 3
+    assert policy.interval(3, eta=0) == 1
+    assert policy.interval(3, eta=100) == 8
+    assert RetryPolicy(5).interval(10) == 5
+    assert 1 <= RetryPolicy(1, 4, jitter=0.5).interval(1) <= 1.5
+    assert 2 <= RetryPolicy(1, 4, 4, jitter=0.5).interval(2) <= 4
+    assert RetryPolicy(1, jitter=0.5).interval(1) == 1
+    assert str(policy) == repr(policy) == 'RetryPolicy(1-8s, x2, +/-0)'
+
+
+def test_wait_until_reports_last_error():
+    def callback():
+        raise ValueError('not yet')
+    with pytest.raises(TimeoutError) as error:
+        wait_until(0.1, 'description', callback, RetryPolicy(0.05), True)
+    assert 'description. not yet' in str(error.value)
+    assert last_wait_stats()['attempts'] >= 2
+
+
+def test_deadline_bounds_waits():
+    start = time.time()
+    with deadline(0.2):
+        with pytest.raises(TimeoutError):
+            wait_until(60, 'description', lambda: False, RetryPolicy(0.05))
+        with pytest.raises(TimeoutError):
+            timeout_loop(60, 'description', 0.05, True, lambda: False)
+    assert time.time() - start < 1
+
+
+def test_deadline_nesting():
+    assert remaining_time() is None
+    assert remaining_time(5) == 5
+    with deadline(10):
+        assert 9 < remaining_time() <= 10
+        assert remaining_time(5) == 5
+        with deadline(60):
+            assert remaining_time(60) <= 10
+        with deadline(1):
+            assert remaining_time(5) <= 1
+        assert 1 < remaining_time() <= 10
+    assert remaining_time() is None
+
+
+def test_propagate_deadline():
+    results = []
+
+    def run():
+        results.append(remaining_time())
+    with deadline(10):
+        thread = threading.Thread(target=propagate_deadline(run))
+    thread.start()
+    thread.join()
+    thread = threading.Thread(target=propagate_deadline(run))
+    thread.start()
+    thread.join()
+    assert 0 < results[0] <= 10
+    assert results[1] is None
+
+
+def test_wait_until_default_policy():
+    assert wait_until(1, 'description', lambda: True)['attempts'] == 1
+
+
+def test_get_local_manifest(tmpdir):
+    tmpdir.join('file-0').write(b'abc', mode='wb')
+    tmpdir.mkdir('dir-0').join('file-1').write(b'', mode='wb')
+    os.utime(str(tmpdir.join('file-0')), (1530000000.5, 1530000000.5))
+    os.utime(str(tmpdir.join('dir-0', 'file-1')), (1530000001, 1530000001))
+    assert get_local_manifest(str(tmpdir)) == {
+        'file-0': '900150983cd24fb0d6963f7d28e17f72',
+        'dir-0/file-1': 'd41d8cd98f00b204e9800998ecf8427e'
+    }
+    assert get_local_manifest(str(tmpdir), checksum=False) == {
+        'file-0': '3-1530000000',
+        'dir-0/file-1': '0-1530000001'
+    }
+
+
+def test_parse_manifest():
+    assert parse_manifest(
+        'ABC\tfile-0\r\n3\tdir-0\\file-1\n\ngarbage\n'
+    ) == {'file-0': 'abc', 'dir-0/file-1': '3'}
+
+
+def test_diff_manifests():
+    assert diff_manifests(
+        {'same': '1', 'changed': '2', 'new': '3'},
+        {'same': '1', 'changed': '0', 'stale': '4'}
+    ) == (['changed', 'new'], ['stale'])
+
+
+def test_guest_file_url():
+    assert guest_file_url(
+        'https://*:443/guestFile?id=1', vcdriver_host='vcenter'
+    ) == 'https://vcenter:443/guestFile?id=1'
+    assert guest_file_url(
+        'https://*/guestFile?id=1', vcdriver_host='vcenter'
+    ) == 'https://vcenter/guestFile?id=1'
+    assert guest_file_url(
+        'https://esxi:443/guestFile?id=1', vcdriver_host='vcenter'
+    ) == 'https://esxi:443/guestFile?id=1'
+
+
 def test_validate_ip_success_version_4():
     assert validate_ip('127.0.0.1') == {
         'ip': '127.0.0.1', 'version': 4
@@ -137,10 +351,110 @@ def test_validate_ipv6_fail():
     assert not validate_ipv6('127.0.0.1')
 
 
+def property_update(version, *object_changes):
+    object_updates = []
+    for obj, changes in object_changes:
+        change_set = []
+        for op, name, value in changes:
+            change = mock.Mock(op=op, val=value)
+            change.name = name
+            change_set.append(change)
+        object_updates.append(mock.Mock(obj=obj, changeSet=change_set))
+    return mock.Mock(
+        version=version, filterSet=[mock.Mock(objectSet=object_updates)]
+    )
+
+
+def test_wait_for_properties():
+    vm1 = vim.VirtualMachine('vm-1')
+    vm2 = vim.VirtualMachine('vm-2')
+    connection_mock = mock.MagicMock()
+    content = connection_mock.RetrieveContent.return_value
+    collector = content.propertyCollector.CreatePropertyCollector.return_value
+    collector.WaitForUpdatesEx.side_effect = [
+        property_update(
+            '1',
+            (vm1, [('assign', 'guest.ipAddress', '10.0.0.1')]),
+            (vm2, [('assign', 'guest.ipAddress', '10.0.0.2')])
+        ),
+        None,
+        property_update(
+            '2', (vm2, [('remove', 'guest.ipAddress', None)])
+        ),
+        property_update(
+            '3', (vm1, [('assign', 'guest.ipAddress', '10.0.0.3')])
+        ),
+        property_update(
+            '4', (vm2, [('assign', 'guest.ipAddress', '10.0.0.2')])
+        ),
+    ]
+    condition = mock.Mock(side_effect=[
+        True, False, False, False, False, True
+    ])
+    assert wait_for_properties(
+        connection_mock,
+        [vm1, vm2],
+        vim.VirtualMachine,
+        ['guest.ipAddress'],
+        condition,
+        'description',
+        10
+    ) == [{'guest.ipAddress': '10.0.0.3'}, {'guest.ipAddress': '10.0.0.2'}]
+    versions = [
+        call[0][0] for call in collector.WaitForUpdatesEx.call_args_list
+    ]
+    assert versions == ['', '1', '1', '2', '3']
+    filter_spec = collector.CreateFilter.call_args[0][0]
+    assert [obj_spec.obj for obj_spec in filter_spec.objectSet] == [vm1, vm2]
+    assert collector.DestroyPropertyCollector.call_count == 1
+
+
+def test_wait_for_properties_timeout():
+    connection_mock = mock.MagicMock()
+    content = connection_mock.RetrieveContent.return_value
+    collector = content.propertyCollector.CreatePropertyCollector.return_value
+    collector.WaitForUpdatesEx.return_value = None
+    with pytest.raises(TimeoutError):
+        wait_for_properties(
+            connection_mock,
+            [vim.VirtualMachine('vm-1')],
+            vim.VirtualMachine,
+            ['guest.ipAddress'],
+            lambda properties: False,
+            'description',
+            0,
+            quiet=True
+        )
+    assert collector.WaitForUpdatesEx.call_args[0][1].maxWaitSeconds == 1
+    assert collector.DestroyPropertyCollector.call_count == 1
+
+
+def test_wait_for_properties_ready():
+    vm = vim.VirtualMachine('vm-1')
+    connection_mock = mock.MagicMock()
+    content = connection_mock.RetrieveContent.return_value
+    collector = content.propertyCollector.CreatePropertyCollector.return_value
+    collector.WaitForUpdatesEx.return_value = property_update(
+        '1', (vm, [('assign', 'guest.ipAddress', '10.0.0.1')])
+    )
+    assert wait_for_properties(
+        connection_mock,
+        [vm],
+        vim.VirtualMachine,
+        ['guest.ipAddress'],
+        lambda properties: properties.get('guest.ipAddress'),
+        'description',
+        10,
+        quiet=True
+    ) == [{'guest.ipAddress': '10.0.0.1'}]
+
+
 def test_wait_for_vcenter_task_wait_for_success():
     task = mock.Mock(vim.Task)
 
     class TaskInfoTimeline:
+        progress = None
+
         def __init__(self, states, result):
             self.result = result
             self._state_iter = iter(states)
@@ -160,6 +474,22 @@ def test_wait_for_vcenter_task_wait_for_success():
         task.info.state
 
 
+def test_wait_for_vcenter_task_info_error_retried():
+    task = mock.Mock(vim.Task)
+    info = mock.Mock(state=vim.TaskInfo.State.success, result='hello')
+    infos = iter([Exception('connection reset'), info, info, info])
+
+    def next_info(_):
+        value = next(infos)
+        if isinstance(value, Exception):
+            raise value
+        return value
+    type(task).info = property(next_info)
+    assert wait_for_vcenter_task(
+        task, 'description', timeout=2, _poll_interval=0
+    ) == 'hello'
+
+
 def test_wait_for_vcenter_task_fail():
     task = mock.MagicMock()
     task.info.state = vim.TaskInfo.State.error
@@ -178,5 +508,277 @@ def test_wait_for_vcenter_task_fail_no_exception():
 def test_wait_for_vcenter_task_timeout():
     task = mock.MagicMock()
     task.info.state = vim.TaskInfo.State.running
+    task.info.progress = None
     with pytest.raises(TimeoutError):
         wait_for_vcenter_task(task, 'description', timeout=1)
+
+
+@mock.patch('vcdriver.helpers.time.sleep')
+@mock.patch('vcdriver.helpers._monotonic')
+def test_wait_for_vcenter_task_follows_progress(monotonic, sleep):
+    monotonic.side_effect = [0, 0, 10, 10, 10, 10, 11]
+    task = mock.MagicMock()
+    task.info.progress = 80
+    task.info.state = vim.TaskInfo.State.running
+
+    def finish(seconds):
+        task.info.state = vim.TaskInfo.State.success
+    sleep.side_effect = finish
+    assert wait_for_vcenter_task(
+        task, 'description', timeout=60
+    ) == task.info.result
+    # 10 seconds for 80%, so the 2.5 seconds left are polled at half
+    assert 1.25 * 0.9 <= sleep.call_args[0][0] <= 1.25 * 1.1
+
+
+def test_wait_for_vcenter_task_cancel_on_timeout():
+    task = mock.MagicMock()
+    task.info.state = vim.TaskInfo.State.running
+    task.info.progress = None
+    task.info.cancelable = True
+
+    def cancel():
+        task.info.state = vim.TaskInfo.State.error
+    task.CancelTask.side_effect = cancel
+    with pytest.raises(TimeoutError):
+        wait_for_vcenter_task(
+            task, 'description', timeout=0.1, cancel_on_timeout=True
+        )
+    assert task.CancelTask.call_count == 1
+
+
+def test_cancel_vcenter_tasks():
+    finished = mock.MagicMock()
+    finished.info.state = vim.TaskInfo.State.success
+    stuck = mock.MagicMock()
+    stuck.info.state = vim.TaskInfo.State.running
+    stuck.info.cancelable = False
+    racing = mock.MagicMock()
+    racing.info.state = vim.TaskInfo.State.running
+    racing.info.cancelable = True
+    racing.CancelTask.side_effect = vim.fault.InvalidState()
+    with deadline(0):
+        infos = cancel_vcenter_tasks(
+            [finished, stuck, racing], grace=0.1, _poll_interval=0.05
+        )
+    assert infos == [finished.info, stuck.info, racing.info]
+    assert finished.CancelTask.call_count == 0
+    assert stuck.CancelTask.call_count == 0
+    assert racing.CancelTask.call_count == 1
+
+
+@mock.patch('vcdriver.helpers.cancel_vcenter_tasks')
+@mock.patch('vcdriver.helpers.get_properties')
+def test_wait_for_vcenter_tasks_cancel_on_timeout(
+        get_properties, cancel_vcenter_tasks
+):
+    running = mock.Mock(state=vim.TaskInfo.State.running)
+    success = mock.Mock(state=vim.TaskInfo.State.success)
+    get_properties.side_effect = lambda connection, tasks, *args: [
+        {'info': success if task == 'task1' else running} for task in tasks
+    ]
+    with pytest.raises(TimeoutError):
+        wait_for_vcenter_tasks(
+            'connection', ['task1', 'task2'], 'description', 0.1,
+            _poll_interval=0.05, cancel_on_timeout=True
+        )
+    cancel_vcenter_tasks.assert_called_once_with(
+        ['task2'], _poll_interval=0.05
+    )
+
+
+def test_file_lock_non_blocking(tmpdir):
+    path = str(tmpdir.join('lock'))
+    with file_lock(path) as locked:
+        assert locked
+        with file_lock(path, blocking=False) as other:
+            assert not other
+    with file_lock(path, blocking=False) as locked:
+        assert locked
+
+
+@mock.patch('vcdriver.helpers.fcntl.flock')
+def test_file_lock_error(flock, tmpdir):
+    flock.side_effect = OSError(errno.EBADF, 'Bad file descriptor')
+    with pytest.raises(OSError):
+        with file_lock(str(tmpdir.join('lock')), blocking=False):
+            pass
+
+
+def test_grace_period():
+    with deadline(0):
+        assert remaining_time(10) == 0
+        with grace_period(5):
+            assert 4 < remaining_time(10) <= 5
+        assert remaining_time(10) == 0
+
+
+@mock.patch('vcdriver.helpers.get_properties')
+def test_wait_for_vcenter_tasks(get_properties):
+    running = mock.Mock(state=vim.TaskInfo.State.running)
+    success = mock.Mock(state=vim.TaskInfo.State.success)
+    error = mock.Mock(state=vim.TaskInfo.State.error)
+    get_properties.side_effect = [
+        [{'info': running}, {}, {'info': error}],
+        [{'info': success}, {'info': success}],
+    ]
+    tasks = ['task1', 'task2', 'task3']
+    assert wait_for_vcenter_tasks(
+        'connection', tasks, 'description', timeout=2, _poll_interval=0
+    ) == [success, success, error]
+    get_properties.assert_called_with(
+        'connection', ['task1', 'task2'], vim.Task, ['info']
+    )
+
+
+@mock.patch('vcdriver.helpers.get_properties')
+def test_wait_for_vcenter_tasks_nothing_to_wait(get_properties):
+    assert wait_for_vcenter_tasks('connection', [], 'description', 1) == []
+    assert get_properties.call_count == 0
+
+
+@mock.patch('vcdriver.helpers.get_properties')
+def test_wait_for_vcenter_tasks_timeout(get_properties):
+    get_properties.return_value = [
+        {'info': mock.Mock(state=vim.TaskInfo.State.running)}
+    ]
+    with pytest.raises(TimeoutError):
+        wait_for_vcenter_tasks('connection', ['task'], 'description', 1)
+
+
+@mock.patch('vcdriver.helpers.paramiko.SSHClient')
+def test_connect_ssh(ssh_client):
+    assert connect_ssh('host', 'user', 'pass', 5) == ssh_client.return_value
+    ssh_client.return_value.connect.assert_called_once_with(
+        'host', username='user', password='pass', timeout=5,
+        allow_agent=False, look_for_keys=False
+    )
+    ssh_client.return_value.connect.side_effect = Exception
+    with pytest.raises(Exception):
+        connect_ssh('host', 'user', 'pass')
+    ssh_client.return_value.close.assert_called_once_with()
+    with deadline(0):
+        with pytest.raises(TimeoutError):
+            connect_ssh('host', 'user', 'pass', 5)
+    assert ssh_client.return_value.connect.call_count == 2
+
+
+def test_call_timeout():
+    assert call_timeout('description') is None
+    assert call_timeout('description', 5) == 5
+    with deadline(10):
+        assert 0 < call_timeout('description') <= 10
+        assert call_timeout('description', 5) == 5
+    with deadline(0):
+        with pytest.raises(TimeoutError):
+            call_timeout('description')
+        with pytest.raises(TimeoutError):
+            call_timeout('description', 5)
+
+
+def test_run_ssh_command():
+    client = mock.MagicMock()
+    stdin, stdout, stderr = [mock.MagicMock() for _ in range(3)]
+    client.exec_command.return_value = stdin, stdout, stderr
+    stdout.read.return_value = b'out'
+    stderr.read.return_value = b'err'
+    stdout.channel.recv_exit_status.return_value = 3
+    assert run_ssh_command(client, 'ls') == (3, 'out', 'err')
+    client.exec_command.assert_called_with('ls')
+    assert not stdin.write.called
+    run_ssh_command(client, 'ls -l', use_sudo=True, password='pass')
+    client.exec_command.assert_called_with('sudo -S -p "" sh -c \'ls -l\'')
+    stdin.write.assert_called_once_with('pass\n')
+
+
+def tcp_server(greeting=None, reset=False):
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+
+    def serve():
+        client, _ = server.accept()
+        if reset:
+            time.sleep(0.1)
+            client.setsockopt(
+                socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0)
+            )
+        elif isinstance(greeting, list):
+            for segment in greeting:
+                client.sendall(segment)
+                time.sleep(0.05)
+        elif greeting:
+            client.sendall(greeting)
+        else:
+            client.recv(1)
+        client.close()
+        server.close()
+
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    return ('127.0.0.1', server.getsockname()[1])
+
+
+def closed_port():
+    probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    probe.bind(('127.0.0.1', 0))
+    address = ('127.0.0.1', probe.getsockname()[1])
+    probe.close()
+    return address
+
+
+def test_probe_ports():
+    assert probe_ports([tcp_server(b'anything'), closed_port()]) == [
+        True, False
+    ]
+
+
+def test_probe_ports_banner():
+    assert probe_ports(
+        [
+            tcp_server(b'SSH-2.0-OpenSSH\r\n'),
+            tcp_server([b'S', b'SH-2.0-OpenSSH\r\n']),
+            tcp_server(b'HTTP/1.1 400\r\n'),
+            tcp_server(b'SS'),
+            tcp_server(reset=True),
+            tcp_server(),
+            closed_port(),
+        ],
+        timeout=0.5,
+        banner=b'SSH-'
+    ) == [True, True, False, False, False, False, False]
+
+
+@mock.patch('vcdriver.helpers.socket.socket')
+def test_probe_ports_connection_error(socket_class):
+    socket_class.return_value.connect_ex.return_value = 111
+    assert probe_ports([('127.0.0.1', 22)]) == [False]
+    assert socket_class.return_value.close.call_count == 1
+
+
+@mock.patch('vcdriver.helpers.run')
+@mock.patch('vcdriver.helpers.probe_ports')
+def test_check_ssh_service(probe_ports, run):
+    probe_ports.return_value = [False]
+    assert not check_ssh_service('127.0.0.1', 'user', 'pass')
+    assert run.call_count == 0
+    probe_ports.assert_called_once_with([('127.0.0.1', 22)], banner=b'SSH-')
+    probe_ports.return_value = [True]
+    assert check_ssh_service('127.0.0.1', 'user', 'pass')
+    run.assert_called_once_with('')
+
+
+@mock.patch('vcdriver.helpers.winrm.protocol.Protocol.send_message')
+@mock.patch('vcdriver.helpers.probe_ports')
+def test_check_winrm_service(probe_ports, send_message):
+    probe_ports.return_value = [False]
+    assert not check_winrm_service('127.0.0.1', 'user', 'pass')
+    assert send_message.call_count == 0
+    probe_ports.assert_called_once_with([('127.0.0.1', 5985)])
+    probe_ports.return_value = [True]
+    assert check_winrm_service(
+        '127.0.0.1', 'user', 'pass', transport='ssl'
+    )
+    probe_ports.assert_called_with([('127.0.0.1', 5986)])
+    assert 'wsmid:Identify' in send_message.call_args[0][0]
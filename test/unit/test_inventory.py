@@ -0,0 +1,161 @@
+import datetime
+
+import mock
+from pyVmomi import vim
+from pyVmomi.Iso8601 import ParseISO8601
+
+from vcdriver.inventory import Inventory
+
+
+def object_update(obj, kind, *changes):
+    change_set = []
+    for op, name, value in changes:
+        change = mock.Mock(op=op, val=value)
+        change.name = name
+        change_set.append(change)
+    return mock.Mock(obj=obj, kind=kind, changeSet=change_set)
+
+
+def update(version, truncated, *object_updates):
+    return mock.Mock(
+        version=version,
+        truncated=truncated,
+        filterSet=[mock.Mock(objectSet=list(object_updates))]
+    )
+
+
+def mocked_connection(api_version='6.7.3'):
+    connection = mock.MagicMock()
+    content = connection.RetrieveContent.return_value
+    content.about.apiVersion = api_version
+    content.viewManager.CreateContainerView.return_value = (
+        vim.view.ContainerView('session[1]view-1', stub=mock.Mock())
+    )
+    return connection, (
+        content.propertyCollector.CreatePropertyCollector.return_value
+    )
+
+
+folder = vim.Folder('group-v1')
+host = vim.HostSystem('host-1')
+vm1 = vim.VirtualMachine('vm-1')
+vm2 = vim.VirtualMachine('vm-2')
+
+
+def test_inventory_sync():
+    connection, collector = mocked_connection()
+    collector.WaitForUpdatesEx.side_effect = [
+        update(
+            '1', True,
+            object_update(
+                folder, 'enter', ('assign', 'name', 'ci'),
+                ('assign', 'parent', vim.Folder('group-d1'))
+            ),
+            object_update(
+                vm1, 'enter', ('assign', 'name', 'ci-1'),
+                ('assign', 'parent', folder),
+                ('assign', 'runtime.powerState', 'poweredOn'),
+                ('assign', 'runtime.host', host),
+                ('assign', 'config.template', False),
+                ('assign', 'config.createDate',
+                 ParseISO8601('2018-06-13T17:12:43+02:00'))
+            ),
+        ),
+        update(
+            '2', False,
+            object_update(
+                vm2, 'enter', ('assign', 'name', 'ci-2'),
+                ('assign', 'parent', folder),
+                ('assign', 'runtime.powerState', 'poweredOff'),
+                ('assign', 'config.createDate',
+                 ParseISO8601('2018-07-01T00:00:00Z')),
+                ('assign', 'guest.ipAddress', 'ignored')
+            ),
+            object_update(host, 'enter', ('assign', 'name', 'esxi-1')),
+        ),
+    ]
+    inventory = Inventory()
+    assert inventory.sync(connection) == 4
+    assert inventory.version == '2'
+    assert collector.WaitForUpdatesEx.call_args_list[0][0][0] == ''
+    assert collector.WaitForUpdatesEx.call_args[0][0] == '1'
+    spec = collector.CreateFilter.call_args[0][0]
+    assert [prop.type for prop in spec.propSet] == [
+        vim.VirtualMachine, vim.Folder, vim.Datastore, vim.HostSystem
+    ]
+    assert 'config.createDate' in spec.propSet[0].pathSet
+    assert inventory.get('vm-1') == {
+        'moid': 'vm-1', 'type': 'VirtualMachine', 'name': 'ci-1',
+        'parent': 'group-v1', 'power_state': 'poweredOn', 'host': 'host-1',
+        'template': 0, 'created_at': '2018-06-13T15:12:43'
+    }
+    assert inventory.get('vm-3') is None
+    assert [row['moid'] for row in inventory.find()] == [
+        'group-v1', 'vm-1', 'vm-2', 'host-1'
+    ]
+    assert [
+        row['name'] for row in inventory.find(
+            vim.VirtualMachine, name='ci-*', folder='ci'
+        )
+    ] == ['ci-1', 'ci-2']
+    assert [
+        row['name'] for row in inventory.find(power_state='poweredOff')
+    ] == ['ci-2']
+    assert [
+        row['name'] for row in inventory.find(
+            created_after=datetime.datetime(2018, 6, 20),
+            created_before='2018-12-31'
+        )
+    ] == ['ci-2']
+    inventory.close()
+    assert collector.DestroyPropertyCollector.call_count == 1
+    assert collector.CreateFilter.return_value.Destroy.call_count == 1
+    view = connection.RetrieveContent.return_value.viewManager.\
+        CreateContainerView.return_value
+    assert view._stub.InvokeMethod.call_args[0][1].name == 'Destroy'
+
+
+def test_inventory_incremental_sync(tmpdir):
+    connection, collector = mocked_connection()
+    collector.WaitForUpdatesEx.side_effect = [
+        update(
+            '1', False,
+            object_update(vm1, 'enter', ('assign', 'name', 'ci-1'),
+                          ('assign', 'runtime.powerState', 'poweredOn')),
+            object_update(vm2, 'enter', ('assign', 'name', 'ci-2')),
+        ),
+        None,
+        update(
+            '2', False,
+            object_update(vm1, 'modify',
+                          ('remove', 'runtime.powerState', None)),
+            object_update(vm2, 'leave'),
+        ),
+    ]
+    path = str(tmpdir.join('inventory.db'))
+    inventory = Inventory(path)
+    with mock.patch('vcdriver.inventory.session_connection') as session:
+        session.return_value = connection
+        assert inventory.sync() == 2
+        assert inventory.sync() == 0
+        assert inventory.sync(wait=10) == 2
+    assert collector.CreatePropertyCollector.call_count == 0
+    assert collector.WaitForUpdatesEx.call_args[0][1].maxWaitSeconds == 10
+    assert inventory.find() == [{
+        'moid': 'vm-1', 'type': 'VirtualMachine', 'name': 'ci-1',
+        'parent': None, 'power_state': None, 'host': None, 'template': None,
+        'created_at': None
+    }]
+    inventory.close()
+    # The file keeps the mirror for readers, until a mirror object syncs
+    inventory = Inventory(path)
+    assert len(inventory.find()) == 1
+    connection, collector = mocked_connection('6.5')
+    collector.WaitForUpdatesEx.return_value = None
+    assert inventory.sync(connection) == 0
+    assert inventory.find() == []
+    spec = collector.CreateFilter.call_args[0][0]
+    assert 'config.createDate' not in spec.propSet[0].pathSet
+    inventory.close()
+    # A mirror that never synced has nothing to destroy
+    Inventory(path).close()
@@ -0,0 +1,122 @@
+import json
+import os
+import shutil
+import tempfile
+
+import mock
+import pytest
+from pyVmomi import vim
+
+from vcdriver.exceptions import IpPoolExhausted
+from vcdriver.network import IpPool, customization_ip, release_leases
+
+
+@pytest.fixture
+def leases_path():
+    directory = tempfile.mkdtemp()
+    yield os.path.join(directory, 'leases.json')
+    shutil.rmtree(directory)
+
+
+def test_ip_pool(leases_path):
+    pool = IpPool(
+        '10.0.0.9/29', exclude=['10.0.0.10'], leases_path=leases_path
+    )
+    assert (pool.subnet_mask, pool.gateway) == ('255.255.255.248', '10.0.0.9')
+    other_process_pool = IpPool(
+        '10.0.0.8/29', exclude=['10.0.0.10'], leases_path=leases_path
+    )
+    assert [pool.allocate('vm1'), other_process_pool.allocate('vm2')] == [
+        '10.0.0.11', '10.0.0.12'
+    ]
+    with open(leases_path) as leases_file:
+        assert json.load(leases_file) == {
+            '10.0.0.11': 'vm1', '10.0.0.12': 'vm2'
+        }
+    assert [pool.allocate('vm') for _ in range(2)] == [
+        '10.0.0.13', '10.0.0.14'
+    ]
+    with pytest.raises(IpPoolExhausted):
+        pool.allocate('vm')
+    pool.release('10.0.0.12')
+    pool.release('10.0.0.12')
+    assert pool.allocate('vm3') == '10.0.0.12'
+    assert str(pool) == repr(pool) == '10.0.0.9/29'
+
+
+def test_ip_pool_release_owner(leases_path):
+    pool = IpPool('10.0.0.0/29', leases_path=leases_path)
+    assert [pool.allocate(owner) for owner in ('vm1', 'vm2', 'vm1')] == [
+        '10.0.0.2', '10.0.0.3', '10.0.0.4'
+    ]
+    # A pool of another process releases the leases of a lost vm object
+    other_process_pool = IpPool('10.0.0.0/29', leases_path=leases_path)
+    assert other_process_pool.release_owner('vm1') == [
+        '10.0.0.2', '10.0.0.4'
+    ]
+    assert other_process_pool.release_owner('vm1') == []
+    with open(leases_path) as leases_file:
+        assert json.load(leases_file) == {'10.0.0.3': 'vm2'}
+
+
+def test_release_leases(leases_path):
+    pool = IpPool('10.1.0.0/29', leases_path=leases_path)
+    IpPool('10.2.0.0/29', leases_path=leases_path + '.missing')
+    pool.allocate('vm1')
+    pool.allocate('vm2')
+    assert release_leases('vm1') == ['10.1.0.2']
+    assert release_leases('vm1') == []
+    assert not os.path.exists(leases_path + '.missing')
+
+
+def test_ip_pool_default_leases_path():
+    pool = IpPool('10.0.0.0/24', gateway='10.0.0.254')
+    assert pool.leases_path == os.path.join(
+        tempfile.gettempdir(), 'vcdriver-ip-pool-10.0.0.0-24.json'
+    )
+    assert pool.gateway == '10.0.0.254'
+
+
+@mock.patch.object(IpPool, '_write_leases', mock.MagicMock())
+def test_ip_pool_corrupted_leases(leases_path):
+    with open(leases_path, 'w') as leases_file:
+        leases_file.write('{')
+    assert IpPool('10.0.0.0/24', leases_path=leases_path).allocate('vm') == (
+        '10.0.0.2'
+    )
+
+
+def test_ip_pool_linux_customization():
+    pool = IpPool(
+        '10.0.0.0/24', dns_servers=['8.8.8.8'], domain='example.com'
+    )
+    spec = pool.customization('10.0.0.2', 'my_vm.1')
+    assert isinstance(spec.identity, vim.vm.customization.LinuxPrep)
+    assert spec.identity.hostName.name == 'my-vm-1'
+    assert spec.identity.domain == 'example.com'
+    assert spec.globalIPSettings.dnsServerList == ['8.8.8.8']
+    adapter = spec.nicSettingMap[0].adapter
+    assert adapter.subnetMask == '255.255.255.0'
+    assert adapter.gateway == ['10.0.0.1']
+    assert customization_ip(spec) == '10.0.0.2'
+    assert pool.customization('10.0.0.2', '__').identity.hostName.name == (
+        'vcdriver'
+    )
+
+
+def test_ip_pool_windows_customization():
+    pool = IpPool('10.0.0.0/24', windows=True)
+    spec = pool.customization('10.0.0.2', 'a-very-long-windows-name')
+    assert isinstance(spec.identity, vim.vm.customization.Sysprep)
+    assert spec.identity.userData.computerName.name == 'a-very-long-win'
+
+
+def test_customization_ip_dhcp():
+    assert customization_ip(vim.vm.customization.Specification()) is None
+    assert customization_ip(vim.vm.customization.Specification(
+        nicSettingMap=[vim.vm.customization.AdapterMapping(
+            adapter=vim.vm.customization.IPSettings(
+                ip=vim.vm.customization.DhcpIpGenerator()
+            )
+        )]
+    )) is None
@@ -0,0 +1,377 @@
+import mock
+import os
+import pytest
+from pyVmomi import vim
+
+from vcdriver.exceptions import NoObjectFound, NotEnoughDiskSpace
+from vcdriver.placement import (
+    data_store_placement,
+    default_host_score,
+    find_data_stores,
+    host_placement,
+    plan_placement,
+    release_data_store,
+    release_host,
+    select_data_store,
+    select_host,
+    template_replica,
+)
+from vcdriver.vm import VirtualMachine
+
+
+data_stores = [vim.Datastore('ds-{}'.format(i)) for i in range(4)]
+storage_pods = [vim.StoragePod('pod-1')]
+data_store_properties = [
+    {'name': 'ssd-1', 'summary.capacity': 100, 'summary.freeSpace': 50},
+    {'name': 'ssd-2', 'summary.capacity': 100, 'summary.freeSpace': 40},
+    {'name': 'hdd-1', 'summary.capacity': 100, 'summary.freeSpace': 90},
+    {
+        'name': 'ssd-3', 'summary.capacity': 100, 'summary.freeSpace': 99,
+        'summary.accessible': False
+    },
+]
+
+
+def fake_get_inventory_properties(connection, property_specs):
+    return list(zip(data_stores, data_store_properties)) + [
+        (storage_pods[0], {'name': 'cluster', 'childEntity': data_stores[1:3]})
+    ]
+
+
+patch_get_inventory_properties = mock.patch(
+    'vcdriver.placement.get_inventory_properties',
+    side_effect=fake_get_inventory_properties
+)
+
+
+@patch_get_inventory_properties
+def test_find_data_stores(get_inventory_properties):
+    assert [obj for obj, _ in find_data_stores('conn', 'ssd-*')] == (
+        data_stores[:2]
+    )
+    assert get_inventory_properties.call_count == 1
+    assert [
+        object_type for object_type, _ in
+        get_inventory_properties.call_args[0][1]
+    ] == [vim.Datastore, vim.StoragePod]
+    assert [obj for obj, _ in find_data_stores('conn', 'hdd-1, ssd-2')] == (
+        data_stores[1:3]
+    )
+    assert [obj for obj, _ in find_data_stores('conn', 'cluster,')] == (
+        data_stores[1:3]
+    )
+    assert find_data_stores('conn', 'missing') == []
+
+
+@mock.patch('vcdriver.placement.get_inventory_properties')
+def test_find_data_stores_resource_pool(get_inventory_properties):
+    clusters = [
+        vim.ClusterComputeResource('domain-1'),
+        vim.ClusterComputeResource('domain-2'),
+    ]
+    resource_pool = mock.MagicMock(owner=clusters[1])
+    get_inventory_properties.return_value = (
+        fake_get_inventory_properties('conn', []) + [
+            (clusters[0], {'datastore': data_stores[:1]}),
+            (clusters[1], {'datastore': data_stores[1:]}),
+        ]
+    )
+    assert [obj for obj, _ in find_data_stores(
+        'conn', 'ssd-*', resource_pool
+    )] == data_stores[1:2]
+    assert get_inventory_properties.call_args[0][1][-1] == (
+        vim.ComputeResource, ['datastore']
+    )
+    assert find_data_stores('conn', 'ssd-1', resource_pool) == []
+    resource_pool.owner = vim.ComputeResource('domain-3')
+    assert find_data_stores('conn', 'ssd-*', resource_pool) == []
+    with pytest.raises(NoObjectFound):
+        select_data_store('conn', 'ssd-1', 20, resource_pool)
+
+
+@mock.patch('vcdriver.placement.get_inventory_properties')
+def test_find_data_stores_literal_names(get_inventory_properties):
+    get_inventory_properties.return_value = [
+        (data_stores[0], {'name': 'ds[1]'}),
+        (data_stores[1], {'name': 'ds,2'}),
+        (data_stores[2], {'name': 'ds1'}),
+    ]
+    assert [obj for obj, _ in find_data_stores('conn', 'ds[1]')] == (
+        data_stores[0:1] + data_stores[2:3]
+    )
+    assert [obj for obj, _ in find_data_stores('conn', ['ds,2'])] == (
+        data_stores[1:2]
+    )
+    assert [obj for obj, _ in find_data_stores('conn', 'ds[[]1]')] == (
+        data_stores[0:1]
+    )
+
+
+@patch_get_inventory_properties
+def test_select_data_store_spreads_clones(get_inventory_properties):
+    chosen = [select_data_store('conn', 'ssd-*', 30) for _ in range(3)]
+    assert chosen == [data_stores[0], data_stores[1], data_stores[0]]
+    for obj in chosen:
+        release_data_store(obj)
+    assert select_data_store('conn', 'ssd-*', 45) == data_stores[0]
+    assert select_data_store('conn', 'ssd-*', 45) == data_stores[0]
+    release_data_store(data_stores[0])
+    release_data_store(data_stores[0])
+
+
+@patch_get_inventory_properties
+def test_select_data_store_errors(get_inventory_properties):
+    with pytest.raises(NoObjectFound):
+        select_data_store('conn', 'missing', 20)
+    with pytest.raises(NotEnoughDiskSpace) as error:
+        select_data_store('conn', 'ssd-*', 60)
+    assert 'ssd-1' in str(error.value)
+
+
+@mock.patch('vcdriver.placement.get_inventory_properties')
+def test_select_data_store_no_capacity(get_inventory_properties):
+    get_inventory_properties.return_value = [
+        (obj, {'name': 'ds'}) for obj in data_stores
+    ]
+    with pytest.raises(NotEnoughDiskSpace):
+        select_data_store('conn', 'ds', 0.1)
+
+
+@patch_get_inventory_properties
+def test_data_store_placement(get_inventory_properties):
+    with data_store_placement('conn', 'hdd-1,ssd-1', 20) as first:
+        with data_store_placement('conn', 'hdd-1,ssd-1', 20) as second:
+            assert (first, second) == (data_stores[2], data_stores[0])
+    with pytest.raises(Exception):
+        with data_store_placement('conn', 'hdd-1,ssd-1', 20) as obj:
+            assert obj == data_stores[2]
+            raise Exception
+    with data_store_placement('conn', 'hdd-1,ssd-1', 20) as obj:
+        assert obj == data_stores[2]
+
+
+hosts = [vim.HostSystem('host-{}'.format(i)) for i in range(4)]
+
+
+def host_properties(name, cpu, memory, state='connected', maintenance=False):
+    return {
+        'name': name,
+        'runtime.connectionState': state,
+        'runtime.inMaintenanceMode': maintenance,
+        'summary.hardware.cpuMhz': 1000,
+        'summary.hardware.numCpuCores': 10,
+        'summary.hardware.memorySize': 1024 * 1024 * 1024,
+        'summary.quickStats.overallCpuUsage': cpu,
+        'summary.quickStats.overallMemoryUsage': memory,
+    }
+
+
+def test_default_host_score():
+    assert default_host_score(host_properties('h', 5000, 256), 1) == 1.75
+    assert default_host_score({}, 0) == 2
+
+
+@mock.patch('vcdriver.placement.get_properties')
+def test_select_host(get_properties):
+    resource_pool = mock.MagicMock()
+    resource_pool.owner.host = hosts
+    get_properties.return_value = [
+        host_properties('busy', 9000, 900),
+        host_properties('idle', 1000, 100),
+        host_properties('off', 0, 0, state='disconnected'),
+        host_properties('maintenance', 0, 0, maintenance=True),
+    ]
+    chosen = [select_host('conn', resource_pool) for _ in range(3)]
+    assert chosen == [hosts[1], hosts[1], hosts[0]]
+    get_properties.assert_called_with(
+        'conn', hosts, vim.HostSystem, mock.ANY
+    )
+    for obj in chosen:
+        release_host(obj)
+    assert select_host(
+        'conn', resource_pool, lambda properties, in_flight: -in_flight
+    ) == hosts[0]
+    release_host(hosts[0])
+    get_properties.return_value = get_properties.return_value[2:]
+    with pytest.raises(NoObjectFound):
+        select_host('conn', resource_pool)
+
+
+@mock.patch('vcdriver.placement.get_properties')
+def test_select_host_data_store(get_properties):
+    resource_pool = mock.MagicMock()
+    resource_pool.owner.host = hosts[:3]
+    get_properties.return_value = [
+        dict(host_properties('local', 0, 0), datastore=[data_stores[0]]),
+        dict(host_properties('idle', 0, 0), datastore=[data_stores[1]]),
+        dict(host_properties('busy', 9000, 900), datastore=data_stores[:2]),
+    ]
+    assert select_host(
+        'conn', resource_pool, data_store=data_stores[1]
+    ) == hosts[1]
+    assert select_host(
+        'conn',
+        resource_pool,
+        lambda properties, in_flight: {
+            'local': 0, 'busy': 1, 'idle': 2
+        }[properties['name']],
+        data_stores[1]
+    ) == hosts[2]
+    release_host(hosts[1])
+    release_host(hosts[2])
+    assert 'datastore' in get_properties.call_args[0][3]
+    with pytest.raises(NoObjectFound):
+        select_host('conn', resource_pool, data_store=data_stores[2])
+
+
+@mock.patch('vcdriver.placement.select_host')
+@mock.patch('vcdriver.placement.release_host')
+def test_host_placement(release_host, select_host):
+    with host_placement('conn', 'pool', None) as host:
+        assert host is None
+    assert select_host.call_count == 0
+    with host_placement('conn', 'pool', data_store='ds') as host:
+        assert host == select_host.return_value
+    select_host.assert_called_once_with(
+        'conn', 'pool', default_host_score, 'ds'
+    )
+    release_host.assert_called_once_with(host)
+
+
+@mock.patch('vcdriver.placement.connection')
+@mock.patch('vcdriver.placement.get_vcenter_object_by_name')
+def test_plan_placement(get_vcenter_object_by_name, connection):
+    resource_pool = get_vcenter_object_by_name.return_value
+    resource_pool.owner.host = hosts[:2]
+    host_mocks = [mock.MagicMock(), mock.MagicMock()]
+    host_mocks[0].name = 'host-a'
+    host_mocks[1].name = 'host-b'
+    data_store_mocks = [mock.MagicMock(), mock.MagicMock()]
+    data_store_mocks[0].name = 'ssd-1'
+    data_store_mocks[1].name = 'ssd-2'
+    vms = [VirtualMachine(name='vm1'), VirtualMachine(name='vm2')]
+    with mock.patch(
+        'vcdriver.placement.select_data_store', side_effect=data_store_mocks
+    ), mock.patch(
+        'vcdriver.placement.select_host', side_effect=host_mocks
+    ) as select_host, mock.patch('vcdriver.placement._release') as release:
+        assert plan_placement(
+            vms,
+            vcdriver_resource_pool='pool',
+            vcdriver_data_store='ssd-*',
+            vcdriver_data_store_threshold='20'
+        ) == [(vms[0], 'host-a', 'ssd-1'), (vms[1], 'host-b', 'ssd-2')]
+        assert release.call_count == 4
+        assert select_host.call_args[0][3] == data_store_mocks[1]
+    with mock.patch(
+        'vcdriver.placement.select_data_store', side_effect=data_store_mocks
+    ), mock.patch('vcdriver.placement._release') as release:
+        assert plan_placement(
+            vms,
+            host_score=None,
+            vcdriver_resource_pool='pool',
+            vcdriver_data_store='ssd-*',
+            vcdriver_data_store_threshold='20'
+        ) == [(vms[0], None, 'ssd-1'), (vms[1], None, 'ssd-2')]
+        assert release.call_count == 2
+
+
+@mock.patch('vcdriver.placement.wait_for_vcenter_task')
+@mock.patch('vcdriver.placement.get_vcenter_object_by_name')
+@mock.patch('vcdriver.placement.get_properties')
+def test_template_replica(
+        get_properties, get_vcenter_object_by_name, wait_for_vcenter_task
+):
+    template = mock.MagicMock()
+    replica = mock.MagicMock()
+    template_properties = {
+        'config.instanceUuid': 'uuid',
+        'config.changeVersion': '1',
+        'datastore': [data_stores[0]],
+        'parent': 'folder',
+    }
+    fingerprint = 'Replica of template "template" uuid 1'
+
+    # The template is already on the datastore
+    get_vcenter_object_by_name.return_value = template
+    get_properties.return_value = [template_properties]
+    assert template_replica('conn', 'template', data_stores[0], 10) == (
+        template
+    )
+
+    # The replica is missing
+    get_vcenter_object_by_name.side_effect = [
+        template, NoObjectFound(vim.VirtualMachine, 'replica')
+    ]
+    get_properties.side_effect = [
+        [template_properties], [{'name': 'ssd-2'}]
+    ]
+    assert template_replica('conn', 'template', data_stores[1], 10) == (
+        wait_for_vcenter_task.return_value
+    )
+    assert get_vcenter_object_by_name.call_args[0][2] == (
+        'template-replica-ssd-2'
+    )
+    clone_kwargs = template.CloneVM_Task.call_args[1]
+    assert clone_kwargs['folder'] == 'folder'
+    assert clone_kwargs['name'] == 'template-replica-ssd-2'
+    assert clone_kwargs['spec'].location.datastore == data_stores[1]
+    assert clone_kwargs['spec'].config.annotation == fingerprint
+    assert clone_kwargs['spec'].template
+
+    # The replica is up to date
+    get_vcenter_object_by_name.side_effect = [template, replica]
+    get_properties.side_effect = [
+        [template_properties],
+        [{'name': 'ssd-2'}],
+        [{'config.annotation': fingerprint}]
+    ]
+    assert template_replica('conn', 'template', data_stores[1], 10) == (
+        replica
+    )
+    assert wait_for_vcenter_task.call_count == 1
+
+    # The template changed
+    get_vcenter_object_by_name.side_effect = [template, replica]
+    get_properties.side_effect = [
+        [dict(template_properties, **{'config.changeVersion': '2'})],
+        [{'name': 'ssd-2'}],
+        [{'config.annotation': fingerprint}]
+    ]
+    template_replica('conn', 'template', data_stores[1], 10)
+    wait_for_vcenter_task.assert_any_call(
+        replica.Destroy_Task.return_value, mock.ANY, 10
+    )
+    assert template.CloneVM_Task.call_args[1]['spec'].config.annotation == (
+        'Replica of template "template" uuid 2'
+    )
+
+
+@mock.patch('vcdriver.placement.file_lock')
+@mock.patch('vcdriver.placement.wait_for_vcenter_task')
+@mock.patch('vcdriver.placement.get_vcenter_object_by_name')
+@mock.patch('vcdriver.placement.get_properties')
+def test_template_replica_file_lock(
+        get_properties,
+        get_vcenter_object_by_name,
+        wait_for_vcenter_task,
+        file_lock
+):
+    template = mock.MagicMock()
+    get_vcenter_object_by_name.side_effect = [
+        template, NoObjectFound(vim.VirtualMachine, 'replica')
+    ]
+    get_properties.side_effect = [
+        [{'datastore': [], 'parent': 'folder'}], [{'name': 'ssd/2 [x]'}]
+    ]
+
+    def create(*args, **kwargs):
+        assert file_lock.return_value.__enter__.call_count == 1
+        assert file_lock.return_value.__exit__.call_count == 0
+
+    template.CloneVM_Task.side_effect = create
+    template_replica('conn', 'base', data_stores[1], 10)
+    assert os.path.basename(file_lock.call_args[0][0]) == (
+        'vcdriver-base-replica-ssd-2--x-.lock'
+    )
+    assert file_lock.return_value.__exit__.call_count == 1
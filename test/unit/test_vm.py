@@ -1,16 +1,24 @@
+import base64
 import datetime
+import functools
 import mock
 import os
+import stat
+import sys
+import time
 
 import pytest
-from pyVmomi import vim
+from pyVmomi import vim, vmodl
 import winrm
 
+from vcdriver.admission import AdmissionController, set_controller
 from vcdriver.exceptions import (
     NoObjectFound,
     TooManyObjectsFound,
     SshError,
     DownloadError,
+    GuestError,
+    HandleError,
     UploadError,
     WinRmError,
     TimeoutError,
@@ -21,11 +29,44 @@ from vcdriver.vm import (
     virtual_machines,
     snapshot,
     get_all_virtual_machines,
+    STATE_PROPERTIES,
 )
 from vcdriver.config import load
+from vcdriver.helpers import deadline
+from vcdriver.network import IpPool
+
+
+@pytest.fixture(autouse=True)
+def vm_properties():
+    """ Read the vm properties from the attributes of the mocked objects """
+    def get_properties(connection, objects, object_type, property_paths):
+        return [
+            dict(
+                (path, functools.reduce(getattr, path.split('.'), obj))
+                for path in property_paths
+            )
+            for obj in objects
+        ]
+    with mock.patch(
+        'vcdriver.vm.get_properties', side_effect=get_properties
+    ) as get_properties_mock:
+        yield get_properties_mock
+
+
+@pytest.fixture(autouse=True)
+def service_probes():
+    """ Make the ssh banners and winrm ports answer, and WSMan identify """
+    with mock.patch(
+        'vcdriver.helpers.probe_ports',
+        side_effect=lambda addresses, **kwargs: [True] * len(addresses)
+    ) as probe_ports, mock.patch.object(
+        winrm.protocol.Protocol, 'send_message'
+    ) as send_message:
+        yield probe_ports, send_message
 
 
 @mock.patch('vcdriver.vm.connection')
+@mock.patch('vcdriver.vm.data_store_placement')
 @mock.patch('vcdriver.vm.get_vcenter_object_by_name')
 @mock.patch('vcdriver.vm.vim.vm.CloneSpec')
 @mock.patch('vcdriver.vm.vim.vm.RelocateSpec')
@@ -35,10 +76,11 @@ def test_virtual_machine_create(
         relocate_spec,
         clone_spec,
         get_vcenter_object_by_name,
+        data_store_placement,
         connection
 ):
     os.environ['vcdriver_resource_pool'] = 'something'
-    os.environ['vcdriver_data_store'] = 'something'
+    os.environ['vcdriver_data_store'] = 'ds1, ssd-*'
     os.environ['vcdriver_data_store_threshold'] = '20'
     os.environ['vcdriver_folder'] = 'something'
     load()
@@ -47,18 +89,111 @@ def test_virtual_machine_create(
     vm.create()
     assert vm.__getattribute__('_vm_object') is not None
     assert wait_for_vcenter_task.call_count == 1
+    data_store_placement.assert_called_once_with(
+        connection.return_value,
+        'ds1, ssd-*',
+        '20',
+        get_vcenter_object_by_name.return_value
+    )
+    assert relocate_spec.call_args[1]['datastore'] == (
+        data_store_placement.return_value.__enter__.return_value
+    )
+    assert relocate_spec.call_args[1]['host'] is None
 
 
 @mock.patch('vcdriver.vm.connection')
+@mock.patch('vcdriver.vm.data_store_placement')
+@mock.patch('vcdriver.vm.host_placement')
 @mock.patch('vcdriver.vm.get_vcenter_object_by_name')
-@mock.patch('vcdriver.vm.vim.vm.CloneSpec')
+@mock.patch('vcdriver.vm.vim.vm.CloneSpec', mock.MagicMock())
 @mock.patch('vcdriver.vm.vim.vm.RelocateSpec')
+@mock.patch('vcdriver.vm.wait_for_vcenter_task', mock.MagicMock())
+def test_virtual_machine_create_host_placement(
+        relocate_spec,
+        get_vcenter_object_by_name,
+        host_placement,
+        data_store_placement,
+        connection
+):
+    os.environ['vcdriver_resource_pool'] = 'something'
+    os.environ['vcdriver_data_store'] = 'something'
+    os.environ['vcdriver_data_store_threshold'] = '20'
+    os.environ['vcdriver_folder'] = 'something'
+    load()
+    score = mock.MagicMock()
+    with mock.patch('vcdriver.vm.template_replica') as template_replica:
+        VirtualMachine(template='template', timeout=10).create(
+            host_score=score, replicate_template=True
+        )
+    template_replica.assert_called_once_with(
+        connection.return_value,
+        'template',
+        mock.ANY,
+        10
+    )
+    template_replica.return_value.CloneVM_Task.assert_called_once_with(
+        folder=mock.ANY, name=mock.ANY, spec=mock.ANY
+    )
+    host_placement.assert_called_once_with(
+        connection.return_value,
+        get_vcenter_object_by_name.return_value,
+        score,
+        data_store_placement.return_value.__enter__.return_value
+    )
+    assert relocate_spec.call_args[1]['host'] == (
+        host_placement.return_value.__enter__.return_value
+    )
+
+
+@mock.patch('vcdriver.vm.connection', mock.MagicMock())
+@mock.patch('vcdriver.vm.data_store_placement', mock.MagicMock())
+@mock.patch('vcdriver.vm.get_vcenter_object_by_name')
+@mock.patch('vcdriver.vm.vim.vm.CloneSpec', mock.MagicMock())
+@mock.patch('vcdriver.vm.vim.vm.RelocateSpec', mock.MagicMock())
+@mock.patch('vcdriver.vm.wait_for_vcenter_task')
+def test_virtual_machine_create_cancel_on_timeout(
+        wait_for_vcenter_task, get_vcenter_object_by_name
+):
+    os.environ['vcdriver_resource_pool'] = 'something'
+    os.environ['vcdriver_data_store'] = 'something'
+    os.environ['vcdriver_data_store_threshold'] = '20'
+    os.environ['vcdriver_folder'] = 'something'
+    load()
+    task = get_vcenter_object_by_name.return_value.CloneVM_Task.return_value
+    wait_for_vcenter_task.side_effect = TimeoutError('description', 10)
+    # The clone task was cancelled
+    task.info.state = vim.TaskInfo.State.error
+    vm = VirtualMachine(timeout=10, cancel_on_timeout=True)
+    with pytest.raises(TimeoutError):
+        vm.create()
+    assert wait_for_vcenter_task.call_args[1] == {'cancel_on_timeout': True}
+    assert wait_for_vcenter_task.call_count == 1
+    # The clone completed before the cancellation landed
+    task.info.state = vim.TaskInfo.State.success
+    wait_for_vcenter_task.side_effect = [
+        TimeoutError('description', 10), None, None
+    ]
+    with pytest.raises(TimeoutError):
+        vm.create()
+    assert wait_for_vcenter_task.call_count == 4
+    task.info.result.Destroy_Task.assert_called_once_with()
+    assert vm.__getattribute__('_vm_object') is None
+    # Without the option, the clone is left alone
+    wait_for_vcenter_task.side_effect = TimeoutError('description', 10)
+    vm = VirtualMachine(timeout=10)
+    with pytest.raises(TimeoutError):
+        vm.create()
+    assert wait_for_vcenter_task.call_count == 5
+    assert task.info.result.Destroy_Task.call_count == 1
+
+
+@mock.patch('vcdriver.vm.connection')
+@mock.patch('vcdriver.vm.get_vcenter_object_by_name', mock.MagicMock())
+@mock.patch('vcdriver.vm.data_store_placement')
 @mock.patch('vcdriver.vm.wait_for_vcenter_task')
 def test_virtual_machine_create_not_enough_disk_space(
         wait_for_vcenter_task,
-        relocate_spec,
-        clone_spec,
-        get_vcenter_object_by_name,
+        data_store_placement,
         connection
 ):
     os.environ['vcdriver_resource_pool'] = 'something'
@@ -66,6 +201,7 @@ def test_virtual_machine_create_not_enough_disk_space(
     os.environ['vcdriver_data_store_threshold'] = '120'
     os.environ['vcdriver_folder'] = 'something'
     load()
+    data_store_placement.side_effect = NotEnoughDiskSpace('something', 120, 50)
     vm = VirtualMachine()
     with pytest.raises(NotEnoughDiskSpace):
         vm.create()
@@ -73,6 +209,46 @@ def test_virtual_machine_create_not_enough_disk_space(
     assert wait_for_vcenter_task.call_count == 0
 
 
+@mock.patch('vcdriver.vm.connection')
+@mock.patch('vcdriver.vm.data_store_placement', mock.MagicMock())
+@mock.patch('vcdriver.vm.get_vcenter_object_by_name', mock.MagicMock())
+@mock.patch('vcdriver.vm.vim.vm.CloneSpec')
+@mock.patch('vcdriver.vm.vim.vm.RelocateSpec', mock.MagicMock())
+@mock.patch('vcdriver.vm.wait_for_vcenter_task')
+def test_virtual_machine_create_static_ip(
+        wait_for_vcenter_task, clone_spec, connection
+):
+    os.environ['vcdriver_resource_pool'] = 'something'
+    os.environ['vcdriver_data_store'] = 'something'
+    os.environ['vcdriver_data_store_threshold'] = '20'
+    os.environ['vcdriver_folder'] = 'something'
+    load()
+    ip_pool = mock.MagicMock(spec=IpPool)
+    ip_pool.allocate.return_value = '10.0.0.2'
+    ip_pool.customization.return_value = IpPool(
+        '10.0.0.0/24'
+    ).customization('10.0.0.2', 'vm')
+    vm = VirtualMachine(name='vm')
+    vm.create(customization=ip_pool)
+    assert clone_spec.call_args[1]['customization'] == (
+        ip_pool.customization.return_value
+    )
+    ip_pool.allocate.assert_called_once_with('vm')
+    assert vm.ip() == '10.0.0.2'
+    with mock.patch('vcdriver.vm.release_leases') as release_leases:
+        vm.destroy()
+    release_leases.assert_called_once_with('vm')
+    ip_pool.release.assert_called_once_with('10.0.0.2')
+    assert vm.__getattribute__('_ip') is None
+    wait_for_vcenter_task.side_effect = Exception
+    with pytest.raises(Exception):
+        vm.create(customization=ip_pool)
+    assert ip_pool.release.call_count == 2
+    with pytest.raises(Exception):
+        vm.create(customization=vim.vm.customization.Specification())
+    assert vm.__getattribute__('_ip_pool') is None
+
+
 @mock.patch('vcdriver.vm.connection')
 @mock.patch('vcdriver.vm.wait_for_vcenter_task')
 def test_virtual_machine_destroy_vm_on(wait_for_vcenter_task, connection):
@@ -135,14 +311,98 @@ def test_virtual_machine_refresh(close, get_vcenter_object_by_name, connection):
     get_vcenter_object_by_name.assert_called_once()
 
 
+@mock.patch('vcdriver.vm.connection')
+def test_virtual_machine_search_index_finders(connection):
+    search_index = connection.return_value.content.searchIndex
+    vm_object = vim.VirtualMachine('vm-1')
+    folder_object = vim.Folder('group-v1')
+    with mock.patch.object(
+        vim.VirtualMachine, 'name', 'ci-1', create=True
+    ):
+        search_index.FindByInventoryPath.return_value = vm_object
+        vm = VirtualMachine.find_by_inventory_path('dc/vm/ci-1', timeout=5)
+        assert (vm.name, vm.timeout) == ('ci-1', 5)
+        assert vm._vm_object is vm_object
+        search_index.FindAllByUuid.return_value = [vm_object]
+        assert VirtualMachine.find_by_uuid(
+            '4213', instance_uuid=True
+        )._vm_object is vm_object
+        search_index.FindAllByUuid.assert_called_once_with(
+            uuid='4213', vmSearch=True, instanceUuid=True
+        )
+        search_index.FindAllByIp.return_value = [vm_object]
+        assert VirtualMachine.find_by_ip('10.0.0.2')._vm_object is vm_object
+        search_index.FindAllByDnsName.return_value = [vm_object]
+        assert VirtualMachine.find_by_dns_name(
+            'ci-1.example.com'
+        )._vm_object is vm_object
+        search_index.FindByInventoryPath.return_value = folder_object
+        search_index.FindChild.return_value = vm_object
+        assert VirtualMachine.find_in_folder(
+            'dc/vm/ci', 'ci-1'
+        )._vm_object is vm_object
+        search_index.FindChild.assert_called_once_with(folder_object, 'ci-1')
+    with pytest.raises(NoObjectFound):
+        VirtualMachine.find_by_inventory_path('dc/vm/ci')
+    search_index.FindAllByIp.return_value = []
+    with pytest.raises(NoObjectFound):
+        VirtualMachine.find_by_ip('10.0.0.2')
+    search_index.FindAllByUuid.return_value = [vm_object, vm_object]
+    with pytest.raises(TooManyObjectsFound):
+        VirtualMachine.find_by_uuid('4213')
+    search_index.FindChild.return_value = None
+    with pytest.raises(NoObjectFound):
+        VirtualMachine.find_in_folder('dc/vm/ci', 'ci-2')
+    search_index.FindByInventoryPath.return_value = None
+    with pytest.raises(NoObjectFound):
+        VirtualMachine.find_in_folder('dc/vm/missing', 'ci-1')
+
+
+@mock.patch('vcdriver.vm.connection')
+def test_virtual_machine_handle(connection, vm_properties):
+    vm = VirtualMachine('ci-1', 'template')
+    assert vm.handle(vcdriver_host='vcenter') is None
+    vm._vm_object = mock.MagicMock(_moId='vm-42')
+    vm._vm_object.name = 'ci-1-renamed'
+    vm._vm_object.config.instanceUuid = '5013'
+    handle = vm.handle(vcdriver_host='vcenter')
+    assert handle == {
+        'vcenter': 'vcenter',
+        'moid': 'vm-42',
+        'instance_uuid': '5013',
+        'name': 'ci-1-renamed',
+        'template': 'template'
+    }
+    vm_properties.side_effect = [[{'config.instanceUuid': '5013'}]]
+    rebound = VirtualMachine.from_handle(
+        handle, timeout=5, cancel_on_timeout=True, vcdriver_host='vcenter'
+    )
+    assert (
+        rebound.name, rebound.template, rebound.timeout,
+        rebound.cancel_on_timeout
+    ) == ('ci-1-renamed', 'template', 5, True)
+    assert rebound._vm_object._moId == 'vm-42'
+    assert rebound._vm_object._stub is connection.return_value._stub
+    with pytest.raises(HandleError):
+        VirtualMachine.from_handle(handle, vcdriver_host='other')
+    # The managed object id was reused by another virtual machine
+    vm_properties.side_effect = [[{'config.instanceUuid': '5014'}]]
+    with pytest.raises(HandleError):
+        VirtualMachine.from_handle(handle, vcdriver_host='vcenter')
+    # The virtual machine was removed
+    vm_properties.side_effect = vmodl.fault.ManagedObjectNotFound()
+    with pytest.raises(HandleError):
+        VirtualMachine.from_handle(handle, vcdriver_host='vcenter')
+
+
 @mock.patch('vcdriver.vm.connection')
 def test_virtual_machine_reboot(connection):
     vm = VirtualMachine()
     vm_object_mock = mock.MagicMock()
     reboot_mock = mock.MagicMock()
     vm_object_mock.RebootGuest = reboot_mock
-    vm_object_mock.summary.runtime.powerState = 'poweredOn'
-    vm_object_mock.summary.guest.toolsRunningStatus = 'guestToolsRunning'
+    vm_object_mock.runtime.powerState = 'poweredOn'
+    vm_object_mock.guest.toolsRunningStatus = 'guestToolsRunning'
     vm.reboot()
     vm.__setattr__('_vm_object', vm_object_mock)
     vm.reboot()
@@ -154,8 +414,8 @@ def test_virtual_machine_reboot_wrong_power_state(connection):
     vm = VirtualMachine()
     vm_object_mock = mock.MagicMock()
     reboot_mock = mock.MagicMock()
-    vm_object_mock.summary.runtime.powerState = 'poweredOff'
-    vm_object_mock.summary.guest.toolsRunningStatus = 'guestToolsRunning'
+    vm_object_mock.runtime.powerState = 'poweredOff'
+    vm_object_mock.guest.toolsRunningStatus = 'guestToolsRunning'
     vm_object_mock.RebootGuest = reboot_mock
     vm.reboot()
     vm.__setattr__('_vm_object', vm_object_mock)
@@ -169,8 +429,8 @@ def test_virtual_machine_shutdown(connection):
     vm_object_mock = mock.MagicMock()
     shutdown_mock = mock.MagicMock()
     vm_object_mock.ShutdownGuest = shutdown_mock
-    vm_object_mock.summary.runtime.powerState = 'poweredOn'
-    vm_object_mock.summary.guest.toolsRunningStatus = 'guestToolsRunning'
+    vm_object_mock.runtime.powerState = 'poweredOn'
+    vm_object_mock.guest.toolsRunningStatus = 'guestToolsRunning'
     vm.shutdown()
     vm.__setattr__('_vm_object', vm_object_mock)
     vm.shutdown()
@@ -183,8 +443,8 @@ def test_virtual_machine_shutdown_wrong_power_state(connection):
     vm_object_mock = mock.MagicMock()
     shutdown_mock = mock.MagicMock()
     vm_object_mock.ShutdownGuest = shutdown_mock
-    vm_object_mock.summary.runtime.powerState = 'poweredOff'
-    vm_object_mock.summary.guest.toolsRunningStatus = 'guestToolsRunning'
+    vm_object_mock.runtime.powerState = 'poweredOff'
+    vm_object_mock.guest.toolsRunningStatus = 'guestToolsRunning'
     vm.shutdown()
     vm.__setattr__('_vm_object', vm_object_mock)
     vm.shutdown()
@@ -201,6 +461,26 @@ def test_virtual_machine_power_on(wait_for_vcenter_task, connection):
     assert wait_for_vcenter_task.call_count == 1
 
 
+@mock.patch('vcdriver.vm.connection')
+@mock.patch('vcdriver.vm.get_properties')
+@mock.patch('vcdriver.vm.wait_for_vcenter_task')
+def test_virtual_machine_power_on_admission(
+        wait_for_vcenter_task, get_properties, connection
+):
+    get_properties.return_value = [{'runtime.host': 'host-1'}]
+    controller = AdmissionController({'power': 1}, host_limit=1)
+    set_controller(controller)
+    try:
+        vm = VirtualMachine()
+        vm.__setattr__('_vm_object', mock.MagicMock())
+        vm.power_on()
+    finally:
+        set_controller(None)
+    assert get_properties.call_args[0][3] == ['runtime.host', 'datastore']
+    assert wait_for_vcenter_task.call_count == 1
+    assert controller.metrics()['admitted'] == 1
+
+
 @mock.patch('vcdriver.vm.connection')
 @mock.patch('vcdriver.vm.wait_for_vcenter_task')
 def test_virtual_machine_power_on_wrong_power_state(
@@ -251,7 +531,7 @@ def test_virtual_machine_reset_wrong_power_state(
 def test_virtual_machine_ip(connection):
     vm = VirtualMachine()
     vm_object_mock = mock.MagicMock()
-    vm_object_mock.summary.guest.ipAddress = '127.0.0.1'
+    vm_object_mock.guest.ipAddress = '127.0.0.1'
     assert vm.ip() is None
     vm.__setattr__('_vm_object', vm_object_mock)
     assert vm.ip() == '127.0.0.1'
@@ -259,29 +539,51 @@ def test_virtual_machine_ip(connection):
 
 
 @mock.patch('vcdriver.vm.connection')
-@mock.patch('vcdriver.vm.timeout_loop')
-@mock.patch('vcdriver.vm.validate_ip')
-def test_virtual_machine_ip_with_dhcp_wait(
-        validate_ip, timeout_loop, connection
-):
+@mock.patch('vcdriver.vm.wait_for_properties')
+def test_virtual_machine_ip_with_dhcp_wait(wait_for_properties, connection):
     vm = VirtualMachine()
-    validate_ip.side_effect = lambda x: x
     vm_object_mock = mock.MagicMock()
-    vm_object_mock.summary.guest.ipAddress = None
+    vm_object_mock.guest.ipAddress = None
     vm.__setattr__('_vm_object', vm_object_mock)
-    assert vm.ip() is None
+    wait_for_properties.return_value = [{'guest.ipAddress': '127.0.0.1'}]
+    assert vm.ip() == '127.0.0.1'
+    args = wait_for_properties.call_args[0]
+    assert args[1:4] == (
+        [vm_object_mock], vim.VirtualMachine, ['guest.ipAddress']
+    )
+    assert args[4]({'guest.ipAddress': '127.0.0.1'})
+    assert not args[4]({})
 
 
 @mock.patch('vcdriver.vm.connection')
-def test_virtual_machine_ip_timeout(connection):
+@mock.patch('vcdriver.vm.wait_for_properties')
+def test_virtual_machine_ip_timeout(wait_for_properties, connection):
     vm = VirtualMachine(timeout=1)
     vm_object_mock = mock.MagicMock()
-    vm_object_mock.summary.guest.ipAddress = None
+    vm_object_mock.guest.ipAddress = None
     vm.__setattr__('_vm_object', vm_object_mock)
+    wait_for_properties.side_effect = TimeoutError('Get IP', 1)
     with pytest.raises(TimeoutError):
         vm.ip()
 
 
+@mock.patch('vcdriver.vm.connection')
+@mock.patch('vcdriver.vm.wait_for_properties')
+def test_virtual_machine_wait_for_vmware_tools(
+        wait_for_properties, connection
+):
+    vm = VirtualMachine()
+    vm_object_mock = mock.MagicMock()
+    vm_object_mock.runtime.powerState = 'poweredOn'
+    vm_object_mock.guest.toolsRunningStatus = 'guestToolsNotRunning'
+    vm.__setattr__('_vm_object', vm_object_mock)
+    vm.reboot()
+    condition = wait_for_properties.call_args[0][4]
+    assert condition({'guest.toolsRunningStatus': 'guestToolsRunning'})
+    assert not condition({})
+    assert vm_object_mock.RebootGuest.call_count == 1
+
+
 @mock.patch('vcdriver.vm.connection')
 @mock.patch('vcdriver.vm.sudo')
 @mock.patch('vcdriver.vm.run')
@@ -293,7 +595,7 @@ def test_virtual_machine_ssh_success(helpers_run, vm_run, sudo, connection):
     vm = VirtualMachine()
     assert vm.ssh('whatever') is None
     vm_object_mock = mock.MagicMock()
-    vm_object_mock.summary.guest.ipAddress = '127.0.0.1'
+    vm_object_mock.guest.ipAddress = '127.0.0.1'
     vm.__setattr__('_vm_object', vm_object_mock)
     result_mock = mock.MagicMock()
     result_mock.return_code = 3
@@ -316,12 +618,28 @@ def test_virtual_machine_ssh_fail(sudo, helpers_run, vm_run, connection):
     load()
     vm = VirtualMachine()
     vm_object_mock = mock.MagicMock()
-    vm_object_mock.summary.guest.ipAddress = 'fe80::250:56ff:febf:1a0a'
+    vm_object_mock.guest.ipAddress = 'fe80::250:56ff:febf:1a0a'
     vm.__setattr__('_vm_object', vm_object_mock)
     with pytest.raises(SshError):
         vm.ssh('whatever', use_sudo=True)
 
 
+@mock.patch('vcdriver.vm.connection')
+@mock.patch('vcdriver.vm.run')
+def test_virtual_machine_ssh_expired_deadline(vm_run, connection):
+    os.environ['vcdriver_vm_ssh_username'] = 'user'
+    os.environ['vcdriver_vm_ssh_password'] = 'pass'
+    load()
+    vm = VirtualMachine()
+    vm._vm_object = mock.MagicMock()
+    vm._vm_object.guest.ipAddress = '127.0.0.1'
+    with mock.patch.object(vm, '_wait_for_ssh_service'):
+        with deadline(0):
+            with pytest.raises(TimeoutError):
+                vm.ssh('whatever')
+    assert not vm_run.called
+
+
 @mock.patch('vcdriver.vm.connection')
 @mock.patch('vcdriver.vm.run')
 @mock.patch('vcdriver.helpers.run')
@@ -331,7 +649,7 @@ def test_virtual_machine_ssh_timeout(helpers_run, vm_run, connection):
     load()
     vm = VirtualMachine(timeout=1)
     vm_object_mock = mock.MagicMock()
-    vm_object_mock.summary.guest.ipAddress = '127.0.0.1'
+    vm_object_mock.guest.ipAddress = '127.0.0.1'
     vm.__setattr__('_vm_object', vm_object_mock)
     helpers_run.side_effect = Exception
     vm_run.side_effect = Exception
@@ -352,7 +670,7 @@ def test_virtual_machine_ssh_upload_success(
     vm = VirtualMachine()
     assert vm.ssh_upload('from', 'to') is None
     vm_object_mock = mock.MagicMock()
-    vm_object_mock.summary.guest.ipAddress = '127.0.0.1'
+    vm_object_mock.guest.ipAddress = '127.0.0.1'
     vm.__setattr__('_vm_object', vm_object_mock)
     result_mock = mock.MagicMock()
     result_mock.failed = False
@@ -371,7 +689,7 @@ def test_virtual_machine_ssh_upload_fail(helpers_run, vm_run, put, connection):
     load()
     vm = VirtualMachine()
     vm_object_mock = mock.MagicMock()
-    vm_object_mock.summary.guest.ipAddress = '127.0.0.1'
+    vm_object_mock.guest.ipAddress = '127.0.0.1'
     vm.__setattr__('_vm_object', vm_object_mock)
     with pytest.raises(UploadError):
         vm.ssh_upload('from', 'to')
@@ -390,7 +708,7 @@ def test_virtual_machine_ssh_download_success(
     vm = VirtualMachine()
     assert vm.ssh_download('from', 'to') is None
     vm_object_mock = mock.MagicMock()
-    vm_object_mock.summary.guest.ipAddress = '127.0.0.1'
+    vm_object_mock.guest.ipAddress = '127.0.0.1'
     vm.__setattr__('_vm_object', vm_object_mock)
     result_mock = mock.MagicMock()
     result_mock.failed = False
@@ -409,7 +727,7 @@ def test_virtual_machine_ssh_download_fail(helpers_run, vm_run, get, session):
     load()
     vm = VirtualMachine()
     vm_object_mock = mock.MagicMock()
-    vm_object_mock.summary.guest.ipAddress = '127.0.0.1'
+    vm_object_mock.guest.ipAddress = '127.0.0.1'
     vm.__setattr__('_vm_object', vm_object_mock)
     with pytest.raises(DownloadError):
         vm.ssh_download('from', 'to')
@@ -424,13 +742,13 @@ def test_virtual_machine_winrm_success(run_ps, connection):
     vm = VirtualMachine()
     assert vm.winrm('whatever', dict()) is None
     vm_object_mock = mock.MagicMock()
-    vm_object_mock.summary.guest.ipAddress = '127.0.0.1'
+    vm_object_mock.guest.ipAddress = '127.0.0.1'
     vm.__setattr__('_vm_object', vm_object_mock)
     run_ps.return_value.status_code = 0
     vm.winrm('script', dict())
     vm.winrm('script', dict(), quiet=True)
     run_ps.assert_called_with('script')
-    assert run_ps.call_count == 4
+    assert run_ps.call_count == 2
 
 
 @mock.patch('vcdriver.vm.connection')
@@ -441,7 +759,7 @@ def test_virtual_machine_winrm_fail(run_ps, connection):
     load()
     vm = VirtualMachine()
     vm_object_mock = mock.MagicMock()
-    vm_object_mock.summary.guest.ipAddress = '127.0.0.1'
+    vm_object_mock.guest.ipAddress = '127.0.0.1'
     vm.__setattr__('_vm_object', vm_object_mock)
     run_ps.return_value.status_code = 1
     with pytest.raises(WinRmError):
@@ -452,17 +770,20 @@ def test_virtual_machine_winrm_fail(run_ps, connection):
 
 @mock.patch('vcdriver.vm.connection')
 @mock.patch.object(winrm.Session, 'run_ps')
-def test_virtual_machine_winrm_timeout(run_ps, connection):
+def test_virtual_machine_winrm_timeout(
+        run_ps, connection, service_probes
+):
     os.environ['vcdriver_vm_winrm_username'] = 'user'
     os.environ['vcdriver_vm_winrm_password'] = 'pass'
     load()
     vm = VirtualMachine(timeout=1)
     vm_object_mock = mock.MagicMock()
-    vm_object_mock.summary.guest.ipAddress = '127.0.0.1'
+    vm_object_mock.guest.ipAddress = '127.0.0.1'
     vm.__setattr__('_vm_object', vm_object_mock)
-    run_ps.side_effect = Exception
+    service_probes[1].side_effect = Exception
     with pytest.raises(TimeoutError):
         vm.winrm('script', dict())
+    assert run_ps.call_count == 0
 
 
 @mock.patch('vcdriver.vm.os.stat')
@@ -474,6 +795,7 @@ def test_virtual_machine_winrm_upload_success(
 ):
     st_size_mock = mock.Mock()
     st_size_mock.st_size = 3
+    st_size_mock.st_mode = stat.S_IFREG
     os_stat.return_value = st_size_mock
     code_mock = mock.Mock()
     code_mock.status_code = 0
@@ -488,7 +810,7 @@ def test_virtual_machine_winrm_upload_success(
     vm = VirtualMachine()
     assert vm.winrm_upload('whatever', 'whatever') is None
     vm_object_mock = mock.MagicMock()
-    vm_object_mock.summary.guest.ipAddress = '127.0.0.1'
+    vm_object_mock.guest.ipAddress = '127.0.0.1'
     vm.__setattr__('_vm_object', vm_object_mock)
     assert vm.winrm_upload('whatever', 'whatever', step=2) is None
     assert vm.winrm_upload('whatever', 'whatever', step=2, quiet=True) is None
@@ -501,6 +823,7 @@ def test_virtual_machine_winrm_upload_success(
 def test_virtual_machine_winrm_upload_fail(run_ps, connection, open, os_stat):
     st_size_mock = mock.Mock()
     st_size_mock.st_size = 3
+    st_size_mock.st_mode = stat.S_IFREG
     os_stat.return_value = st_size_mock
     code_mock = mock.Mock()
     code_mock.status_code = 1
@@ -515,7 +838,7 @@ def test_virtual_machine_winrm_upload_fail(run_ps, connection, open, os_stat):
     load()
     vm = VirtualMachine()
     vm_object_mock = mock.MagicMock()
-    vm_object_mock.summary.guest.ipAddress = '127.0.0.1'
+    vm_object_mock.guest.ipAddress = '127.0.0.1'
     vm.__setattr__('_vm_object', vm_object_mock)
     with pytest.raises(WinRmError):
         vm.winrm_upload('whatever', 'whatever', step=2)
@@ -530,6 +853,7 @@ def test_virtual_machine_winrm_upload_timeout(
 ):
     st_size_mock = mock.Mock()
     st_size_mock.st_size = 3
+    st_size_mock.st_mode = stat.S_IFREG
     os_stat.return_value = st_size_mock
     code_mock = mock.Mock()
     code_mock.status_code = 1
@@ -544,50 +868,527 @@ def test_virtual_machine_winrm_upload_timeout(
     load()
     vm = VirtualMachine()
     vm_object_mock = mock.MagicMock()
-    vm_object_mock.summary.guest.ipAddress = '127.0.0.1'
+    vm_object_mock.guest.ipAddress = '127.0.0.1'
     vm.__setattr__('_vm_object', vm_object_mock)
     vm.timeout = 1
     with pytest.raises(TimeoutError):
         vm.winrm_upload('whatever', 'whatever', step=2)
 
 
+@mock.patch('vcdriver.vm.connection')
+@mock.patch('vcdriver.vm.put')
+@mock.patch('vcdriver.vm.sudo')
+@mock.patch('vcdriver.vm.run')
+@mock.patch('vcdriver.helpers.run')
+def test_virtual_machine_ssh_sync(
+        helpers_run, vm_run, sudo, put, connection, tmpdir
+):
+    tmpdir.join('same').write(b'abc', mode='wb')
+    tmpdir.mkdir('dir').join('changed').write(b'abc', mode='wb')
+    for path in (tmpdir.join('same'), tmpdir.join('dir', 'changed')):
+        os.utime(str(path), (1530000000, 1530000000))
+    os.environ['vcdriver_vm_ssh_username'] = 'user'
+    os.environ['vcdriver_vm_ssh_password'] = 'pass'
+    load()
+    vm = VirtualMachine()
+    assert vm.ssh_sync('/remote', str(tmpdir)) is None
+    vm_object_mock = mock.MagicMock()
+    vm_object_mock.guest.ipAddress = '127.0.0.1'
+    vm.__setattr__('_vm_object', vm_object_mock)
+    listing = mock.MagicMock(failed=False)
+    listing.__str__.return_value = (
+        '900150983cd24fb0d6963f7d28e17f72\tsame\n'
+        '00000000000000000000000000000000\tdir/changed\n'
+        '900150983cd24fb0d6963f7d28e17f72\tstale\n'
+    )
+    listing.splitlines.return_value = str(listing).splitlines()
+    ok = mock.MagicMock(failed=False)
+    vm_run.side_effect = [listing, ok, ok]
+    put.return_value = ok
+    assert vm.ssh_sync('/remote', str(tmpdir), delete=True) == {
+        'uploaded': ['dir/changed'], 'deleted': ['stale']
+    }
+    put.assert_called_once_with(
+        os.path.join(str(tmpdir), 'dir', 'changed'), '/remote/dir/changed',
+        use_sudo=False
+    )
+    assert vm_run.call_args_list[1][0][0] == 'mkdir -p /remote/dir'
+    assert vm_run.call_args_list[2][0][0] == 'rm -f /remote/stale'
+    empty = mock.MagicMock(failed=False)
+    empty.splitlines.return_value = []
+    sudo.side_effect = [empty, ok, ok]
+    assert vm.ssh_sync(
+        '/remote', str(tmpdir), use_sudo=True, checksum=False, quiet=True
+    ) == {'uploaded': ['dir/changed', 'same'], 'deleted': []}
+    assert 'printf' in sudo.call_args_list[0][0][0]
+    assert sudo.call_args_list[2][0][0] == (
+        'touch -c -m -d @1530000000 /remote/dir/changed && '
+        'touch -c -m -d @1530000000 /remote/same'
+    )
+    listing.splitlines.return_value = [
+        '3-1530000000\tsame', '3-1530000001\tdir/changed'
+    ]
+    sudo.side_effect = [listing, ok, ok]
+    put.reset_mock()
+    assert vm.ssh_sync(
+        '/remote', str(tmpdir), use_sudo=True, checksum=False
+    ) == {'uploaded': ['dir/changed'], 'deleted': []}
+    assert put.call_count == 1
+    vm_run.side_effect = [listing]
+    listing.splitlines.return_value = [
+        '900150983cd24fb0d6963f7d28e17f72\tsame',
+        '900150983cd24fb0d6963f7d28e17f72\tdir/changed'
+    ]
+    assert vm.ssh_sync('/remote', str(tmpdir)) == {
+        'uploaded': [], 'deleted': []
+    }
+    put.return_value = mock.MagicMock(failed=True)
+    sudo.side_effect = [empty, ok]
+    with pytest.raises(UploadError):
+        vm.ssh_sync('/remote', str(tmpdir), use_sudo=True)
+    sudo.side_effect = [mock.MagicMock(failed=True)]
+    with pytest.raises(SshError):
+        vm.ssh_sync('/remote', str(tmpdir), use_sudo=True)
+
+
+@mock.patch('vcdriver.vm.connection')
+@mock.patch.object(VirtualMachine, '_winrm_upload_archive')
+@mock.patch.object(winrm.Session, 'run_ps')
+def test_virtual_machine_winrm_sync(
+        run_ps, winrm_upload_archive, connection, tmpdir
+):
+    tmpdir.join('same').write(b'abc', mode='wb')
+    tmpdir.mkdir('dir').join('changed').write(b'abc', mode='wb')
+    for path in (tmpdir.join('same'), tmpdir.join('dir', 'changed')):
+        os.utime(str(path), (1530000000, 1530000000))
+    os.environ['vcdriver_vm_winrm_username'] = 'user'
+    os.environ['vcdriver_vm_winrm_password'] = 'pass'
+    load()
+    vm = VirtualMachine()
+    assert vm.winrm_sync('C:\\remote', str(tmpdir)) is None
+    vm_object_mock = mock.MagicMock()
+    vm_object_mock.guest.ipAddress = '127.0.0.1'
+    vm.__setattr__('_vm_object', vm_object_mock)
+
+    def result(status_code, std_out=b''):
+        return mock.Mock(status_code=status_code, std_out=std_out, std_err=b'')
+
+    run_ps.side_effect = [
+        result(0, b'900150983CD24FB0D6963F7D28E17F72\tsame\r\n'
+                  b'3\tdir\\changed\r\n'
+                  b'3\tstale\r\n'),
+        result(0)
+    ]
+    assert vm.winrm_sync('C:\\remote', str(tmpdir), delete=True) == {
+        'uploaded': ['dir/changed'], 'deleted': ['stale']
+    }
+    winrm_upload_archive.assert_called_once_with(
+        'C:\\remote', str(tmpdir), ['dir/changed'], 1024, {}, False,
+        vcdriver_vm_winrm_username='user', vcdriver_vm_winrm_password='pass'
+    )
+    assert run_ps.call_args_list[1][0][0] == (
+        "Remove-Item -force -literalPath 'C:\\remote\\stale'"
+    )
+    run_ps.side_effect = [result(
+        0, b'3-1530000000\tsame\r\n3-1530000000\tdir\\changed\r\n'
+    )]
+    assert vm.winrm_sync('C:\\remote', str(tmpdir), checksum=False) == {
+        'uploaded': [], 'deleted': []
+    }
+    assert winrm_upload_archive.call_count == 1
+    run_ps.side_effect = [
+        result(0, u'3-1530000000\tsame\r\n3-1\tdir\\changed\r\n'
+                  u'3-1\t\u00e9t\u00e9\r\n'.encode('utf-8')),
+        result(0)
+    ]
+    assert vm.winrm_sync('C:\\remote', str(tmpdir), checksum=False) == {
+        'uploaded': ['dir/changed'], 'deleted': []
+    }
+    assert run_ps.call_args_list[-1][0][0] == (
+        "(Get-Item -literalPath 'C:\\remote\\dir\\changed')"
+        '.LastWriteTimeUtc = ([datetime]"1970-01-01").AddSeconds(1530000000)'
+    )
+    run_ps.side_effect = [result(1)]
+    with pytest.raises(WinRmError):
+        vm.winrm_sync('C:\\remote', str(tmpdir))
+
+
+@mock.patch('vcdriver.vm.connection')
+@mock.patch.object(VirtualMachine, '_winrm_upload_archive')
+@mock.patch.object(winrm.Session, 'run_ps')
+def test_virtual_machine_winrm_sync_batches(
+        run_ps, winrm_upload_archive, connection, tmpdir
+):
+    directory = tmpdir.mkdir('a directory with a long name')
+    for i in range(300):
+        directory.join('file-{}.txt'.format(i)).write(b'abc', mode='wb')
+    os.environ['vcdriver_vm_winrm_username'] = 'user'
+    os.environ['vcdriver_vm_winrm_password'] = 'pass'
+    load()
+    vm = VirtualMachine()
+    vm_object_mock = mock.MagicMock()
+    vm_object_mock.guest.ipAddress = '127.0.0.1'
+    vm.__setattr__('_vm_object', vm_object_mock)
+    listing = ''.join(
+        '3-1\ta directory with a long name\\stale-{}.txt\r\n'.format(i)
+        for i in range(300)
+    ).encode('utf-8')
+    run_ps.side_effect = lambda script: mock.Mock(
+        status_code=0,
+        std_out=listing if 'Get-ChildItem' in script else b'',
+        std_err=b''
+    )
+    remote_path = 'C:\\Program Files\\vcdriver\\remote'
+    result = vm.winrm_sync(remote_path, str(tmpdir), False, True)
+    assert len(result['uploaded']) == len(result['deleted']) == 300
+    scripts = [call[0][0] for call in run_ps.call_args_list[1:]]
+    assert len(scripts) > 2
+    for script in scripts:
+        assert len('powershell -encodedcommand ') + len(
+            base64.b64encode(script.encode('utf_16_le'))
+        ) <= 8191
+    assert sum(script.count('LastWriteTimeUtc') for script in scripts) == 300
+    assert sum(script.count('stale-') for script in scripts) == 300
+
+
+@mock.patch('vcdriver.vm.connection')
+@mock.patch.object(winrm.Session, 'run_ps')
+def test_virtual_machine_winrm_upload_directory(run_ps, connection, tmpdir):
+    tmpdir.join('file-0').write(b'abc', mode='wb')
+    tmpdir.mkdir('dir-0').join('file-1').write(b'abc', mode='wb')
+    os.environ['vcdriver_vm_winrm_username'] = 'user'
+    os.environ['vcdriver_vm_winrm_password'] = 'pass'
+    load()
+    vm = VirtualMachine()
+    assert vm.winrm_upload('C:\\remote', str(tmpdir)) is None
+    vm_object_mock = mock.MagicMock()
+    vm_object_mock.guest.ipAddress = '127.0.0.1'
+    vm.__setattr__('_vm_object', vm_object_mock)
+    expand_code = [0]
+
+    def run(script):
+        code = expand_code[0] if 'Expand-Archive' in script else 0
+        return mock.Mock(status_code=code, std_out=b'', std_err=b'')
+
+    run_ps.side_effect = run
+    timings = vm.winrm_upload('C:\\remote\\', str(tmpdir), step=4096)
+    assert sorted(timings) == ['expand', 'upload', 'zip']
+    script = run_ps.call_args_list[-1][0][0]
+    assert "-destinationPath 'C:\\remote\\' -force" in script
+    assert "Remove-Item -force -path 'C:\\remote." in script
+    assert sorted(vm.winrm_upload(
+        'C:\\remote', str(tmpdir), quiet=True
+    )) == ['expand', 'upload', 'zip']
+    expand_code[0] = 1
+    with pytest.raises(WinRmError):
+        vm.winrm_upload('C:\\remote', str(tmpdir), quiet=True)
+    expand_code[0] = 0
+    vm.winrm_upload('C:\\', str(tmpdir), quiet=True)
+    script = run_ps.call_args_list[-1][0][0]
+    assert "Remove-Item -force -path 'C:\\vcdriver." in script
+    # A failed upload still removes the remote archive
+    run_ps.reset_mock()
+    with mock.patch.object(
+        VirtualMachine, 'winrm_upload', side_effect=WinRmError('upload', 1)
+    ):
+        with pytest.raises(WinRmError):
+            vm._winrm_upload_archive(
+                'D:\\remote', str(tmpdir), ['file-0'], 1024, {}, True,
+                vcdriver_vm_winrm_username='user',
+                vcdriver_vm_winrm_password='pass'
+            )
+    assert run_ps.call_args[0][0].startswith(
+        "Remove-Item -force -errorAction SilentlyContinue -path "
+        "'D:\\remote."
+    )
+    # The cleanup errors do not hide the original one
+    run_ps.side_effect = Exception('connection reset')
+    with pytest.raises(Exception, match='connection reset'):
+        vm.winrm_upload('C:\\remote', str(tmpdir), quiet=True)
+    assert 'SilentlyContinue -path' in run_ps.call_args[0][0]
+
+
+@mock.patch('vcdriver.vm.connection')
+@mock.patch.object(winrm.Session, 'run_ps')
+def test_virtual_machine_winrm_upload_path_with_spaces(
+        run_ps, connection, tmpdir
+):
+    tmpdir.join('file').write(b'abc', mode='wb')
+    os.environ['vcdriver_vm_winrm_username'] = 'user'
+    os.environ['vcdriver_vm_winrm_password'] = 'pass'
+    load()
+    vm = VirtualMachine()
+    vm_object_mock = mock.MagicMock()
+    vm_object_mock.guest.ipAddress = '127.0.0.1'
+    vm.__setattr__('_vm_object', vm_object_mock)
+    run_ps.return_value = mock.Mock(status_code=0, std_out=b'', std_err=b'')
+    vm.winrm_upload(
+        "C:\\Program Files\\app's\\file", str(tmpdir.join('file')),
+        quiet=True
+    )
+    remove, add = [call[0][0] for call in run_ps.call_args_list]
+    assert remove == (
+        "if (Test-Path -literalPath 'C:\\Program Files\\app''s\\file') "
+        "{ Remove-Item -literalPath 'C:\\Program Files\\app''s\\file' }"
+    )
+    assert add.endswith(
+        "-encoding byte -literalPath 'C:\\Program Files\\app''s\\file'"
+    )
+    run_ps.reset_mock()
+    vm.winrm_upload('C:\\Program Files\\app', str(tmpdir), quiet=True)
+    for script in [call[0][0] for call in run_ps.call_args_list]:
+        assert "'C:\\Program Files\\app." in script
+
+
+@mock.patch('vcdriver.vm.connection')
+@mock.patch('vcdriver.vm.guest_file_url')
+@mock.patch('vcdriver.vm.requests')
+def test_virtual_machine_guest_upload(
+        requests, guest_file_url, connection, tmpdir
+):
+    local_file = tmpdir.join('file')
+    local_file.write(b'abc', mode='wb')
+    os.environ['vcdriver_vm_guest_username'] = 'user'
+    os.environ['vcdriver_vm_guest_password'] = 'pass'
+    load()
+    vm = VirtualMachine()
+    assert vm.guest_upload('/remote', str(local_file)) is None
+    vm_object_mock = mock.MagicMock()
+    vm_object_mock.guest.toolsRunningStatus = 'guestToolsRunning'
+    vm.__setattr__('_vm_object', vm_object_mock)
+    file_manager = connection.return_value.content.guestOperationsManager.\
+        fileManager
+    requests.put.return_value.status_code = 200
+    vm.guest_upload('/remote', str(local_file))
+    vm.guest_upload('/remote', str(local_file), quiet=True)
+    assert file_manager.InitiateFileTransferToGuest.call_args[1][
+        'fileSize'] == 3
+    assert requests.put.call_args[0] == (guest_file_url.return_value,)
+    requests.put.return_value.status_code = 500
+    with pytest.raises(UploadError):
+        vm.guest_upload('/remote', str(local_file))
+
+
+@mock.patch('vcdriver.vm.connection')
+@mock.patch('vcdriver.vm.guest_file_url')
+@mock.patch('vcdriver.vm.requests')
+def test_virtual_machine_guest_transfer_expired_deadline(
+        requests, guest_file_url, connection, tmpdir
+):
+    local_file = tmpdir.join('file')
+    local_file.write(b'abc', mode='wb')
+    os.environ['vcdriver_vm_guest_username'] = 'user'
+    os.environ['vcdriver_vm_guest_password'] = 'pass'
+    load()
+    vm = VirtualMachine()
+    vm._vm_object = mock.MagicMock()
+    vm._vm_object.guest.toolsRunningStatus = 'guestToolsRunning'
+    with deadline(0):
+        with pytest.raises(TimeoutError):
+            vm.guest_upload('/remote', str(local_file))
+        with pytest.raises(TimeoutError):
+            vm.guest_download('/remote', str(tmpdir.join('copy')))
+    assert not requests.put.called
+    assert not requests.get.called
+
+
+@mock.patch('vcdriver.vm.connection')
+@mock.patch('vcdriver.vm.guest_file_url')
+@mock.patch('vcdriver.vm.requests')
+def test_virtual_machine_guest_download(
+        requests, guest_file_url, connection, tmpdir
+):
+    local_file = tmpdir.join('file')
+    os.environ['vcdriver_vm_guest_username'] = 'user'
+    os.environ['vcdriver_vm_guest_password'] = 'pass'
+    load()
+    vm = VirtualMachine()
+    assert vm.guest_download('/remote', str(local_file)) is None
+    vm_object_mock = mock.MagicMock()
+    vm_object_mock.guest.toolsRunningStatus = 'guestToolsRunning'
+    vm.__setattr__('_vm_object', vm_object_mock)
+    response = requests.get.return_value
+    response.status_code = 200
+    response.iter_content.return_value = [b'ab', b'c']
+    vm.guest_download('/remote', str(local_file))
+    assert local_file.read(mode='rb') == b'abc'
+    vm.guest_download('/remote', str(local_file), quiet=True)
+    response.status_code = 404
+    with pytest.raises(DownloadError):
+        vm.guest_download('/remote', str(local_file))
+    assert response.close.call_count == 3
+
+
+@mock.patch('vcdriver.vm.connection')
+@mock.patch('vcdriver.vm.guest_file_url')
+@mock.patch('vcdriver.vm.requests')
+def test_virtual_machine_guest_run(requests, guest_file_url, connection):
+    os.environ['vcdriver_vm_guest_username'] = 'user'
+    os.environ['vcdriver_vm_guest_password'] = 'pass'
+    load()
+    vm = VirtualMachine()
+    assert vm.guest_run('whatever') is None
+    vm_object_mock = mock.MagicMock()
+    vm_object_mock.guest.toolsRunningStatus = 'guestToolsRunning'
+    vm_object_mock.config.guestId = 'windows9Server64Guest'
+    vm.__setattr__('_vm_object', vm_object_mock)
+    guest_operations = connection.return_value.content.guestOperationsManager
+    file_manager = guest_operations.fileManager
+    process_manager = guest_operations.processManager
+    file_manager.CreateTemporaryDirectoryInGuest.return_value = 'C:\\tmp'
+    running = mock.Mock(endTime=None)
+    done = mock.Mock(exitCode=0)
+    process_manager.ListProcessesInGuest.side_effect = [[running], [done]]
+    requests.get.return_value.status_code = 200
+    requests.get.return_value.content = b'out'
+    assert vm.guest_run('dir') == (0, 'out', 'out')
+    spec = process_manager.StartProgramInGuest.call_args[1]['spec']
+    assert spec.programPath == 'C:\\Windows\\System32\\cmd.exe'
+    assert spec.arguments == (
+        '/s /c "(dir) > "C:\\tmp\\stdout" 2> "C:\\tmp\\stderr""'
+    )
+    file_manager.DeleteDirectoryInGuest.assert_called_once_with(
+        vm=vm_object_mock, auth=mock.ANY, directoryPath='C:\\tmp',
+        recursive=True
+    )
+    file_manager.CreateTemporaryDirectoryInGuest.return_value = '/tmp/x'
+    process_manager.ListProcessesInGuest.side_effect = None
+    process_manager.ListProcessesInGuest.return_value = [done]
+    assert vm.guest_run('ls', windows=False, quiet=True) == (0, 'out', 'out')
+    spec = process_manager.StartProgramInGuest.call_args[1]['spec']
+    assert spec.programPath == '/bin/sh'
+    assert spec.arguments == "-c '(ls) > /tmp/x/stdout 2> /tmp/x/stderr'"
+    done.exitCode = 2
+    with pytest.raises(GuestError):
+        vm.guest_run('ls', windows=False)
+    with pytest.raises(GuestError):
+        vm.guest_run('ls', windows=False, quiet=True)
+    # An empty process list or a login failure stop the wait at once
+    process_manager.ListProcessesInGuest.return_value = []
+    with pytest.raises(GuestError):
+        vm.guest_run('ls', windows=False)
+    process_manager.ListProcessesInGuest.side_effect = (
+        vim.fault.InvalidGuestLogin()
+    )
+    with pytest.raises(vim.fault.InvalidGuestLogin):
+        vm.guest_run('ls', windows=False)
+    process_manager.ListProcessesInGuest.side_effect = None
+    process_manager.ListProcessesInGuest.return_value = [done]
+    # A missing guest id is guessed as linux
+    done.exitCode = 0
+    vm_object_mock.config.guestId = None
+    assert vm.guest_run('ls', quiet=True) == (0, 'out', 'out')
+    spec = process_manager.StartProgramInGuest.call_args[1]['spec']
+    assert spec.programPath == '/bin/sh'
+    requests.get.return_value.status_code = 500
+    with pytest.raises(DownloadError):
+        vm.guest_run('ls', windows=False)
+    assert file_manager.DeleteDirectoryInGuest.call_count == 8
+
+
+def snapshot_tree(name, snapshot_id, children=()):
+    tree = mock.MagicMock()
+    tree.name = name
+    tree.id = snapshot_id
+    tree.childSnapshotList = list(children)
+    return tree
+
+
+@mock.patch('vcdriver.vm.connection')
+@mock.patch('vcdriver.vm.get_properties')
 @mock.patch('vcdriver.vm.wait_for_vcenter_task')
-def test_virtual_machine_find_snapshot(wait_for_vcenter_task):
-    fake_snapshots = [mock.MagicMock(), mock.MagicMock(), mock.MagicMock()]
-    for fake_snapshot in fake_snapshots[:-1]:
-        fake_snapshot.name = 'snapshot'
-        fake_snapshot.childSnapshotList = []
-    fake_snapshots[-1].name = 'other'
-    fake_snapshots[-1].childSnapshotList = []
+def test_virtual_machine_find_snapshot(
+        wait_for_vcenter_task, get_properties, connection
+):
+    fake_snapshots = [
+        snapshot_tree('snapshot', 1),
+        snapshot_tree('snapshot', 2),
+        snapshot_tree('other', 3)
+    ]
     vm = VirtualMachine()
     assert vm.find_snapshot('snapshot') is None
     vm_object_mock = mock.MagicMock()
     vm.__setattr__('_vm_object', vm_object_mock)
-    vm_object_mock.snapshot.rootSnapshotList = []
+    get_properties.return_value = [
+        {'snapshot.rootSnapshotList': []}
+    ]
     with pytest.raises(NoObjectFound):
         vm.find_snapshot('snapshot')
-    vm_object_mock.snapshot.rootSnapshotList = fake_snapshots[:-2]
+    get_properties.assert_called_once_with(
+        connection.return_value, [vm_object_mock], vim.VirtualMachine,
+        ['snapshot.rootSnapshotList']
+    )
+    vm.__setattr__('_snapshots', None)
+    get_properties.return_value = [
+        {'snapshot.rootSnapshotList': fake_snapshots[:-2]}
+    ]
     vm.find_snapshot('snapshot')
-    vm_object_mock.snapshot.rootSnapshotList = fake_snapshots
+    vm.__setattr__('_snapshots', None)
+    get_properties.return_value = [
+        {'snapshot.rootSnapshotList': [fake_snapshots[0]]}
+    ]
+    fake_snapshots[0].childSnapshotList = fake_snapshots[1:]
     with pytest.raises(TooManyObjectsFound):
         vm.find_snapshot('snapshot')
-    vm_object_mock.snapshot = None
+    assert vm.find_snapshot('other') == fake_snapshots[2].snapshot
+    assert get_properties.call_count == 3
+    vm.__setattr__('_snapshots', None)
+    get_properties.return_value = [{}]
     with pytest.raises(NoObjectFound):
         vm.find_snapshot('snapshot')
 
 
+@mock.patch('vcdriver.vm.connection')
+@mock.patch('vcdriver.vm.get_properties')
+def test_virtual_machine_find_snapshot_by_id(get_properties, connection):
+    child = snapshot_tree('child', 2)
+    get_properties.return_value = [{
+        'snapshot.rootSnapshotList': [snapshot_tree('root', 1, [child])]
+    }]
+    vm = VirtualMachine()
+    assert vm.find_snapshot_by_id(2) is None
+    vm.__setattr__('_vm_object', mock.MagicMock())
+    assert vm.find_snapshot_by_id(2) == child.snapshot
+    with pytest.raises(NoObjectFound):
+        vm.find_snapshot_by_id(3)
+    assert get_properties.call_count == 1
+
+
+@mock.patch('vcdriver.vm.connection')
+@mock.patch('vcdriver.vm.get_properties')
+def test_virtual_machine_find_snapshot_deep_tree(get_properties, connection):
+    # Deeper than the recursion limit, and a crude benchmark of the indexing
+    depth = sys.getrecursionlimit() * 5
+    tree = snapshot_tree('leaf', depth)
+    for snapshot_id in range(depth - 1, 0, -1):
+        tree = snapshot_tree(str(snapshot_id), snapshot_id, [tree])
+    get_properties.return_value = [{'snapshot.rootSnapshotList': [tree]}]
+    vm = VirtualMachine()
+    vm.__setattr__('_vm_object', mock.MagicMock())
+    start = time.time()
+    for _ in range(100):
+        vm.find_snapshot('leaf')
+    vm.find_snapshot_by_id(1)
+    assert time.time() - start < 10
+    assert get_properties.call_count == 1
+
+
+@mock.patch('vcdriver.vm.connection')
+@mock.patch('vcdriver.vm.get_properties')
 @mock.patch('vcdriver.vm.wait_for_vcenter_task')
-def test_virtual_machine_create_snapshot(wait_for_vcenter_task):
-    fake_snapshot = mock.MagicMock()
-    fake_snapshot.name = 'snapshot'
-    fake_snapshot.childSnapshotList = []
+def test_virtual_machine_create_snapshot(
+        wait_for_vcenter_task, get_properties, connection
+):
+    get_properties.return_value = [{'snapshot.rootSnapshotList': []}]
     vm = VirtualMachine()
     assert vm.create_snapshot('snapshot', True) is None
     vm_object_mock = mock.MagicMock()
-    vm_object_mock.snapshot.rootSnapshotList = []
     vm.__setattr__('_vm_object', vm_object_mock)
     vm.create_snapshot('snapshot', True)
-    vm_object_mock.snapshot.rootSnapshotList = [fake_snapshot]
+    assert vm.__getattribute__('_snapshots') is None
+    get_properties.return_value = [
+        {'snapshot.rootSnapshotList': [snapshot_tree('snapshot', 1)]}
+    ]
     with pytest.raises(TooManyObjectsFound):
         vm.create_snapshot('snapshot', True)
 
@@ -607,9 +1408,12 @@ def test_virtual_machine_remove_snapshot(wait_for_vcenter_task):
     assert vm.remove_snapshot('snapshot') is None
     vm.find_snapshot = mock.MagicMock()
     vm.__setattr__('_vm_object', mock.MagicMock())
+    vm.__setattr__('_snapshots', ({}, {}))
     vm.remove_snapshot('snapshot')
+    assert vm.__getattribute__('_snapshots') is None
 
 
+@mock.patch('vcdriver.vm.connection', mock.MagicMock())
 @mock.patch('vcdriver.vm.vim.host.AutoStartManager.AutoPowerInfo')
 def test_set_autostart(init):
     vm = VirtualMachine()
@@ -623,11 +1427,96 @@ def test_virtual_machine_summary(connection):
     print(VirtualMachine().summary())
 
 
+@mock.patch('vcdriver.vm.connection')
+def test_virtual_machine_state(connection, vm_properties):
+    assert VirtualMachine().state() is None
+    vm = VirtualMachine()
+    vm.__setattr__('_vm_object', mock.MagicMock())
+    vm_properties.side_effect = None
+    vm_properties.return_value = [{'runtime.powerState': 'poweredOn'}]
+    state = vm.state(['runtime.powerState', 'guest.ipAddress'])
+    vm_properties.assert_called_once_with(
+        connection.return_value,
+        [vm._vm_object],
+        vim.VirtualMachine,
+        ['runtime.powerState', 'guest.ipAddress']
+    )
+    assert dict(state) == {'runtime.powerState': 'poweredOn'}
+    assert state.get('guest.ipAddress') is None
+    assert len(state) == 1
+    assert str(state) == repr(state) == "{'runtime.powerState': 'poweredOn'}"
+    with pytest.raises(TypeError):
+        state['runtime.powerState'] = 'poweredOff'
+    vm.state()
+    assert vm_properties.call_args[0][3] == STATE_PROPERTIES
+
+
 def test_str_repr():
     assert str(VirtualMachine(name='whatever')) == 'whatever'
     assert repr(VirtualMachine(name='whatever')) == 'whatever'
 
 
+@mock.patch('vcdriver.vm.connection')
+@mock.patch('vcdriver.vm.get_vcenter_object_by_name')
+@mock.patch('vcdriver.vm.wait_for_vcenter_task')
+@mock.patch.object(VirtualMachine, '_snapshot_index')
+@mock.patch.object(VirtualMachine, 'find')
+@mock.patch.object(VirtualMachine, 'create')
+@mock.patch.object(VirtualMachine, 'destroy')
+@mock.patch.object(VirtualMachine, 'power_on')
+@mock.patch.object(VirtualMachine, 'power_off')
+@mock.patch.object(VirtualMachine, 'create_snapshot')
+def test_virtual_machine_reuse(
+        create_snapshot,
+        power_off,
+        power_on,
+        destroy,
+        create,
+        find,
+        snapshot_index,
+        wait_for_vcenter_task,
+        get_vcenter_object_by_name,
+        connection
+):
+    template_config = get_vcenter_object_by_name.return_value.config
+    template_config.instanceUuid = 'uuid'
+    template_config.changeVersion = '1'
+    fingerprint = 'Template "template" uuid 1'
+    baseline = mock.MagicMock(description=fingerprint)
+    snapshot_index.return_value = ({'vcdriver-baseline': [baseline]}, {})
+    vm = VirtualMachine(template='template')
+    find.side_effect = NoObjectFound(vim.VirtualMachine, vm.name)
+    assert vm.reuse(vcdriver_folder='folder') is False
+    create.assert_called_once_with(vcdriver_folder='folder')
+    create_snapshot.assert_called_once_with(
+        'vcdriver-baseline', False, fingerprint
+    )
+    assert power_off.call_count == 1 and power_on.call_count == 1
+    find.side_effect = lambda: vm.__setattr__('_vm_object', mock.MagicMock())
+    assert vm.reuse() is True
+    wait_for_vcenter_task.assert_called_once_with(
+        baseline.snapshot.RevertToSnapshot_Task.return_value,
+        mock.ANY,
+        vm.timeout
+    )
+    assert power_on.call_count == 2 and destroy.call_count == 0
+    template_config.changeVersion = '2'
+    assert vm.reuse() is False
+    assert destroy.call_count == 1 and create.call_count == 2
+    assert find.call_count == 2
+
+
+@mock.patch('vcdriver.vm.connection')
+@mock.patch.object(VirtualMachine, 'reuse')
+@mock.patch.object(VirtualMachine, 'destroy')
+def test_virtual_machines_reuse(destroy, reuse, connection):
+    vm = VirtualMachine()
+    with virtual_machines([vm], reuse=True):
+        pass
+    reuse.assert_called_once_with()
+    assert destroy.call_count == 0
+
+
 @mock.patch('vcdriver.vm.connection')
 @mock.patch.object(VirtualMachine, 'create')
 @mock.patch.object(VirtualMachine, 'destroy')
@@ -676,13 +1565,95 @@ def test_snapshot_fail(remove, revert, create):
     remove.assert_called_once()
 
 
+@mock.patch('vcdriver.vm.connection', mock.MagicMock())
+@mock.patch.object(VirtualMachine, 'find_snapshot')
+@mock.patch.object(VirtualMachine, 'create_snapshot')
+@mock.patch.object(VirtualMachine, 'revert_snapshot')
+@mock.patch.object(VirtualMachine, 'remove_snapshot')
+@mock.patch.object(VirtualMachine, 'power_on')
+def test_snapshot_strategies(power_on, remove, revert, create, find):
+    vm = VirtualMachine()
+    vm.__setattr__('_vm_object', mock.MagicMock())
+    vm._vm_object.runtime.powerState = 'poweredOn'
+    with snapshot(vm, strategy='memory') as timings:
+        pass
+    assert sorted(timings) == ['create', 'remove', 'revert']
+    create.assert_called_with(
+        mock.ANY, dump_memory=True, quiesce=False
+    )
+    assert not power_on.called
+    with snapshot(vm, strategy='quiesced', name='name'):
+        pass
+    create.assert_called_with('name', dump_memory=False, quiesce=True)
+    power_on.assert_called_once_with()
+    vm._vm_object.runtime.powerState = 'poweredOff'
+    with snapshot(vm, strategy='disk'):
+        pass
+    create.assert_called_with(mock.ANY, dump_memory=False, quiesce=False)
+    assert power_on.call_count == 1
+    with pytest.raises(KeyError):
+        with snapshot(vm, strategy='wrong'):
+            pass
+
+
+@mock.patch.object(VirtualMachine, 'find_snapshot')
+@mock.patch.object(VirtualMachine, 'create_snapshot')
+@mock.patch.object(VirtualMachine, 'revert_snapshot')
+@mock.patch.object(VirtualMachine, 'remove_snapshot')
+def test_snapshot_keep(remove, revert, create, find):
+    vm = VirtualMachine()
+    find.side_effect = [NoObjectFound(vim.vm.Snapshot, 'name'), None]
+    with snapshot(vm, strategy='disk', keep=True) as timings:
+        pass
+    assert sorted(timings) == ['create', 'revert']
+    create.assert_called_once_with(
+        'vcdriver-disk', dump_memory=False, quiesce=False
+    )
+    with snapshot(vm, strategy='disk', keep=True) as timings:
+        pass
+    assert sorted(timings) == ['revert']
+    assert create.call_count == 1
+    assert revert.call_count == 2
+    assert not remove.called
+
+
+@mock.patch('vcdriver.vm.connection', mock.MagicMock())
+@mock.patch.object(VirtualMachine, 'revert_snapshot')
+@mock.patch.object(VirtualMachine, 'power_on')
+def test_snapshot_keep_power_state(power_on, revert):
+    vm = VirtualMachine()
+    vm._vm_object = mock.MagicMock()
+    vm._vm_object.runtime.powerState = 'poweredOff'
+    kept = snapshot_tree('vcdriver-disk', 1)
+    kept.state = 'poweredOn'
+    vm._vm_object.snapshot.rootSnapshotList = [kept]
+    # The kept snapshot was taken running, so it is powered on again
+    with snapshot(vm, strategy='disk', keep=True):
+        pass
+    power_on.assert_called_once_with()
+    kept.state = 'poweredOff'
+    vm._vm_object.runtime.powerState = 'poweredOn'
+    vm._snapshots = None
+    with snapshot(vm, strategy='disk', keep=True):
+        pass
+    assert power_on.call_count == 1
+    assert revert.call_count == 2
+
+
 @mock.patch('vcdriver.vm.connection')
-@mock.patch('vcdriver.vm.get_all_vcenter_objects')
-def test_get_all_virtual_machines(get_all_vcenter_objects, connection):
+@mock.patch('vcdriver.vm.get_inventory_properties')
+def test_get_all_virtual_machines(get_inventory_properties, connection):
     obj1 = mock.MagicMock()
     obj2 = mock.MagicMock()
-    get_all_vcenter_objects.return_value = [obj1, obj2]
-    assert len(get_all_virtual_machines()) == 2
+    get_inventory_properties.return_value = [
+        (obj1, {'name': 'vm1'}), (obj2, {'name': 'vm2'})
+    ]
+    vms = get_all_virtual_machines()
+    assert [vm.name for vm in vms] == ['vm1', 'vm2']
+    assert [vm.__getattribute__('_vm_object') for vm in vms] == [obj1, obj2]
+    get_inventory_properties.assert_called_once_with(
+        connection.return_value, [(vim.VirtualMachine, ['name'])]
+    )
 
 
 @mock.patch('vcdriver.vm.connection')
@@ -0,0 +1,265 @@
+import contextlib
+import os
+import threading
+import time
+
+from vcdriver.exceptions import TimeoutError
+from vcdriver.helpers import file_lock, remaining_time
+
+
+# The admission controller of this process, see set_controller
+_controller = None
+
+
+class AdmissionController(object):
+    def __init__(
+            self,
+            operation_limits=None,
+            host_limit=None,
+            data_store_limit=None,
+            lock_dir=None,
+            _poll_interval=0.5
+    ):
+        """
+        Limit the vcenter tasks in flight per operation type, per host and
+        per datastore. The requests over a limit are queued and admitted in
+        arrival order: a queued request holds its place on every resource it
+        needs, so later requests only overtake it on other resources
+        :param operation_limits: A dictionary mapping operation types, like
+        "clone" or "power", to their limit
+        :param host_limit: The limit per host
+        :param data_store_limit: The limit per datastore
+        :param lock_dir: A directory where the limits are shared with the
+        other processes of this machine through lock files, one per slot. By
+        default, the limits only apply to this process
+        """
+        self.operation_limits = dict(operation_limits or {})
+        self.host_limit = host_limit
+        self.data_store_limit = data_store_limit
+        self.lock_dir = lock_dir
+        self._poll_interval = _poll_interval
+        self._condition = threading.Condition()
+        self._queue = []
+        self._in_flight = {}
+        self._admitted = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    @contextlib.contextmanager
+    def admit(self, operation, host=None, data_store=None):
+        """
+        Hold a slot for a vcenter task within a context, waiting in the queue
+        if a limit is reached. The wait honours the current deadline, see
+        vcdriver.helpers.deadline
+        :param operation: The operation type, like "clone"
+        :param host: The host the task runs on, if known
+        :param data_store: The datastore the task writes to, if known
+
+        :raise: TimeoutError: If the deadline is reached while queued
+        """
+        limits = self._limits(operation, host, data_store)
+        # A unique token, so requests with the same limits are not equal
+        ticket = (object(), limits)
+        description = 'Admission of "{}"'.format(operation)
+        start = time.time()
+        with self._condition:
+            self._queue.append(ticket)
+            try:
+                while not self._admissible(ticket):
+                    left = remaining_time()
+                    if left == 0:
+                        raise TimeoutError(description, time.time() - start)
+                    self._condition.wait(left)
+            finally:
+                self._queue.remove(ticket)
+                self._condition.notify_all()
+            for key in limits:
+                self._in_flight[key] = self._in_flight.get(key, 0) + 1
+        try:
+            slots = self._lock_slots(limits, description, start)
+            try:
+                waited = time.time() - start
+                with self._condition:
+                    self._admitted += 1
+                    self._wait_total += waited
+                    self._wait_max = max(self._wait_max, waited)
+                yield
+            finally:
+                for slot in reversed(slots):
+                    slot.__exit__(None, None, None)
+        finally:
+            with self._condition:
+                for key in limits:
+                    self._in_flight[key] -= 1
+                    if not self._in_flight[key]:
+                        del self._in_flight[key]
+                self._condition.notify_all()
+
+    def metrics(self):
+        """
+        Get the admission metrics
+
+        :return: A dictionary with the number of queued requests
+        (queue_depth), the tasks in flight per limited resource (in_flight),
+        the number of admitted requests (admitted) and their total and
+        maximum seconds waited (wait_seconds, max_wait_seconds)
+        """
+        with self._condition:
+            return {
+                'queue_depth': len(self._queue),
+                'in_flight': dict(self._in_flight),
+                'admitted': self._admitted,
+                'wait_seconds': self._wait_total,
+                'max_wait_seconds': self._wait_max
+            }
+
+    def _limits(self, operation, host, data_store):
+        """
+        Get the limited resources of a request
+        :param operation: The operation type
+        :param host: The host, or None
+        :param data_store: The datastore, or None
+
+        :return: A dictionary mapping each resource key to its limit
+        """
+        limits = {}
+        if operation in self.operation_limits:
+            limits['operation-{}'.format(operation)] = (
+                self.operation_limits[operation]
+            )
+        if host is not None and self.host_limit:
+            limits['host-{}'.format(_object_id(host))] = self.host_limit
+        if data_store is not None and self.data_store_limit:
+            limits['datastore-{}'.format(_object_id(data_store))] = (
+                self.data_store_limit
+            )
+        return limits
+
+    def _admissible(self, ticket):
+        """
+        Check whether a queued request can be admitted, every request ahead
+        of it reserving the resources it needs. Call it with the condition
+        :param ticket: The queued request token and limits
+
+        :return: True if it can be admitted, False otherwise
+        """
+        reserved = {}
+        for queued in self._queue[:self._queue.index(ticket)]:
+            for key in queued[1]:
+                reserved[key] = reserved.get(key, 0) + 1
+        return all(
+            self._in_flight.get(key, 0) + reserved.get(key, 0) < limit
+            for key, limit in ticket[1].items()
+        )
+
+    def _lock_slots(self, limits, description, start):
+        """
+        Lock a slot file of each resource of a request, in a fixed order so
+        processes do not deadlock, if the limits are shared
+        :param limits: The request limits
+        :param description: The description of the wait
+        :param start: When the request was made
+
+        :return: The list of entered slot lock contexts
+
+        :raise: TimeoutError: If the deadline is reached while waiting
+        """
+        slots = []
+        if self.lock_dir:
+            try:
+                for key in sorted(limits):
+                    slots.append(
+                        self._lock_slot(key, limits[key], description, start)
+                    )
+            except Exception:
+                for slot in reversed(slots):
+                    slot.__exit__(None, None, None)
+                raise
+        return slots
+
+    def _lock_slot(self, key, limit, description, start):
+        """
+        Lock the first free slot file of a resource, polling until one is
+        :param key: The resource key
+        :param limit: The resource limit
+        :param description: The description of the wait
+        :param start: When the request was made
+
+        :return: The entered slot lock context
+
+        :raise: TimeoutError: If the deadline is reached while waiting
+        """
+        while True:
+            for i in range(limit):
+                slot = file_lock(
+                    os.path.join(
+                        self.lock_dir, 'vcdriver-{}-{}.lock'.format(key, i)
+                    ),
+                    blocking=False
+                )
+                if slot.__enter__():
+                    return slot
+                slot.__exit__(None, None, None)
+            left = remaining_time()
+            if left == 0:
+                raise TimeoutError(description, time.time() - start)
+            time.sleep(
+                self._poll_interval if left is None
+                else min(self._poll_interval, left)
+            )
+
+    def __str__(self):
+        return 'AdmissionController({}, host={}, datastore={})'.format(
+            self.operation_limits, self.host_limit, self.data_store_limit
+        )
+
+    def __repr__(self):
+        return str(self)
+
+
+def set_controller(controller):
+    """
+    Set the admission controller of this process, used by the virtual
+    machine tasks
+    :param controller: The admission controller (AdmissionController), or
+    None to admit every task at once
+    """
+    global _controller
+    _controller = controller
+
+
+def get_controller():
+    """
+    Get the admission controller of this process
+
+    :return: The admission controller (AdmissionController), or None
+    """
+    return _controller
+
+
+@contextlib.contextmanager
+def admit(operation, host=None, data_store=None):
+    """
+    Hold a slot of the admission controller of this process for a vcenter
+    task within a context, see AdmissionController.admit. Without a
+    controller, the task is admitted at once
+    :param operation: The operation type, like "clone"
+    :param host: The host the task runs on, if known
+    :param data_store: The datastore the task writes to, if known
+    """
+    controller = get_controller()
+    if controller:
+        with controller.admit(operation, host, data_store):
+            yield
+    else:
+        yield
+
+
+def _object_id(obj):
+    """
+    Get a stable identifier of a vcenter object
+    :param obj: The vcenter object, or a name
+
+    :return: Its managed object id, or the name
+    """
+    return getattr(obj, '_moId', obj)
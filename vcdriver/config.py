@@ -28,14 +28,17 @@ _CONFIG = {
         'vcdriver_vm_ssh_username': '',
         'vcdriver_vm_ssh_password': '',
         'vcdriver_vm_winrm_username': '',
-        'vcdriver_vm_winrm_password': ''
+        'vcdriver_vm_winrm_password': '',
+        'vcdriver_vm_guest_username': '',
+        'vcdriver_vm_guest_password': ''
     }
 }
 
 _SECRETS = {
     'vcdriver_password',
     'vcdriver_vm_ssh_password',
-    'vcdriver_vm_winrm_password'
+    'vcdriver_vm_winrm_password',
+    'vcdriver_vm_guest_password'
 }
 
 _config = copy.deepcopy(_CONFIG)
@@ -69,9 +72,13 @@ def load(path=None):
     for section_key, section_content in _config.items():
         for config_key in section_content.keys():
             if path:
-                _config[section_key][config_key] = config.get(
-                    section_key, config_key
-                ) or os.getenv(config_key, _DEFAULTS.get(config_key, ''))
+                try:
+                    value = config.get(section_key, config_key)
+                except configparser.NoOptionError:
+                    value = ''
+                _config[section_key][config_key] = value or os.getenv(
+                    config_key, _DEFAULTS.get(config_key, '')
+                )
             else:
                 _config[section_key][config_key] = os.getenv(
                     config_key, _DEFAULTS.get(config_key, '')
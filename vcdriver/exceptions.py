@@ -23,6 +23,13 @@ class IpError(Exception):
         )
 
 
+class IpPoolExhausted(Exception):
+    def __init__(self, network):
+        super(IpPoolExhausted, self).__init__(
+            'There are no free addresses left in "{}"'.format(network)
+        )
+
+
 class TimeoutError(Exception):
     def __init__(self, description, timeout):
         super(TimeoutError, self).__init__(
@@ -32,6 +39,10 @@ class TimeoutError(Exception):
 
 class RemoteCommandError(Exception):
     def __init__(self, command, return_code, std_out='', std_err=''):
+        self.command = command
+        self.return_code = return_code
+        self.std_out = std_out
+        self.std_err = std_err
         super(RemoteCommandError, self).__init__(
             'Remote execution of "{}" failed with exit code {}. '
             'STDOUT: {}. STDERR: {}.'.format(
@@ -48,6 +59,10 @@ class WinRmError(RemoteCommandError):
     pass
 
 
+class GuestError(RemoteCommandError):
+    pass
+
+
 class FileTransferError(Exception):
     def __init__(self, local_path, remote_path):
         super(FileTransferError, self).__init__(
@@ -73,3 +88,27 @@ class NotEnoughDiskSpace(Exception):
                 data_store_name, threshold, free_percentage
             )
         )
+
+
+class FleetError(Exception):
+    def __init__(self, description, results):
+        self.results = results
+        failures = [result for result in results if result.error]
+        super(FleetError, self).__init__(
+            '"{}" failed on {} of {} virtual machines: {}'.format(
+                description,
+                len(failures),
+                len(results),
+                ', '.join(
+                    '{} ({})'.format(result.vm, result.error)
+                    for result in failures
+                )
+            )
+        )
+
+
+class HandleError(Exception):
+    def __init__(self, name, reason):
+        super(HandleError, self).__init__(
+            'The handle of "{}" cannot be rebound: {}'.format(name, reason)
+        )
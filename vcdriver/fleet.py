@@ -0,0 +1,822 @@
+from __future__ import print_function
+
+from concurrent import futures
+import contextlib
+import datetime
+import time
+import uuid
+
+from pyVmomi import vim
+
+from vcdriver.config import configurable
+from vcdriver.exceptions import (
+    FleetError,
+    NoObjectFound,
+    RemoteCommandError,
+    SshError,
+    TooManyObjectsFound,
+)
+from vcdriver.helpers import (
+    connect_ssh,
+    get_all_vcenter_objects,
+    get_properties,
+    probe_ports,
+    propagate_deadline,
+    run_ssh_command,
+    timeout_loop,
+    wait_for_properties,
+    wait_for_vcenter_tasks,
+)
+from vcdriver.session import connection
+from vcdriver.vm import SNAPSHOT_STRATEGIES
+
+
+class FleetResult(object):
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+
+    def __init__(self, vm):
+        """
+        The outcome of an operation on one of the virtual machines of a fleet
+        :param vm: The virtual machine (VirtualMachine)
+
+        status: One of succeeded, failed or cancelled
+        elapsed: The seconds spent on this virtual machine
+        value: What the operation returned, if it succeeded
+        error: The exception raised, if it failed
+        """
+        self.vm = vm
+        self.status = self.CANCELLED
+        self.elapsed = 0
+        self.value = None
+        self.error = None
+
+    @property
+    def return_code(self):
+        """ The exit code, for remote commands """
+        return self._command_output(0, 'return_code')
+
+    @property
+    def stdout(self):
+        """ The stdout, for remote commands """
+        return self._command_output(1, 'std_out')
+
+    @property
+    def stderr(self):
+        """ The stderr, for remote commands """
+        return self._command_output(2, 'std_err')
+
+    def _command_output(self, index, attribute):
+        """
+        Get a remote command output either from the value or from the error
+        :param index: The index in the (status, stdout, stderr) value tuple
+        :param attribute: The RemoteCommandError attribute
+
+        :return: The output, or None if this is not a remote command result
+        """
+        if isinstance(self.error, RemoteCommandError):
+            return getattr(self.error, attribute)
+        elif isinstance(self.value, tuple) and len(self.value) == 3:
+            return self.value[index]
+
+    def __str__(self):
+        return '{}: {} ({})'.format(
+            self.vm, self.status, datetime.timedelta(seconds=self.elapsed)
+        )
+
+    def __repr__(self):
+        return str(self)
+
+
+def fan_out(vms, function, max_workers=10, fail_fast=False, quiet=False):
+    """
+    Run a function concurrently on every virtual machine of a fleet
+    :param vms: The list of virtual machines (VirtualMachine)
+    :param function: The function, called with a virtual machine
+    :param max_workers: The maximum number of virtual machines handled at once
+    :param fail_fast: If True, the virtual machines not started yet are
+    cancelled as soon as one of them fails
+    :param quiet: Whether to hide the per virtual machine summary or not
+
+    :return: The list of results (FleetResult), in the same order as the vms
+    """
+    results = [FleetResult(vm) for vm in vms]
+
+    def run(result):
+        start = time.time()
+        try:
+            result.value = function(result.vm)
+            result.status = FleetResult.SUCCEEDED
+        except Exception as e:
+            result.error = e
+            result.status = FleetResult.FAILED
+        result.elapsed = time.time() - start
+        return result
+
+    executor = futures.ThreadPoolExecutor(max_workers=max(max_workers, 1))
+    try:
+        pending = [
+            executor.submit(propagate_deadline(run), result)
+            for result in results
+        ]
+        for future in futures.as_completed(pending):
+            if fail_fast and future.result().status == FleetResult.FAILED:
+                for other in pending:
+                    other.cancel()
+                break
+    finally:
+        executor.shutdown(wait=True)
+    if not quiet:
+        for result in results:
+            print(result)
+    return results
+
+
+@configurable([
+    ('Virtual Machine Remote Management', 'vcdriver_vm_ssh_username'),
+    ('Virtual Machine Remote Management', 'vcdriver_vm_ssh_password')
+])
+def fleet_ssh(
+        vms,
+        command,
+        use_sudo=False,
+        max_workers=10,
+        fail_fast=False,
+        quiet=False,
+        **kwargs
+):
+    """
+    Execute a shell command through ssh on every virtual machine of a fleet.
+    Each virtual machine gets its own ssh connection, which is opened once
+    and doubles as the ssh service readiness check
+    :param vms: The list of virtual machines (VirtualMachine)
+    :param command: The command to be executed
+    :param use_sudo: If True, it runs as sudo
+    :param max_workers: The maximum number of virtual machines handled at once
+    :param fail_fast: If True, stop starting new virtual machines on failure
+    :param quiet: Whether to hide the per virtual machine summary or not
+
+    :return: The list of results (FleetResult), in the same order as the vms.
+    The virtual machines not deployed fail with NoObjectFound
+    """
+    username = kwargs['vcdriver_vm_ssh_username']
+    password = kwargs['vcdriver_vm_ssh_password']
+
+    def run(vm):
+        _check_deployed(vm)
+        host = vm.ip()
+        clients = []
+
+        def connect():
+            clients.append(connect_ssh(host, username, password, timeout=10))
+            return True
+
+        timeout_loop(
+            vm.timeout, 'Check SSH service on {}'.format(vm), 1, True, connect
+        )
+        try:
+            status, stdout, stderr = run_ssh_command(
+                clients[0], command, use_sudo, password
+            )
+        finally:
+            clients[0].close()
+        if status != 0:
+            raise SshError(command, status, stdout, stderr)
+        return status, stdout, stderr
+
+    return fan_out(vms, run, max_workers, fail_fast, quiet)
+
+
+@configurable([
+    ('Virtual Machine Remote Management', 'vcdriver_vm_winrm_username'),
+    ('Virtual Machine Remote Management', 'vcdriver_vm_winrm_password')
+])
+def fleet_winrm(
+        vms,
+        script,
+        winrm_kwargs=dict(),
+        max_workers=10,
+        fail_fast=False,
+        quiet=False,
+        **kwargs
+):
+    """
+    Execute a remote windows powershell script on every virtual machine of a
+    fleet
+    :param vms: The list of virtual machines (VirtualMachine)
+    :param script: A string with the powershell script
+    :param winrm_kwargs: The pywinrm Protocol class kwargs
+    :param max_workers: The maximum number of virtual machines handled at once
+    :param fail_fast: If True, stop starting new virtual machines on failure
+    :param quiet: Whether to hide the per virtual machine summary or not
+
+    :return: The list of results (FleetResult), in the same order as the vms.
+    The virtual machines not deployed fail with NoObjectFound
+    """
+    def run(vm):
+        _check_deployed(vm)
+        return vm.winrm(script, winrm_kwargs, quiet=True, **kwargs)
+
+    return fan_out(vms, run, max_workers, fail_fast, quiet)
+
+
+def fleet_wait_for_ips(vms, timeout=None, quiet=False):
+    """
+    Wait for every virtual machine of a fleet to get an ip, being notified by
+    vcenter of the changes of all of them in a single update loop
+    :param vms: The list of virtual machines (VirtualMachine)
+    :param timeout: The timeout, by default the highest timeout of the vms
+    :param quiet: If true, the benchmark time will not be printed
+
+    :return: The list of ips, in the same order as the vms. It is None for
+    the vms that do not exist
+
+    :raise: TimeoutError: If the timeout is reached
+    """
+    ips = dict((vm, vm._ip) for vm in vms if vm._vm_object and vm._ip)
+    pending = [vm for vm in vms if vm._vm_object and not vm._ip]
+    if pending:
+        if timeout is None:
+            timeout = max(vm.timeout for vm in pending)
+        for vm, properties in zip(pending, wait_for_properties(
+            connection(),
+            [vm._vm_object for vm in pending],
+            vim.VirtualMachine,
+            ['guest.ipAddress'],
+            lambda properties: properties.get('guest.ipAddress'),
+            'Get IP of {} vms'.format(len(pending)),
+            timeout,
+            quiet
+        )):
+            ips[vm] = properties['guest.ipAddress']
+    return [ips.get(vm) for vm in vms]
+
+
+def fleet_wait_for_port(vms, port, banner=None, timeout=None, quiet=False):
+    """
+    Wait for a tcp port to answer on every virtual machine of a fleet,
+    probing all of them at once on each retry
+    :param vms: The list of virtual machines (VirtualMachine)
+    :param port: The port, like 22 for ssh or 5985 for winrm
+    :param banner: If given, the bytes that the service must greet with,
+    like b"SSH-"
+    :param timeout: The timeout, by default the highest timeout of the vms
+    :param quiet: If true, the benchmark time will not be printed
+
+    :raise: TimeoutError: If the timeout is reached
+    """
+    if timeout is None:
+        timeout = max([vm.timeout for vm in vms] or [0])
+    pending = [
+        ip for ip in fleet_wait_for_ips(vms, timeout, quiet=True) if ip
+    ]
+    description = 'Port {} of {} vms'.format(port, len(pending))
+
+    def ready():
+        answered = probe_ports(
+            [(ip, port) for ip in pending], banner=banner
+        )
+        pending[:] = [ip for ip, ok in zip(pending, answered) if not ok]
+        return not pending
+
+    if pending:
+        timeout_loop(timeout, description, 1, quiet, ready)
+
+
+def fleet_create_snapshot(
+        vms,
+        name,
+        dump_memory,
+        description='',
+        quiesce=False,
+        max_workers=10,
+        timeout=None,
+        quiet=False
+):
+    """
+    Create a snapshot on every virtual machine of a fleet at once
+    :param vms: The list of virtual machines (VirtualMachine)
+    :param name: The name of the snapshot to create
+    :param dump_memory: Whether to dump the memory of the vms
+    :param description: A description of the snapshot
+    :param quiesce: Whether to quiesce the guest file systems first
+    :param max_workers: The maximum number of tasks issued at once
+    :param timeout: The timeout for all the tasks, by default the highest
+    timeout of the vms
+    :param quiet: Whether to hide the per virtual machine summary or not
+
+    :return: The list of results (FleetResult), in the same order as the vms
+    """
+    def issue(vm):
+        if vm._vm_object:
+            try:
+                vm.find_snapshot(name)
+            except NoObjectFound:
+                return vm._vm_object.CreateSnapshot(
+                    name, description, dump_memory, quiesce
+                )
+            raise TooManyObjectsFound(vim.vm.Snapshot, name)
+
+    try:
+        return _fleet_tasks(
+            vms,
+            issue,
+            'Creating snapshot "{}" on {} vms'.format(name, len(vms)),
+            max_workers,
+            timeout,
+            quiet
+        )
+    finally:
+        for vm in vms:
+            vm._snapshots = None
+
+
+def fleet_revert_snapshot(
+        vms, name, max_workers=10, timeout=None, quiet=False
+):
+    """
+    Revert every virtual machine of a fleet to a snapshot at once
+    :param vms: The list of virtual machines (VirtualMachine)
+    :param name: The name of the snapshot to revert to
+    :param max_workers: The maximum number of tasks issued at once
+    :param timeout: The timeout for all the tasks, by default the highest
+    timeout of the vms
+    :param quiet: Whether to hide the per virtual machine summary or not
+
+    :return: The list of results (FleetResult), in the same order as the vms
+    """
+    def issue(vm):
+        if vm._vm_object:
+            return vm.find_snapshot(name).RevertToSnapshot_Task()
+
+    return _fleet_tasks(
+        vms,
+        issue,
+        'Restoring snapshot "{}" on {} vms'.format(name, len(vms)),
+        max_workers,
+        timeout,
+        quiet
+    )
+
+
+def fleet_remove_snapshot(
+        vms,
+        name,
+        remove_children=False,
+        max_workers=10,
+        timeout=None,
+        quiet=False
+):
+    """
+    Delete a snapshot from every virtual machine of a fleet at once
+    :param vms: The list of virtual machines (VirtualMachine)
+    :param name: The name of the snapshot to delete
+    :param remove_children: Whether to remove the children snapshots or not
+    :param max_workers: The maximum number of tasks issued at once
+    :param timeout: The timeout for all the tasks, by default the highest
+    timeout of the vms
+    :param quiet: Whether to hide the per virtual machine summary or not
+
+    :return: The list of results (FleetResult), in the same order as the vms
+    """
+    def issue(vm):
+        if vm._vm_object:
+            return vm.find_snapshot(name).RemoveSnapshot_Task(remove_children)
+
+    try:
+        return _fleet_tasks(
+            vms,
+            issue,
+            'Delete snapshot "{}" from {} vms'.format(name, len(vms)),
+            max_workers,
+            timeout,
+            quiet
+        )
+    finally:
+        for vm in vms:
+            vm._snapshots = None
+
+
+def fleet_power_on(vms, timeout=None, quiet=False):
+    """
+    Power on every virtual machine of a fleet with a single task per
+    datacenter (PowerOnMultiVM_Task), skipping the ones already powered on
+    :param vms: The list of virtual machines (VirtualMachine)
+    :param timeout: The timeout for all the tasks, by default the highest
+    timeout of the vms
+    :param quiet: Whether to hide the per virtual machine summary or not
+
+    :return: The list of results (FleetResult), in the same order as the vms
+    """
+    conn = connection()
+    results = [FleetResult(vm) for vm in vms]
+    pending = [
+        result for result, state in zip(results, _power_states(conn, vms))
+        if state is not None and state != 'poweredOn'
+    ]
+    for result in results:
+        result.status = FleetResult.SUCCEEDED
+    if timeout is None:
+        timeout = max([result.vm.timeout for result in pending] or [0])
+    datacenters = _datacenters(
+        conn, [result.vm._vm_object for result in pending]
+    )
+    batches = {}
+    for result in pending:
+        datacenter = datacenters.get(result.vm._vm_object)
+        if datacenter is None:
+            result.status = FleetResult.FAILED
+            result.error = NoObjectFound(vim.Datacenter, result.vm.name)
+        else:
+            batches.setdefault(datacenter, []).append(result)
+    batches = list(batches.items())
+    description = 'Power on {} vms'.format(len(pending))
+    attempted = []
+    for (datacenter, batch), info in zip(batches, wait_for_vcenter_tasks(
+        conn,
+        [
+            datacenter.PowerOnMultiVM_Task(
+                vm=[result.vm._vm_object for result in batch]
+            )
+            for datacenter, batch in batches
+        ],
+        description,
+        timeout
+    )):
+        by_object = dict((result.vm._vm_object, result) for result in batch)
+        if info.state != vim.TaskInfo.State.success:
+            for result in batch:
+                result.status = FleetResult.FAILED
+                result.error = info.error
+            continue
+        for not_attempted in info.result.notAttempted:
+            result = by_object[not_attempted.vm]
+            result.status = FleetResult.FAILED
+            result.error = not_attempted.fault
+        for vm_attempt in info.result.attempted:
+            if vm_attempt.task is None:
+                by_object[vm_attempt.vm].elapsed = (
+                    info.completeTime - info.queueTime
+                ).total_seconds()
+            else:
+                attempted.append((by_object[vm_attempt.vm], vm_attempt.task))
+    for (result, task), info in zip(attempted, wait_for_vcenter_tasks(
+        conn, [task for result, task in attempted], description, timeout
+    )):
+        result.elapsed = (info.completeTime - info.queueTime).total_seconds()
+        if info.state != vim.TaskInfo.State.success and not isinstance(
+            info.error, vim.fault.InvalidPowerState
+        ):
+            result.status = FleetResult.FAILED
+            result.error = info.error
+    if not quiet:
+        for result in results:
+            print(result)
+    return results
+
+
+def fleet_power_off(vms, max_workers=10, timeout=None, quiet=False):
+    """
+    Power off every virtual machine of a fleet at once, skipping the ones
+    already powered off
+    :param vms: The list of virtual machines (VirtualMachine)
+    :param max_workers: The maximum number of tasks issued at once
+    :param timeout: The timeout for all the tasks, by default the highest
+    timeout of the vms
+    :param quiet: Whether to hide the per virtual machine summary or not
+
+    :return: The list of results (FleetResult), in the same order as the vms
+    """
+    return _fleet_power_tasks(
+        vms,
+        lambda vm_object: vm_object.PowerOffVM_Task(),
+        ('poweredOn', 'suspended'),
+        'Power off {} vms',
+        max_workers,
+        timeout,
+        quiet
+    )
+
+
+def fleet_reset(vms, max_workers=10, timeout=None, quiet=False):
+    """
+    Reset every powered on virtual machine of a fleet at once
+    :param vms: The list of virtual machines (VirtualMachine)
+    :param max_workers: The maximum number of tasks issued at once
+    :param timeout: The timeout for all the tasks, by default the highest
+    timeout of the vms
+    :param quiet: Whether to hide the per virtual machine summary or not
+
+    :return: The list of results (FleetResult), in the same order as the vms
+    """
+    return _fleet_power_tasks(
+        vms,
+        lambda vm_object: vm_object.ResetVM_Task(),
+        ('poweredOn',),
+        'Reset {} vms',
+        max_workers,
+        timeout,
+        quiet
+    )
+
+
+def fleet_set_autostart(vms, start_delay=10, max_workers=10, quiet=False):
+    """
+    Set the ESXI autostart of every virtual machine of a fleet, with a single
+    reconfiguration per host. The vms of a host start in the fleet order
+    :param vms: The list of virtual machines (VirtualMachine)
+    :param start_delay: The seconds between the start of each vm
+    :param max_workers: The maximum number of hosts reconfigured at once
+    :param quiet: Whether to hide the per virtual machine summary or not
+
+    :return: The list of results (FleetResult), in the same order as the vms.
+    The vms of a host share the outcome of its reconfiguration
+    """
+    results = [FleetResult(vm) for vm in vms]
+    deployed = [result for result in results if result.vm._vm_object]
+    for result in results:
+        result.status = FleetResult.SUCCEEDED
+    batches = {}
+    for result, properties in zip(deployed, get_properties(
+        connection(),
+        [result.vm._vm_object for result in deployed],
+        vim.VirtualMachine,
+        ['summary.runtime.host']
+    ) if deployed else []):
+        batches.setdefault(
+            properties.get('summary.runtime.host'), []
+        ).append(result)
+    hosts = list(batches)
+
+    def reconfigure(host):
+        host.configManager.autoStartManager.ReconfigureAutostart(
+            vim.host.AutoStartManager.Config(
+                defaults=vim.host.AutoStartManager.SystemDefaults(
+                    enabled=True, startDelay=start_delay
+                ),
+                powerInfo=[
+                    vim.host.AutoStartManager.AutoPowerInfo(
+                        key=result.vm._vm_object,
+                        startAction='powerOn',
+                        startDelay=-1,
+                        startOrder=order,
+                        stopAction='None',
+                        stopDelay=-1,
+                        waitForHeartbeat='no'
+                    )
+                    for order, result in enumerate(batches[host], 1)
+                ]
+            )
+        )
+
+    for host_result in fan_out(hosts, reconfigure, max_workers, quiet=True):
+        for result in batches[host_result.vm]:
+            result.status = host_result.status
+            result.error = host_result.error
+            result.elapsed = host_result.elapsed
+    if not quiet:
+        for result in results:
+            print(result)
+    return results
+
+
+@contextlib.contextmanager
+def fleet_snapshot(
+        vms,
+        strategy='memory',
+        keep=False,
+        name=None,
+        max_workers=10,
+        quiet=False
+):
+    """
+    Ensure that you run something and restore a fleet of VMs to its initial
+    state, handling all the VMs at once in each phase
+    :param vms: The list of virtual machines (VirtualMachine)
+    :param strategy: The snapshot strategy, see vcdriver.vm.snapshot
+    :param keep: If True, the snapshot is only reverted when leaving the
+    context and kept, so later contexts with the same name reuse it
+    :param name: The snapshot name. A random one is used by default, or
+    "vcdriver-<strategy>" when keeping the snapshot
+    :param max_workers: The maximum number of tasks issued at once
+    :param quiet: Whether to hide the per virtual machine summaries or not
+
+    :yield: A dictionary with the list of results (FleetResult) of each
+    phase (create, revert, power_on and remove), filled in as they happen
+
+    :raise: FleetError: If a phase fails on any virtual machine. A failure
+    while restoring the fleet after the body raised is printed instead, so
+    the original exception is the one propagated
+    """
+    options = SNAPSHOT_STRATEGIES[strategy]
+    if name is None:
+        if keep:
+            name = 'vcdriver-{}'.format(strategy)
+        else:
+            name = str(uuid.uuid4())
+    deployed = [vm for vm in vms if vm._vm_object]
+    powered_on = [
+        vm for vm, properties in zip(deployed, get_properties(
+            connection(),
+            [vm._vm_object for vm in deployed],
+            vim.VirtualMachine,
+            ['runtime.powerState']
+        ))
+        if properties.get('runtime.powerState') == 'poweredOn'
+    ] if deployed else []
+    missing = vms
+    if keep:
+        found = fan_out(
+            vms, lambda vm: vm.find_snapshot(name), max_workers, quiet=True
+        )
+        missing = [
+            result.vm for result in found
+            if isinstance(result.error, NoObjectFound)
+        ]
+        existing = [
+            result.vm for result in found
+            if not result.error and result.vm._vm_object
+        ]
+        # The revert restores the power state recorded in the snapshot
+        powered_on = [
+            vm for vm in deployed
+            if vm not in existing and vm in powered_on or
+            vm in existing and vm._snapshot_index()[0][name][0].state ==
+            vim.VirtualMachine.PowerState.poweredOn
+        ]
+    phases = {}
+    phases['create'] = fleet_create_snapshot(
+        missing, name, max_workers=max_workers, quiet=quiet, **options
+    )
+    if any(result.error for result in phases['create']):
+        if not keep:
+            fleet_remove_snapshot(
+                [result.vm for result in phases['create'] if not result.error],
+                name,
+                max_workers=max_workers,
+                quiet=quiet
+            )
+        raise FleetError('Create snapshot "{}"'.format(name), phases['create'])
+    succeeded = False
+    try:
+        yield phases
+        succeeded = True
+    finally:
+        phases['revert'] = fleet_revert_snapshot(
+            vms, name, max_workers=max_workers, quiet=quiet
+        )
+        if not options['dump_memory']:
+            phases['power_on'] = fleet_power_on(powered_on, quiet=quiet)
+        if not keep:
+            phases['remove'] = fleet_remove_snapshot(
+                vms, name, max_workers=max_workers, quiet=quiet
+            )
+        for phase in ('revert', 'power_on', 'remove'):
+            if any(result.error for result in phases.get(phase, [])):
+                error = FleetError(
+                    '{} snapshot "{}"'.format(phase.capitalize(), name),
+                    phases[phase]
+                )
+                if not succeeded:
+                    print(error)
+                    break
+                raise error
+
+
+def _check_deployed(vm):
+    """
+    Check that a virtual machine is deployed, as its remote management
+    functions silently do nothing otherwise
+    :param vm: The virtual machine (VirtualMachine)
+
+    :raise: NoObjectFound: If it is not deployed
+    """
+    if not vm._vm_object:
+        raise NoObjectFound(vim.VirtualMachine, vm.name)
+
+
+def _fleet_power_tasks(
+        vms, issue, states, description, max_workers, timeout, quiet
+):
+    """
+    Issue a power task for the virtual machines of a fleet in some power
+    states, read in a single call, and wait for all of them together
+    :param vms: The list of virtual machines (VirtualMachine)
+    :param issue: The function that starts the task of a vm object
+    :param states: The power states of the virtual machines to act on
+    :param description: The description of the tasks, formatted with their
+    number
+    :param max_workers: The maximum number of tasks issued at once
+    :param timeout: The timeout for all the tasks
+    :param quiet: Whether to hide the per virtual machine summary or not
+
+    :return: The list of results (FleetResult), in the same order as the vms
+    """
+    states_of_vms = zip(vms, _power_states(connection(), vms))
+    targets = set(
+        vm._vm_object for vm, state in states_of_vms if state in states
+    )
+    return _fleet_tasks(
+        vms,
+        lambda vm: issue(vm._vm_object) if vm._vm_object in targets else None,
+        description.format(len(targets)),
+        max_workers,
+        timeout,
+        quiet,
+        ignored_errors=(vim.fault.InvalidPowerState,)
+    )
+
+
+def _power_states(conn, vms):
+    """
+    Get the power state of the virtual machines of a fleet in a single call
+    :param conn: A vcenter connection
+    :param vms: The list of virtual machines (VirtualMachine)
+
+    :return: A list with the power state of each vm, like "poweredOn", or
+    None if it is not deployed
+    """
+    deployed = [vm._vm_object for vm in vms if vm._vm_object]
+    states = iter([
+        properties.get('runtime.powerState') for properties in get_properties(
+            conn, deployed, vim.VirtualMachine, ['runtime.powerState']
+        )
+    ] if deployed else [])
+    return [next(states) if vm._vm_object else None for vm in vms]
+
+
+def _datacenters(conn, vm_objects):
+    """
+    Find the datacenter of several vm objects, with a single container view
+    per datacenter when there are many
+    :param conn: A vcenter connection
+    :param vm_objects: The vm objects
+
+    :return: A dictionary mapping each vm object found to its datacenter
+    """
+    if not vm_objects:
+        return {}
+    datacenters = get_all_vcenter_objects(conn, vim.Datacenter)
+    if len(datacenters) == 1:
+        return dict((obj, datacenters[0]) for obj in vm_objects)
+    wanted = set(vm_objects)
+    found = {}
+    for datacenter in datacenters:
+        for obj in get_all_vcenter_objects(
+            conn, vim.VirtualMachine, datacenter
+        ):
+            if obj in wanted:
+                found[obj] = datacenter
+    return found
+
+
+def _fleet_tasks(
+        vms,
+        issue,
+        description,
+        max_workers,
+        timeout,
+        quiet,
+        ignored_errors=()
+):
+    """
+    Issue a vcenter task for every virtual machine of a fleet concurrently
+    and wait for all of them together
+    :param vms: The list of virtual machines (VirtualMachine)
+    :param issue: The function that starts the task of a virtual machine. It
+    returns the task, or None if there is nothing to do
+    :param description: The description of the tasks
+    :param max_workers: The maximum number of tasks issued at once
+    :param timeout: The timeout for all the tasks, by default the highest
+    timeout of the vms
+    :param quiet: Whether to hide the per virtual machine summary or not
+    :param ignored_errors: The task fault types considered a success
+
+    :return: The list of results (FleetResult), in the same order as the vms.
+    The elapsed time of a task is measured by vcenter, from queue to completion
+    """
+    results = fan_out(vms, issue, max_workers, quiet=True)
+    issued = [
+        result for result in results
+        if result.status == FleetResult.SUCCEEDED and result.value is not None
+    ]
+    if timeout is None:
+        timeout = max([result.vm.timeout for result in issued] or [0])
+    infos = wait_for_vcenter_tasks(
+        connection(), [result.value for result in issued], description, timeout
+    )
+    for result, info in zip(issued, infos):
+        result.elapsed = (info.completeTime - info.queueTime).total_seconds()
+        if info.state == vim.TaskInfo.State.success:
+            result.value = info.result
+        elif isinstance(info.error, ignored_errors):
+            result.value = None
+        else:
+            result.status = FleetResult.FAILED
+            result.error = info.error
+            result.value = None
+    if not quiet:
+        for result in results:
+            print(result)
+    return results
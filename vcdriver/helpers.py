@@ -1,17 +1,30 @@
 from __future__ import print_function
 import contextlib
 import datetime
+import errno
+import functools
+import hashlib
 import os
+import random
 import socket
 import sys
+import threading
 import time
 
 from colorama import init, Style
 from fabric.api import run
 from fabric.context_managers import settings
+import paramiko
 from pyVmomi import vim, vmodl
+from six.moves import shlex_quote
+from six.moves.urllib.parse import urlsplit, urlunsplit
 import winrm
+try:
+    import selectors
+except ImportError:  # pragma: no cover
+    import selectors34 as selectors
 
+from vcdriver.config import configurable
 from vcdriver.exceptions import (
     TooManyObjectsFound,
     NoObjectFound,
@@ -22,12 +35,73 @@ from vcdriver.exceptions import (
 
 init()
 
+# A monotonic clock when available (Python 3), so waits do not drift
+_monotonic = getattr(time, 'monotonic', time.time)
 
-def get_all_vcenter_objects(connection, object_type):
+# The statistics of the last wait of each thread
+_wait_stats = threading.local()
+
+# The deadline of each thread, see deadline
+_deadlines = threading.local()
+
+# The connect_ex results of a non-blocking socket that is connecting
+_CONNECTING = frozenset([
+    0,
+    errno.EINPROGRESS,
+    errno.EWOULDBLOCK,
+    getattr(errno, 'WSAEWOULDBLOCK', errno.EWOULDBLOCK)
+])
+
+_WSMAN_IDENTIFY = (
+    '<s:Envelope xmlns:s="http://www.w3.org/2003/05/soap-envelope" '
+    'xmlns:wsmid="http://schemas.dmtf.org/wbem/wsman/identity/1/'
+    'wsmanidentity.xsd"><s:Header/><s:Body><wsmid:Identify/></s:Body>'
+    '</s:Envelope>'
+)
+
+try:
+    import fcntl
+
+    def _lock_file(lock_file, blocking=True):
+        try:
+            fcntl.flock(
+                lock_file.fileno(),
+                fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+            )
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return False
+        return True
+
+    def _unlock_file(lock_file):
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+except ImportError:  # pragma: no cover
+    import msvcrt
+
+    def _lock_file(lock_file, blocking=True):
+        lock_file.seek(0)
+        while True:
+            try:
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+                return True
+            except (IOError, OSError):
+                if not blocking:
+                    return False
+                time.sleep(0.1)
+
+    def _unlock_file(lock_file):
+        lock_file.seek(0)
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def get_all_vcenter_objects(connection, object_type, container=None):
     """
     Return all the vcenter objects of a given type
     :param connection: A vcenter connection
     :param object_type:  A vcenter object type, like vim.VirtualMachine
+    :param container: The folder or datacenter to search in, by default the
+    whole inventory
 
     :return: A list with all the objects found
     """
@@ -40,7 +114,9 @@ def get_all_vcenter_objects(connection, object_type):
     content = connection.RetrieveContent()
     view = content.viewManager.CreateContainerView
     objects = [
-        obj for obj in view(content.rootFolder, [object_type], True).view
+        obj for obj in view(
+            container or content.rootFolder, [object_type], True
+        ).view
     ]
     print(datetime.timedelta(seconds=time.time() - start))
     return objects
@@ -81,6 +157,185 @@ def get_vcenter_object_by_name(connection, object_type, name):
         raise NoObjectFound(object_type, name)
 
 
+def get_properties(connection, objects, object_type, property_paths):
+    """
+    Retrieve some properties of several vcenter objects in a single call,
+    instead of fetching whole data objects one attribute access at a time
+    :param connection: A vcenter connection
+    :param objects: The vcenter objects
+    :param object_type: The vcenter objects type, like vim.VirtualMachine
+    :param property_paths: The property paths, like "summary.runtime.host"
+
+    :return: A list with a dictionary mapping each path to its value for each
+    object, in the same order. Unset properties are missing from them
+    """
+    collector = connection.RetrieveContent().propertyCollector
+    result = collector.RetrievePropertiesEx(
+        [vmodl.query.PropertyCollector.FilterSpec(
+            objectSet=[
+                vmodl.query.PropertyCollector.ObjectSpec(obj=obj)
+                for obj in objects
+            ],
+            propSet=[vmodl.query.PropertyCollector.PropertySpec(
+                type=object_type, pathSet=list(property_paths)
+            )]
+        )],
+        vmodl.query.PropertyCollector.RetrieveOptions()
+    )
+    properties = {}
+    while result:
+        for object_content in result.objects:
+            properties[object_content.obj] = dict(
+                (prop.name, prop.val) for prop in object_content.propSet
+            )
+        if result.token:
+            result = collector.ContinueRetrievePropertiesEx(result.token)
+        else:
+            result = None
+    return [properties.get(obj, {}) for obj in objects]
+
+
+def get_inventory_properties(connection, property_specs, container=None):
+    """
+    Retrieve some properties of all the vcenter objects of several types in
+    a single call, without listing the objects first
+    :param connection: A vcenter connection
+    :param property_specs: A list of (object type, property paths) tuples,
+    like [(vim.Datastore, ["name"])]
+    :param container: The folder or datacenter to search in, by default the
+    whole inventory
+
+    :return: A list of (object, properties) tuples, where the properties are
+    a dictionary mapping each path to its value. Unset properties are missing
+    from them
+    """
+    content = connection.RetrieveContent()
+    view = content.viewManager.CreateContainerView(
+        container or content.rootFolder,
+        [object_type for object_type, _ in property_specs],
+        True
+    )
+    try:
+        collector = content.propertyCollector
+        result = collector.RetrievePropertiesEx(
+            [vmodl.query.PropertyCollector.FilterSpec(
+                objectSet=[vmodl.query.PropertyCollector.ObjectSpec(
+                    obj=view,
+                    skip=True,
+                    selectSet=[vmodl.query.PropertyCollector.TraversalSpec(
+                        name='view',
+                        path='view',
+                        skip=False,
+                        type=vim.view.ContainerView
+                    )]
+                )],
+                propSet=[
+                    vmodl.query.PropertyCollector.PropertySpec(
+                        type=object_type, pathSet=list(property_paths)
+                    )
+                    for object_type, property_paths in property_specs
+                ]
+            )],
+            vmodl.query.PropertyCollector.RetrieveOptions()
+        )
+        objects = []
+        while result:
+            for object_content in result.objects:
+                objects.append((object_content.obj, dict(
+                    (prop.name, prop.val) for prop in object_content.propSet
+                )))
+            if result.token:
+                result = collector.ContinueRetrievePropertiesEx(result.token)
+            else:
+                result = None
+    finally:
+        view.Destroy()
+    return objects
+
+
+def wait_for_properties(
+        connection,
+        objects,
+        object_type,
+        property_paths,
+        condition,
+        description,
+        timeout,
+        quiet=False
+):
+    """
+    Wait until some properties of several vcenter objects meet a condition,
+    being notified by vcenter of each change instead of polling. A private
+    property collector is used, so other waits are not affected
+    :param connection: A vcenter connection
+    :param objects: The vcenter objects
+    :param object_type: The vcenter objects type, like vim.VirtualMachine
+    :param property_paths: The property paths, like "guest.ipAddress"
+    :param condition: The function called with the properties dictionary of
+    an object, returning True when the object is ready
+    :param description: The description of the wait
+    :param timeout: The timeout, in seconds
+    :param quiet: If true, the benchmark time will not be printed
+
+    :return: A list with a dictionary mapping each path to its value for each
+    object, in the same order. Unset properties are missing from them
+
+    :raise: TimeoutError: If the timeout is reached
+    """
+    timeout = remaining_time(timeout)
+    if not quiet:
+        print('Waiting for [{}] ... '.format(description), end='')
+        sys.stdout.flush()
+    start = time.time()
+    collector = connection.RetrieveContent(
+    ).propertyCollector.CreatePropertyCollector()
+    try:
+        collector.CreateFilter(
+            vmodl.query.PropertyCollector.FilterSpec(
+                objectSet=[
+                    vmodl.query.PropertyCollector.ObjectSpec(obj=obj)
+                    for obj in objects
+                ],
+                propSet=[vmodl.query.PropertyCollector.PropertySpec(
+                    type=object_type, pathSet=list(property_paths)
+                )]
+            ),
+            partialUpdates=False
+        )
+        properties = dict((obj, {}) for obj in objects)
+        pending = list(objects)
+        version = ''
+        while True:
+            update = collector.WaitForUpdatesEx(
+                version,
+                vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=max(
+                    int(timeout - (time.time() - start)), 1
+                ))
+            )
+            if update:
+                version = update.version
+                for filter_update in update.filterSet:
+                    for object_update in filter_update.objectSet:
+                        object_properties = properties[object_update.obj]
+                        for change in object_update.changeSet:
+                            if change.op == 'remove':
+                                object_properties.pop(change.name, None)
+                            else:
+                                object_properties[change.name] = change.val
+            pending = [
+                obj for obj in pending if not condition(properties[obj])
+            ]
+            if not pending:
+                break
+            if time.time() - start >= timeout:
+                raise TimeoutError(description, timeout)
+    finally:
+        collector.DestroyPropertyCollector()
+    if not quiet:
+        print(datetime.timedelta(seconds=time.time() - start))
+    return [properties[obj] for obj in objects]
+
+
 def styled_print(styles):
     """
     Generate a function that prints a message with a given style
@@ -104,6 +359,141 @@ def hide_std():
             sys.stderr = stderr
 
 
+class RetryPolicy(object):
+    def __init__(self, minimum=1, maximum=None, factor=1, jitter=0):
+        """
+        How long a waiter sleeps between attempts. The interval starts at the
+        minimum and is multiplied by the factor after each attempt, up to the
+        maximum. When the operation reports its expected remaining time, the
+        interval is half of it instead, within the same bounds
+        :param minimum: The minimum interval, in seconds
+        :param maximum: The maximum interval, in seconds. By default the
+        minimum, so the interval is fixed
+        :param factor: The backoff factor, like 2 for exponential backoff
+        :param jitter: The random fraction added or removed from each
+        interval, like 0.1 for +/-10%, so concurrent waiters do not sync.
+        The jittered interval stays within the bounds
+        """
+        self.minimum = minimum
+        self.maximum = minimum if maximum is None else maximum
+        self.factor = factor
+        self.jitter = jitter
+
+    def interval(self, attempts, eta=None):
+        """
+        Get the seconds to sleep before the next attempt
+        :param attempts: The number of attempts done so far
+        :param eta: The expected remaining seconds of the operation, if known
+
+        :return: The interval, in seconds
+        """
+        if eta is None:
+            interval = self.minimum * self.factor ** (attempts - 1)
+        else:
+            interval = eta / 2.0
+        interval *= 1 + random.uniform(-self.jitter, self.jitter)
+        return max(self.minimum, min(interval, self.maximum))
+
+    def __str__(self):
+        return 'RetryPolicy({}-{}s, x{}, +/-{})'.format(
+            self.minimum, self.maximum, self.factor, self.jitter
+        )
+
+    def __repr__(self):
+        return str(self)
+
+
+def last_wait_stats():
+    """
+    Get the statistics of the last wait of the current thread
+
+    :return: A dictionary with the number of attempts and the elapsed
+    seconds, or None if the thread did not wait yet
+    """
+    return getattr(_wait_stats, 'last', None)
+
+
+@contextlib.contextmanager
+def deadline(seconds):
+    """
+    Bound the vcdriver waits, task waits and remote calls of the current
+    thread by a single deadline within a context, so chained operations share
+    the time left instead of getting a fresh timeout each. A nested deadline
+    can only shorten the enclosing one, and the fleet functions pass it on to
+    their workers
+    :param seconds: The seconds from now until the deadline
+    """
+    with _deadline_at(_monotonic() + seconds):
+        yield
+
+
+def remaining_time(timeout=None):
+    """
+    Get the time left for a wait, bounded by the deadline of the current
+    thread
+    :param timeout: The timeout of the wait, in seconds, or None if unbounded
+
+    :return: The seconds left, never negative, or None if there is neither a
+    timeout nor a deadline
+    """
+    end = getattr(_deadlines, 'end', None)
+    if end is None:
+        return timeout
+    left = max(end - _monotonic(), 0)
+    return left if timeout is None else min(timeout, left)
+
+
+def call_timeout(description, timeout=None):
+    """
+    Get the timeout of a remote call, bounded by the deadline of the current
+    thread. Unlike remaining_time, a passed deadline raises instead of giving
+    a zero timeout, which the transports take as non-blocking
+    :param description: The description of the call
+    :param timeout: The timeout of the call, in seconds, or None if unbounded
+
+    :return: The seconds left, or None if there is neither a timeout nor a
+    deadline
+
+    :raise: TimeoutError: If there is no time left
+    """
+    left = remaining_time(timeout)
+    if left is not None and left <= 0:
+        raise TimeoutError(description, timeout or 0)
+    return left
+
+
+def propagate_deadline(function):
+    """
+    Bind a function to the deadline of the current thread, so it honours it
+    when it runs in another thread
+    :param function: The function
+
+    :return: The bound function
+    """
+    end = getattr(_deadlines, 'end', None)
+
+    @functools.wraps(function)
+    def bound(*args, **kwargs):
+        with _deadline_at(end):
+            return function(*args, **kwargs)
+    return bound
+
+
+@contextlib.contextmanager
+def grace_period(seconds):
+    """
+    Replace the deadline of the current thread by a short grace period within
+    a context, so the cleanups after a timeout can still wait for vcenter
+    :param seconds: The seconds from now until the end of the grace period
+    """
+    previous = getattr(_deadlines, 'end', None)
+    _deadlines.end = _monotonic() + seconds
+    try:
+        yield
+    finally:
+        _deadlines.end = previous
+
+
 def timeout_loop(
         timeout, description, seconds_until_retry, quiet,
         callback, *callback_args, **callback_kwargs
@@ -112,36 +502,163 @@ def timeout_loop(
     Wait inside a blocking loop for a task to complete
     :param timeout: The timeout, in seconds
     :param description: The task description
-    :param seconds_until_retry: Seconds before re-checking the callback
+    :param seconds_until_retry: Seconds before re-checking the callback, or
+    a retry policy (RetryPolicy)
     :param quiet: If true, the benchmark time will not be printed
     :param callback: If this function is True, the while loop will break
     :param callback_args: The positional arguments of the callback
     :param callback_kwargs: The keyword arguments of the callback
 
+    :return: A dictionary with the number of attempts and the elapsed seconds
+
     :raise: TimeoutError: If the timeout is reached
     """
+    if not isinstance(seconds_until_retry, RetryPolicy):
+        seconds_until_retry = RetryPolicy(seconds_until_retry)
+    return wait_until(
+        timeout,
+        description,
+        lambda: callback(*callback_args, **callback_kwargs),
+        seconds_until_retry,
+        quiet
+    )
+
+
+def wait_until(
+        timeout, description, callback, policy=None, quiet=False, eta=None
+):
+    """
+    Wait inside a blocking loop until a callback returns True, measuring the
+    time with a monotonic clock against a fixed deadline
+    :param timeout: The timeout, in seconds
+    :param description: The description of the wait
+    :param callback: The function called on each attempt. Its exceptions
+    count as failed attempts, and the last one is reported on timeout
+    :param policy: The retry policy (RetryPolicy), one second by default
+    :param quiet: If true, the benchmark time will not be printed
+    :param eta: A function returning the expected remaining seconds of the
+    operation, or None if unknown
+
+    :return: A dictionary with the number of attempts and the elapsed seconds
+
+    :raise: TimeoutError: If the timeout is reached
+    """
+    timeout = remaining_time(timeout)
+    policy = policy or RetryPolicy()
     error = None
     if not quiet:
         print('Waiting for [{}] ... '.format(description), end='')
         sys.stdout.flush()
-    countdown = timeout
-    start = time.time()
-    while countdown >= 0:
-        callback_start = time.time()
+    start = _monotonic()
+    deadline = start + timeout
+    attempts = 0
+    while True:
+        attempts += 1
         try:
-            if callback(*callback_args, **callback_kwargs):
+            if callback():
                 break
         except Exception as e:
             error = e
-        callback_time = time.time() - callback_start
-        time.sleep(seconds_until_retry)
-        countdown = countdown - seconds_until_retry - callback_time
-    if countdown <= 0:
-        if error:
-            description = '{}. {}'.format(description, str(error))
-        raise TimeoutError(description, timeout)
+        remaining = deadline - _monotonic()
+        if remaining <= 0:
+            _wait_stats.last = {
+                'attempts': attempts, 'elapsed': _monotonic() - start
+            }
+            if error:
+                description = '{}. {}'.format(description, str(error))
+            raise TimeoutError(description, timeout)
+        time.sleep(min(
+            policy.interval(attempts, eta() if eta else None), remaining
+        ))
+    stats = {'attempts': attempts, 'elapsed': _monotonic() - start}
+    _wait_stats.last = stats
     if not quiet:
-        print(datetime.timedelta(seconds=time.time() - start))
+        print(datetime.timedelta(seconds=stats['elapsed']))
+    return stats
+
+
+def get_local_manifest(local_path, checksum=True):
+    """
+    Build the manifest of the files under a local directory
+    :param local_path: The local directory
+    :param checksum: If True, files are signed with their md5 digest instead
+    of their size and modification time, as "size-mtime" with the mtime in
+    whole seconds since the epoch
+
+    :return: A dictionary mapping each relative path (using "/") to its
+    signature
+    """
+    manifest = {}
+    for directory, _, file_names in os.walk(local_path):
+        for file_name in file_names:
+            path = os.path.join(directory, file_name)
+            relative_path = os.path.relpath(path, local_path).replace(
+                os.sep, '/'
+            )
+            if checksum:
+                digest = hashlib.md5()
+                with open(path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                        digest.update(chunk)
+                manifest[relative_path] = digest.hexdigest()
+            else:
+                manifest[relative_path] = '{}-{}'.format(
+                    os.path.getsize(path), int(os.path.getmtime(path))
+                )
+    return manifest
+
+
+def parse_manifest(output):
+    """
+    Parse a remote manifest made of "signature<TAB>relative path" lines
+    :param output: The remote command output
+
+    :return: A dictionary mapping each relative path (using "/") to its
+    signature
+    """
+    manifest = {}
+    for line in output.splitlines():
+        if '\t' in line:
+            signature, relative_path = line.split('\t', 1)
+            manifest[relative_path.replace('\\', '/')] = (
+                signature.strip().lower()
+            )
+    return manifest
+
+
+def diff_manifests(local_manifest, remote_manifest):
+    """
+    Compare a local and a remote manifest
+    :param local_manifest: The local manifest
+    :param remote_manifest: The remote manifest
+
+    :return: A tuple with the sorted lists of the changed paths (missing or
+    different on the remote side) and the stale paths (only on the remote side)
+    """
+    changed = sorted(
+        path for path, signature in local_manifest.items()
+        if remote_manifest.get(path) != signature
+    )
+    stale = sorted(set(remote_manifest) - set(local_manifest))
+    return changed, stale
+
+
+@configurable([('Vsphere Session', 'vcdriver_host')])
+def guest_file_url(url, **kwargs):
+    """
+    Resolve a guest operations file transfer url, whose host might be "*"
+    when it is the same one the session is connected to
+    :param url: The url returned by the guest operations file manager
+
+    :return: The url ready to be used
+    """
+    parts = urlsplit(url)
+    if parts.hostname == '*':
+        netloc = kwargs['vcdriver_host']
+        if parts.port:
+            netloc = '{}:{}'.format(netloc, parts.port)
+        parts = parts._replace(netloc=netloc)
+    return urlunsplit(parts)
 
 
 def validate_ip(ip):
@@ -199,22 +716,56 @@ def validate_ipv6(ip):
 _TERMINAL_STATES = frozenset(
     (vim.TaskInfo.State.success, vim.TaskInfo.State.error))
 
+# The seconds given to cancellations and cleanups after a timeout
+CANCEL_GRACE = 60
+
 
-def wait_for_vcenter_task(task, task_description, timeout, _poll_interval=1):
+def wait_for_vcenter_task(
+        task,
+        task_description,
+        timeout,
+        _poll_interval=1,
+        cancel_on_timeout=False
+):
     """
-    Wait for a vcenter task to finish
+    Wait for a vcenter task to finish. The polling backs off while the task
+    runs, and follows its expected remaining time when it reports progress
     :param task: A vcenter task object
     :param task_description: The task description
     :param timeout: The timeout, in seconds
+    :param cancel_on_timeout: Whether to cancel the task on timeout, instead
+    of leaving it running on vcenter, see cancel_vcenter_tasks
 
     :return: The task result
 
     :raise: TimeoutError: If the timeout is reached
     """
-    timeout_loop(
-        timeout, task_description, _poll_interval, False,
-        callback=lambda: task.info.state in _TERMINAL_STATES,
-    )
+    start = _monotonic()
+    infos = []
+
+    def finished():
+        infos.append(task.info)
+        return infos[-1].state in _TERMINAL_STATES
+
+    def eta():
+        if not infos:
+            return None
+        progress = infos[-1].progress
+        if progress:
+            return (_monotonic() - start) * (100 - progress) / progress
+
+    try:
+        wait_until(
+            timeout,
+            task_description,
+            finished,
+            _task_retry_policy(_poll_interval),
+            eta=eta
+        )
+    except TimeoutError:
+        if cancel_on_timeout:
+            cancel_vcenter_tasks([task], _poll_interval=_poll_interval)
+        raise
     if task.info.state == vim.TaskInfo.State.success:
         return task.info.result
     else:
@@ -222,6 +773,146 @@ def wait_for_vcenter_task(task, task_description, timeout, _poll_interval=1):
             raise task.info.error
 
 
+def wait_for_vcenter_tasks(
+        connection,
+        tasks,
+        description,
+        timeout,
+        _poll_interval=1,
+        cancel_on_timeout=False
+):
+    """
+    Wait for several vcenter tasks to finish, polling the state of all the
+    pending ones in a single call
+    :param connection: A vcenter connection
+    :param tasks: The vcenter task objects
+    :param description: The description of the tasks
+    :param timeout: The timeout, in seconds
+    :param cancel_on_timeout: Whether to cancel the pending tasks on timeout,
+    see cancel_vcenter_tasks
+
+    :return: A list with the info (vim.TaskInfo) of each task, in the same
+    order. Failed tasks do not raise, their info has the error instead
+
+    :raise: TimeoutError: If the timeout is reached
+    """
+    infos = [None] * len(tasks)
+
+    def finished():
+        pending = [i for i, info in enumerate(infos) if info is None]
+        properties = get_properties(
+            connection, [tasks[i] for i in pending], vim.Task, ['info']
+        )
+        for i, task_properties in zip(pending, properties):
+            info = task_properties.get('info')
+            if info is not None and info.state in _TERMINAL_STATES:
+                infos[i] = info
+        return all(info is not None for info in infos)
+
+    if tasks:
+        try:
+            wait_until(
+                timeout,
+                description,
+                finished,
+                _task_retry_policy(_poll_interval)
+            )
+        except TimeoutError:
+            if cancel_on_timeout:
+                cancel_vcenter_tasks(
+                    [task for task, info in zip(tasks, infos) if info is None],
+                    _poll_interval=_poll_interval
+                )
+            raise
+    return infos
+
+
+def cancel_vcenter_tasks(tasks, grace=CANCEL_GRACE, _poll_interval=1):
+    """
+    Cancel the vcenter tasks that are still running and can be cancelled,
+    then wait briefly for the cancellations to land. The grace period
+    replaces the current deadline, which is often the cause of the timeout
+    :param tasks: The vcenter task objects
+    :param grace: The seconds to wait for the cancellations
+
+    :return: A list with the info (vim.TaskInfo) of each task, in the same
+    order, as last seen
+    """
+    for task in tasks:
+        info = task.info
+        if info.state not in _TERMINAL_STATES and info.cancelable:
+            try:
+                task.CancelTask()
+            except vmodl.MethodFault:
+                # The task finished or became not cancellable meanwhile
+                pass
+    infos = [task.info for task in tasks]
+
+    def cancelled():
+        infos[:] = [task.info for task in tasks]
+        return all(info.state in _TERMINAL_STATES for info in infos)
+
+    with grace_period(grace):
+        try:
+            wait_until(
+                grace,
+                'Cancel vcenter tasks',
+                cancelled,
+                RetryPolicy(_poll_interval),
+                quiet=True
+            )
+        except TimeoutError:
+            pass
+    return infos
+
+
+@contextlib.contextmanager
+def _deadline_at(end):
+    """
+    Set the deadline of the current thread within a context, unless the
+    current one is earlier
+    :param end: The deadline, as a monotonic clock time, or None
+    """
+    previous = getattr(_deadlines, 'end', None)
+    if previous is not None and (end is None or previous < end):
+        end = previous
+    _deadlines.end = end
+    try:
+        yield
+    finally:
+        _deadlines.end = previous
+
+
+def _task_retry_policy(poll_interval):
+    """
+    Get the retry policy of the vcenter task waits
+    :param poll_interval: The minimum interval, in seconds
+
+    :return: The retry policy (RetryPolicy)
+    """
+    return RetryPolicy(poll_interval, 10 * poll_interval, 1.5, 0.1)
+
+
+@contextlib.contextmanager
+def file_lock(path, blocking=True):
+    """
+    Hold an exclusive lock on a file within a context, shared by all the
+    processes of this machine
+    :param path: The lock file path, created if missing
+    :param blocking: Whether to wait for the lock, or give up at once if
+    another holder has it
+
+    :yield: Whether the lock is held
+    """
+    with open(path, 'a+') as lock_file:
+        locked = _lock_file(lock_file, blocking)
+        try:
+            yield locked
+        finally:
+            if locked:
+                _unlock_file(lock_file)
+
+
 @contextlib.contextmanager
 def fabric_context(host, username, password):
     """
@@ -237,32 +928,149 @@ def fabric_context(host, username, password):
             host_string="{}@{}".format(username, host),
             password=password,
             warn_only=True,
-            disable_known_hosts=True
+            disable_known_hosts=True,
+            command_timeout=call_timeout('SSH to "{}"'.format(host))
     ):
         yield
 
 
+def probe_ports(addresses, timeout=1, banner=None):
+    """
+    Check whether several tcp ports accept connections, probing all of them
+    at once with non-blocking sockets
+    :param addresses: The list of (host, port) tuples
+    :param timeout: The seconds to wait for all the ports
+    :param banner: If given, the bytes that the service must greet with,
+    like b"SSH-"
+
+    :return: A list with whether each port is open, in the same order
+    """
+    results = [False] * len(addresses)
+    received = {}
+    sockets = []
+    selector = selectors.DefaultSelector()
+    try:
+        for i, (host, port) in enumerate(addresses):
+            family = socket.AF_INET6 if validate_ipv6(host) else socket.AF_INET
+            probe = socket.socket(family, socket.SOCK_STREAM)
+            sockets.append(probe)
+            probe.setblocking(0)
+            if probe.connect_ex((host, port)) in _CONNECTING:
+                selector.register(probe, selectors.EVENT_WRITE, i)
+        deadline = time.time() + timeout
+        while selector.get_map():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            for key, events in selector.select(remaining):
+                probe, i = key.fileobj, key.data
+                if events & selectors.EVENT_WRITE:
+                    if probe.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                        selector.unregister(probe)
+                    elif banner:
+                        received[i] = b''
+                        selector.modify(probe, selectors.EVENT_READ, i)
+                    else:
+                        results[i] = True
+                        selector.unregister(probe)
+                    continue
+                # The banner might arrive in several segments
+                try:
+                    data = probe.recv(len(banner) - len(received[i]))
+                except socket.error:
+                    data = b''
+                received[i] += data
+                if not data or len(received[i]) == len(banner):
+                    results[i] = received[i] == banner
+                    selector.unregister(probe)
+    finally:
+        selector.close()
+        for probe in sockets:
+            probe.close()
+    return results
+
+
 def check_ssh_service(host, username, password):
     """
-    Check whether the ssh service is up or not on the target host
+    Check whether the ssh service is up or not on the target host. The ssh
+    banner is probed first, so the full login only happens once it answers
     :param host: SSH host
     :param username: SSH username
     :param password: SSH password
     """
+    if not probe_ports([(host, 22)], banner=b'SSH-')[0]:
+        return False
     with hide_std():
         with fabric_context(host, username, password):
             run('')
     return True
 
 
+def connect_ssh(host, username, password, timeout=None):
+    """
+    Open a dedicated ssh connection. Unlike fabric, which keeps its state in
+    a global environment, it can be used from several threads at once
+    :param host: SSH host
+    :param username: SSH username
+    :param password: SSH password
+    :param timeout: The connection timeout, in seconds, bounded by the
+    current deadline
+
+    :return: The connected paramiko client
+    """
+    timeout = call_timeout('SSH connection to "{}"'.format(host), timeout)
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    try:
+        client.connect(
+            host,
+            username=username,
+            password=password,
+            timeout=timeout,
+            allow_agent=False,
+            look_for_keys=False
+        )
+    except Exception:
+        client.close()
+        raise
+    return client
+
+
+def run_ssh_command(client, command, use_sudo=False, password=None):
+    """
+    Run a command through a paramiko client
+    :param client: The connected paramiko client
+    :param command: The command to be executed
+    :param use_sudo: If True, it runs as sudo
+    :param password: The sudo password
+
+    :return: A tuple with the status code, the stdout and the stderr
+    """
+    if use_sudo:
+        command = 'sudo -S -p "" sh -c {}'.format(shlex_quote(command))
+    stdin, stdout, stderr = client.exec_command(command)
+    if use_sudo:
+        stdin.write('{}\n'.format(password))
+        stdin.flush()
+    out = stdout.read().decode('utf-8', 'replace')
+    err = stderr.read().decode('utf-8', 'replace')
+    return stdout.channel.recv_exit_status(), out, err
+
+
 def check_winrm_service(host, username, password, **kwargs):
     """
-    Check whether the winrm service is up or not on the target host
+    Check whether the winrm service is up or not on the target host. The
+    winrm port is probed first, and then an authenticated WSMan Identify
+    request is sent once it answers
     :param host: WinRM host
     :param username: WinRM username
     :param password: WinRM password
     :param kwargs: pywinrm Protocol kwargs
     """
+    session = winrm.Session(host, (username, password), **kwargs)
+    url = urlsplit(session.url)
+    if not probe_ports([(url.hostname, url.port)])[0]:
+        return False
     with hide_std():
-        winrm.Session(host, (username, password), **kwargs).run_ps('ls')
+        session.protocol.send_message(_WSMAN_IDENTIFY)
     return True
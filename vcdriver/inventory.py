@@ -0,0 +1,301 @@
+import datetime
+import sqlite3
+
+from pyVmomi import vim, vmodl
+import six
+
+from vcdriver.session import connection as session_connection
+
+
+# The mirrored object types and their property paths
+MIRRORED_PROPERTIES = [
+    (vim.VirtualMachine, [
+        'name',
+        'parent',
+        'runtime.powerState',
+        'runtime.host',
+        'config.template',
+        'config.createDate',
+    ]),
+    (vim.Folder, ['name', 'parent']),
+    (vim.Datastore, ['name', 'parent']),
+    (vim.HostSystem, ['name', 'parent', 'runtime.powerState']),
+]
+
+# The column of each property path
+_COLUMNS = {
+    'name': 'name',
+    'parent': 'parent',
+    'runtime.powerState': 'power_state',
+    'runtime.host': 'host',
+    'config.template': 'template',
+    'config.createDate': 'created_at',
+}
+
+# The vcenter api version that introduced config.createDate
+_CREATE_DATE_VERSION = (6, 7)
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS objects (
+    moid TEXT PRIMARY KEY,
+    type TEXT NOT NULL,
+    name TEXT,
+    parent TEXT,
+    power_state TEXT,
+    host TEXT,
+    template INTEGER,
+    created_at TEXT
+);
+CREATE INDEX IF NOT EXISTS objects_type ON objects (type);
+CREATE INDEX IF NOT EXISTS objects_name ON objects (name);
+CREATE INDEX IF NOT EXISTS objects_parent ON objects (parent);
+CREATE INDEX IF NOT EXISTS objects_power_state ON objects (power_state);
+CREATE INDEX IF NOT EXISTS objects_created_at ON objects (created_at);
+'''
+
+
+class Inventory(object):
+    def __init__(self, path=':memory:'):
+        """
+        A local mirror of the virtual machines, folders, datastores and hosts
+        of vcenter in a SQLite database. The first sync retrieves all of them
+        at once, and the next ones only the changes since the previous sync,
+        so the queries never touch vcenter. The changes are tracked by a
+        property collector of this session, so the first sync of each mirror
+        object rebuilds the database, even if the file was synced before
+        :param path: The database file path, in memory by default
+
+        version: The property collector version of the last sync
+        _collector: The property collector of the mirror
+        _filter: The property filter of the collector
+        _view: The container view of the mirrored objects
+        """
+        self.path = path
+        self.version = None
+        self._collector = None
+        self._filter = None
+        self._view = None
+        self._db = sqlite3.connect(path)
+        self._db.row_factory = sqlite3.Row
+        self._db.executescript(_SCHEMA)
+
+    def sync(self, connection=None, wait=0):
+        """
+        Bring the mirror up to date. The first sync of this object rebuilds
+        the mirror from scratch
+        :param connection: A vcenter connection, the session one by default
+        :param wait: The seconds to wait for changes, if there are none yet
+
+        :return: The number of objects added, changed or removed
+        """
+        if self._collector is None:
+            self._create_collector(connection or session_connection())
+            self.version = ''
+            with self._db:
+                self._db.execute('DELETE FROM objects')
+        changed = 0
+        options = vmodl.query.PropertyCollector.WaitOptions(
+            maxWaitSeconds=wait
+        )
+        while True:
+            update = self._collector.WaitForUpdatesEx(self.version, options)
+            if not update:
+                break
+            with self._db:
+                for filter_update in update.filterSet:
+                    for object_update in filter_update.objectSet:
+                        self._apply(object_update)
+                        changed += 1
+                self.version = update.version
+            if not update.truncated:
+                break
+            # The rest of a truncated update is returned at once
+            options.maxWaitSeconds = 0
+        return changed
+
+    def find(
+            self,
+            object_type=None,
+            name=None,
+            folder=None,
+            power_state=None,
+            created_after=None,
+            created_before=None
+    ):
+        """
+        Query the mirror
+        :param object_type: The object type, like vim.VirtualMachine
+        :param name: The object name, or a glob pattern like "ci-*"
+        :param folder: The name of the parent folder
+        :param power_state: The power state, like "poweredOn"
+        :param created_after: The earliest creation timestamp, as an ISO 8601
+        string or a datetime, in UTC if naive
+        :param created_before: The latest creation timestamp, as an ISO 8601
+        string or a datetime, in UTC if naive
+
+        :return: A list with a dictionary of the mirrored columns of each
+        object (moid, type, name, parent, power_state, host, template and
+        created_at), sorted by name. The creation timestamp is only known
+        from vcenter 6.7 on, and the objects without one never match the
+        creation filters
+        """
+        conditions = []
+        values = []
+        if object_type is not None:
+            conditions.append('type = ?')
+            values.append(_type_name(object_type))
+        if name is not None:
+            conditions.append('name GLOB ?')
+            values.append(name)
+        if folder is not None:
+            conditions.append(
+                'parent IN (SELECT moid FROM objects '
+                'WHERE type = ? AND name = ?)'
+            )
+            values.extend([_type_name(vim.Folder), folder])
+        if power_state is not None:
+            conditions.append('power_state = ?')
+            values.append(power_state)
+        if created_after is not None:
+            conditions.append('created_at >= ?')
+            values.append(_timestamp(created_after))
+        if created_before is not None:
+            conditions.append('created_at <= ?')
+            values.append(_timestamp(created_before))
+        query = 'SELECT * FROM objects'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        return [
+            dict(row) for row in self._db.execute(
+                query + ' ORDER BY name, moid', values
+            )
+        ]
+
+    def get(self, moid):
+        """
+        Get a mirrored object
+        :param moid: The managed object id, like "vm-42"
+
+        :return: The dictionary of its mirrored columns, or None
+        """
+        row = self._db.execute(
+            'SELECT * FROM objects WHERE moid = ?', (moid,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def close(self):
+        """ Stop mirroring and close the database """
+        if self._collector is not None:
+            self._filter.Destroy()
+            self._view.Destroy()
+            self._collector.DestroyPropertyCollector()
+            self._collector = self._filter = self._view = None
+        self._db.close()
+
+    def _create_collector(self, connection):
+        """
+        Create the private property collector of the mirror, watching all
+        the mirrored objects of the inventory through a container view
+        :param connection: A vcenter connection
+        """
+        content = connection.RetrieveContent()
+        create_date = _api_version(
+            content.about.apiVersion
+        ) >= _CREATE_DATE_VERSION
+        self._view = content.viewManager.CreateContainerView(
+            content.rootFolder,
+            [object_type for object_type, _ in MIRRORED_PROPERTIES],
+            True
+        )
+        self._collector = content.propertyCollector.CreatePropertyCollector()
+        self._filter = self._collector.CreateFilter(
+            vmodl.query.PropertyCollector.FilterSpec(
+                objectSet=[vmodl.query.PropertyCollector.ObjectSpec(
+                    obj=self._view,
+                    skip=True,
+                    selectSet=[
+                        vmodl.query.PropertyCollector.TraversalSpec(
+                            name='view',
+                            path='view',
+                            skip=False,
+                            type=vim.view.ContainerView
+                        )
+                    ]
+                )],
+                propSet=[
+                    vmodl.query.PropertyCollector.PropertySpec(
+                        type=object_type,
+                        pathSet=[
+                            path for path in property_paths
+                            if create_date or path != 'config.createDate'
+                        ]
+                    )
+                    for object_type, property_paths in MIRRORED_PROPERTIES
+                ]
+            ),
+            partialUpdates=True
+        )
+
+    def _apply(self, object_update):
+        """
+        Apply the update of an object to the mirror
+        :param object_update: The object update
+        (vmodl.query.PropertyCollector.ObjectUpdate)
+        """
+        moid = object_update.obj._moId
+        if object_update.kind == 'leave':
+            self._db.execute('DELETE FROM objects WHERE moid = ?', (moid,))
+            return
+        if object_update.kind == 'enter':
+            self._db.execute(
+                'INSERT OR REPLACE INTO objects (moid, type) VALUES (?, ?)',
+                (moid, _type_name(type(object_update.obj)))
+            )
+        for change in object_update.changeSet:
+            column = _COLUMNS.get(change.name)
+            if column:
+                value = None
+                if change.op != 'remove':
+                    value = change.val
+                    if isinstance(value, vim.ManagedObject):
+                        value = value._moId
+                    elif isinstance(value, datetime.datetime):
+                        value = _timestamp(value)
+                self._db.execute(
+                    'UPDATE objects SET {} = ? WHERE moid = ?'.format(column),
+                    (value, moid)
+                )
+
+
+def _type_name(object_type):
+    """
+    Get the mirrored name of an object type
+    :param object_type: The object type, like vim.VirtualMachine
+
+    :return: The type name, like "VirtualMachine"
+    """
+    return object_type.__name__.split('.')[-1]
+
+
+def _api_version(version):
+    """
+    Parse a vcenter api version
+    :param version: The version, like "6.7.3"
+
+    :return: A tuple of its numbers, like (6, 7, 3)
+    """
+    return tuple(int(number) for number in version.split('.'))
+
+
+def _timestamp(value):
+    """
+    Get the mirrored form of a creation timestamp
+    :param value: An ISO 8601 string or a datetime, in UTC if naive
+
+    :return: The ISO 8601 string, in UTC
+    """
+    if isinstance(value, six.string_types):
+        return value
+    if value.utcoffset() is not None:
+        value = (value - value.utcoffset()).replace(tzinfo=None)
+    return value.isoformat()
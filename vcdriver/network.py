@@ -0,0 +1,237 @@
+import json
+import os
+import re
+import socket
+import struct
+import tempfile
+import threading
+
+from pyVmomi import vim
+from six.moves import range
+
+from vcdriver.exceptions import IpPoolExhausted
+from vcdriver.helpers import file_lock
+
+
+# The ip pools created by this process, by leases file
+_pools_lock = threading.Lock()
+_pools = {}
+
+
+class IpPool(object):
+    def __init__(
+            self,
+            network,
+            gateway=None,
+            dns_servers=(),
+            domain='',
+            exclude=(),
+            windows=False,
+            leases_path=None
+    ):
+        """
+        A pool of static IPv4 addresses to customize the cloned guests with,
+        so their ip is known without waiting for the Vmware tools. The leases
+        are kept in a json file that is locked while it is updated, so the
+        concurrent processes of this machine never get the same address
+        :param network: The network in CIDR notation, like "10.0.0.0/24"
+        :param gateway: The default gateway, by default the first address
+        :param dns_servers: The dns server addresses
+        :param domain: The domain of the guests
+        :param exclude: Addresses that must not be leased
+        :param windows: Whether the guests are windows (Sysprep) or linux
+        :param leases_path: The leases file, by default one per network in
+        the temporary directory
+        """
+        address, prefix = network.split('/')
+        mask = (0xffffffff << (32 - int(prefix))) & 0xffffffff
+        first = _ip_to_int(address) & mask
+        broadcast = first | (~mask & 0xffffffff)
+        self.network = network
+        self.subnet_mask = _int_to_ip(mask)
+        self.gateway = gateway or _int_to_ip(first + 1)
+        self.dns_servers = list(dns_servers)
+        self.domain = domain
+        self.windows = windows
+        self.leases_path = leases_path or os.path.join(
+            tempfile.gettempdir(),
+            'vcdriver-ip-pool-{}.json'.format(network.replace('/', '-'))
+        )
+        self._excluded = set(exclude) | {self.gateway}
+        self._hosts = range(first + 1, broadcast)
+        with _pools_lock:
+            _pools[self.leases_path] = self
+
+    def allocate(self, owner):
+        """
+        Lease the first free address of the pool
+        :param owner: The owner of the lease, like the vm name
+
+        :return: The address
+
+        :raise: IpPoolExhausted: If all the addresses are leased
+        """
+        with file_lock(self.leases_path + '.lock'):
+            leases = self._read_leases()
+            for number in self._hosts:
+                address = _int_to_ip(number)
+                if address not in leases and address not in self._excluded:
+                    leases[address] = owner
+                    self._write_leases(leases)
+                    return address
+        raise IpPoolExhausted(self.network)
+
+    def release(self, address):
+        """
+        Give an address back to the pool
+        :param address: The address
+        """
+        with file_lock(self.leases_path + '.lock'):
+            leases = self._read_leases()
+            if leases.pop(address, None) is not None:
+                self._write_leases(leases)
+
+    def release_owner(self, owner):
+        """
+        Give back all the addresses leased to an owner, whichever process
+        leased them
+        :param owner: The owner of the leases, like the vm name
+
+        :return: The list of addresses released
+        """
+        with file_lock(self.leases_path + '.lock'):
+            leases = self._read_leases()
+            released = sorted(
+                address for address, lease_owner in leases.items()
+                if lease_owner == owner
+            )
+            if released:
+                for address in released:
+                    del leases[address]
+                self._write_leases(leases)
+        return released
+
+    def customization(self, address, hostname):
+        """
+        Build the guest customization of a clone with a static address
+        :param address: The address leased for the clone
+        :param hostname: The guest host name, sanitized and truncated as
+        needed
+
+        :return: The customization spec (vim.vm.customization.Specification)
+        """
+        name = vim.vm.customization.FixedName(name=re.sub(
+            '[^a-zA-Z0-9-]', '-', hostname
+        )[:15 if self.windows else 63].strip('-') or 'vcdriver')
+        if self.windows:
+            identity = vim.vm.customization.Sysprep(
+                guiUnattended=vim.vm.customization.GuiUnattended(
+                    autoLogon=False, autoLogonCount=0, timeZone=85
+                ),
+                userData=vim.vm.customization.UserData(
+                    computerName=name,
+                    fullName='vcdriver',
+                    orgName='vcdriver',
+                    productId=''
+                ),
+                identification=vim.vm.customization.Identification(
+                    joinWorkgroup='WORKGROUP'
+                )
+            )
+        else:
+            identity = vim.vm.customization.LinuxPrep(
+                hostName=name, domain=self.domain
+            )
+        return vim.vm.customization.Specification(
+            identity=identity,
+            globalIPSettings=vim.vm.customization.GlobalIPSettings(
+                dnsServerList=self.dns_servers
+            ),
+            nicSettingMap=[vim.vm.customization.AdapterMapping(
+                adapter=vim.vm.customization.IPSettings(
+                    ip=vim.vm.customization.FixedIp(ipAddress=address),
+                    subnetMask=self.subnet_mask,
+                    gateway=[self.gateway],
+                    dnsDomain=self.domain
+                )
+            )]
+        )
+
+    def _read_leases(self):
+        """
+        Read the leases file, while holding its lock
+
+        :return: A dictionary mapping the leased addresses to their owners
+        """
+        try:
+            with open(self.leases_path) as leases_file:
+                return json.load(leases_file)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _write_leases(self, leases):
+        """
+        Write the leases file, while holding its lock
+        :param leases: A dictionary mapping the leased addresses to their
+        owners
+        """
+        with open(self.leases_path, 'w') as leases_file:
+            json.dump(leases, leases_file, indent=2, sort_keys=True)
+
+    def __str__(self):
+        return self.network
+
+    def __repr__(self):
+        return str(self)
+
+
+def release_leases(owner):
+    """
+    Give back the addresses leased to an owner in the leases files of all the
+    ip pools created by this process, so the leases of a vm are released even
+    by another VirtualMachine object or process than the one that leased them
+    :param owner: The owner of the leases, like the vm name
+
+    :return: The list of addresses released
+    """
+    with _pools_lock:
+        pools = list(_pools.values())
+    released = []
+    for pool in pools:
+        if os.path.exists(pool.leases_path):
+            released.extend(pool.release_owner(owner))
+    return released
+
+
+def customization_ip(customization):
+    """
+    Get the static address of the first network adapter of a customization
+    :param customization: The customization spec
+    (vim.vm.customization.Specification)
+
+    :return: The address, or None if it is not static
+    """
+    if customization.nicSettingMap:
+        ip = customization.nicSettingMap[0].adapter.ip
+        if isinstance(ip, vim.vm.customization.FixedIp):
+            return ip.ipAddress
+
+
+def _ip_to_int(address):
+    """
+    Convert an IPv4 address to an integer
+    :param address: The address, like "10.0.0.1"
+
+    :return: The integer
+    """
+    return struct.unpack('!I', socket.inet_aton(address))[0]
+
+
+def _int_to_ip(number):
+    """
+    Convert an integer to an IPv4 address
+    :param number: The integer
+
+    :return: The address, like "10.0.0.1"
+    """
+    return socket.inet_ntoa(struct.pack('!I', number))
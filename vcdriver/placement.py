@@ -0,0 +1,423 @@
+from __future__ import print_function
+
+import contextlib
+import fnmatch
+import os
+import re
+import tempfile
+import threading
+
+from pyVmomi import vim
+import six
+
+from vcdriver.admission import admit
+from vcdriver.config import configurable
+from vcdriver.exceptions import NoObjectFound, NotEnoughDiskSpace
+from vcdriver.helpers import (
+    file_lock,
+    get_inventory_properties,
+    get_properties,
+    get_vcenter_object_by_name,
+    wait_for_vcenter_task,
+)
+from vcdriver.session import connection
+
+
+# Clones in flight from this process for each datastore and host
+_in_flight_lock = threading.Lock()
+_in_flight = {}
+
+# Locks for the template replicas being checked or created by this process
+_replica_locks_lock = threading.Lock()
+_replica_locks = {}
+
+# The host properties available to the host scoring functions
+HOST_PROPERTIES = [
+    'name',
+    'runtime.connectionState',
+    'runtime.inMaintenanceMode',
+    'summary.hardware.cpuMhz',
+    'summary.hardware.numCpuCores',
+    'summary.hardware.memorySize',
+    'summary.quickStats.overallCpuUsage',
+    'summary.quickStats.overallMemoryUsage',
+]
+
+
+def find_data_stores(connection, data_store, resource_pool=None):
+    """
+    Find the datastores matching a placement specification, retrieving their
+    capacity and free space in a single call
+    :param connection: A vcenter connection
+    :param data_store: A comma separated list of datastore names, glob
+    patterns like "ssd-*" or datastore cluster names, or a list of them for
+    names with commas. A name always matches itself, even if it has glob
+    characters
+    :param resource_pool: The resource pool (vim.ResourcePool) of the clones.
+    If set, only the datastores of its compute resource match
+
+    :return: A list of (datastore, properties) tuples, where the properties
+    are a dictionary with the name, summary.capacity, summary.freeSpace and
+    summary.accessible of the datastore
+    """
+    if isinstance(data_store, six.string_types):
+        data_store = data_store.split(',')
+    patterns = [pattern.strip() for pattern in data_store if pattern.strip()]
+    property_specs = [
+        (vim.Datastore, [
+            'name',
+            'summary.capacity',
+            'summary.freeSpace',
+            'summary.accessible'
+        ]),
+        (vim.StoragePod, ['name', 'childEntity'])
+    ]
+    if resource_pool is not None:
+        owner = resource_pool.owner
+        property_specs.append((vim.ComputeResource, ['datastore']))
+    data_stores = []
+    storage_pods = []
+    reachable = []
+    for obj, properties in get_inventory_properties(
+            connection, property_specs
+    ):
+        if isinstance(obj, vim.StoragePod):
+            storage_pods.append(properties)
+        elif isinstance(obj, vim.ComputeResource):
+            if obj == owner:
+                reachable = properties.get('datastore', [])
+        else:
+            data_stores.append((obj, properties))
+    if resource_pool is not None:
+        data_stores = [
+            (obj, properties) for obj, properties in data_stores
+            if obj in reachable
+        ]
+    matched = set()
+    unmatched = []
+    for pattern in patterns:
+        matches = [
+            i for i, (_, properties) in enumerate(data_stores)
+            if properties.get('name') == pattern or fnmatch.fnmatchcase(
+                properties.get('name', ''), pattern
+            )
+        ]
+        if matches:
+            matched.update(matches)
+        else:
+            unmatched.append(pattern)
+    for pod_properties in storage_pods:
+        if pod_properties.get('name') in unmatched:
+            children = pod_properties.get('childEntity', [])
+            matched.update(
+                i for i, (obj, _) in enumerate(data_stores) if obj in children
+            )
+    return [
+        data_stores[i] for i in sorted(matched)
+        if data_stores[i][1].get('summary.accessible', True)
+    ]
+
+
+def select_data_store(connection, data_store, threshold, resource_pool=None):
+    """
+    Select the best datastore of a placement specification and count a new
+    clone in flight on it. Datastores below the free space threshold are
+    discarded, then the one with the least clones in flight from this process
+    is chosen, and the most free space breaks ties, so parallel clones are
+    spread across the datastores
+    :param connection: A vcenter connection
+    :param data_store: The placement specification, see find_data_stores
+    :param threshold: The minimum free space percentage
+    :param resource_pool: The resource pool of the clones, see
+    find_data_stores
+
+    :return: The datastore chosen. Call release_data_store when the clone
+    finishes
+
+    :raise: NoObjectFound: If no datastore matches the specification
+    :raise: NotEnoughDiskSpace: If all the datastores are below the threshold
+    """
+    candidates = []
+    for obj, properties in find_data_stores(
+            connection, data_store, resource_pool
+    ):
+        capacity = float(properties.get('summary.capacity', 0))
+        free_space = float(properties.get('summary.freeSpace', 0))
+        free_percentage = 100 * free_space / capacity if capacity else 0
+        candidates.append(
+            (obj, properties['name'], free_space, free_percentage)
+        )
+    if not candidates:
+        raise NoObjectFound(vim.Datastore, data_store)
+    eligible = [
+        candidate for candidate in candidates
+        if candidate[3] >= float(threshold)
+    ]
+    if not eligible:
+        best = max(candidates, key=lambda candidate: candidate[3])
+        raise NotEnoughDiskSpace(best[1], threshold, best[3])
+    with _in_flight_lock:
+        obj = max(eligible, key=lambda candidate: (
+            -_in_flight.get(candidate[0], 0), candidate[2]
+        ))[0]
+        _in_flight[obj] = _in_flight.get(obj, 0) + 1
+    return obj
+
+
+def release_data_store(data_store):
+    """
+    Stop counting a clone in flight on a datastore
+    :param data_store: The datastore returned by select_data_store
+    """
+    _release(data_store)
+
+
+@contextlib.contextmanager
+def data_store_placement(
+        connection, data_store, threshold, resource_pool=None
+):
+    """
+    Select the best datastore for a clone within a context, see
+    select_data_store
+    :param connection: A vcenter connection
+    :param data_store: The placement specification, see find_data_stores
+    :param threshold: The minimum free space percentage
+    :param resource_pool: The resource pool of the clones, see
+    find_data_stores
+
+    :yield: The datastore chosen
+    """
+    obj = select_data_store(connection, data_store, threshold, resource_pool)
+    try:
+        yield obj
+    finally:
+        release_data_store(obj)
+
+
+def default_host_score(properties, in_flight):
+    """
+    Score a host by its cpu and memory usage ratios, each clone in flight on
+    it counting as a fully used resource, so the load is spread evenly
+    :param properties: The host properties, see HOST_PROPERTIES
+    :param in_flight: The number of clones in flight from this process
+
+    :return: The score, the lower the better
+    """
+    cpu_capacity = properties.get('summary.hardware.cpuMhz', 0) * (
+        properties.get('summary.hardware.numCpuCores', 0)
+    )
+    memory_capacity = properties.get('summary.hardware.memorySize', 0)
+    cpu = properties.get('summary.quickStats.overallCpuUsage', 0)
+    # The memory usage is in MB, while the memory size is in bytes
+    memory = properties.get(
+        'summary.quickStats.overallMemoryUsage', 0
+    ) * 1024 * 1024
+    return (
+        (float(cpu) / cpu_capacity if cpu_capacity else 1) +
+        (float(memory) / memory_capacity if memory_capacity else 1) +
+        in_flight
+    )
+
+
+def select_host(
+        connection, resource_pool, score=default_host_score, data_store=None
+):
+    """
+    Select the best host for a clone in the compute resource of a resource
+    pool and count a new clone in flight on it. Disconnected hosts, hosts in
+    maintenance mode and hosts without access to the datastore are discarded
+    :param connection: A vcenter connection
+    :param resource_pool: The resource pool (vim.ResourcePool)
+    :param score: The scoring function, called with the host properties and
+    its clones in flight from this process. The lowest score wins
+    :param data_store: The datastore of the clone (vim.Datastore), if any
+
+    :return: The host chosen. Call release_host when the clone finishes
+
+    :raise: NoObjectFound: If there is no available host
+    """
+    hosts = resource_pool.owner.host
+    candidates = [
+        (obj, properties)
+        for obj, properties in zip(hosts, get_properties(
+            connection,
+            hosts,
+            vim.HostSystem,
+            HOST_PROPERTIES + (['datastore'] if data_store else [])
+        ))
+        if properties.get('runtime.connectionState') == 'connected' and
+        not properties.get('runtime.inMaintenanceMode') and
+        (not data_store or data_store in properties.get('datastore', []))
+    ]
+    if not candidates:
+        raise NoObjectFound(vim.HostSystem, resource_pool.name)
+    with _in_flight_lock:
+        obj = min(candidates, key=lambda candidate: score(
+            candidate[1], _in_flight.get(candidate[0], 0)
+        ))[0]
+        _in_flight[obj] = _in_flight.get(obj, 0) + 1
+    return obj
+
+
+def release_host(host):
+    """
+    Stop counting a clone in flight on a host
+    :param host: The host returned by select_host
+    """
+    _release(host)
+
+
+@contextlib.contextmanager
+def host_placement(
+        connection, resource_pool, score=default_host_score, data_store=None
+):
+    """
+    Select the best host for a clone within a context, see select_host
+    :param connection: A vcenter connection
+    :param resource_pool: The resource pool (vim.ResourcePool)
+    :param score: The scoring function, see select_host. If None, no host is
+    selected and vcenter places the clone
+    :param data_store: The datastore of the clone (vim.Datastore), if any
+
+    :yield: The host chosen, or None
+    """
+    obj = score and select_host(connection, resource_pool, score, data_store)
+    try:
+        yield obj
+    finally:
+        if obj:
+            release_host(obj)
+
+
+@configurable([
+    ('Virtual Machine Deployment', 'vcdriver_resource_pool'),
+    ('Virtual Machine Deployment', 'vcdriver_data_store'),
+    ('Virtual Machine Deployment', 'vcdriver_data_store_threshold')
+])
+def plan_placement(vms, host_score=default_host_score, **kwargs):
+    """
+    Print where a list of virtual machines would be cloned if they were
+    created at once, without cloning them
+    :param vms: The list of virtual machines (VirtualMachine)
+    :param host_score: The host scoring function, see select_host. If None,
+    only the datastores are planned
+
+    :return: A list with a (vm, host name, datastore name) tuple for each vm
+    """
+    conn = connection()
+    resource_pool = get_vcenter_object_by_name(
+        conn, vim.ResourcePool, kwargs['vcdriver_resource_pool']
+    )
+    selected = []
+    plan = []
+    try:
+        for vm in vms:
+            data_store = select_data_store(
+                conn,
+                kwargs['vcdriver_data_store'],
+                kwargs['vcdriver_data_store_threshold'],
+                resource_pool
+            )
+            selected.append(data_store)
+            host = host_score and select_host(
+                conn, resource_pool, host_score, data_store
+            )
+            if host:
+                selected.append(host)
+            plan.append((vm, host.name if host else None, data_store.name))
+    finally:
+        for obj in selected:
+            _release(obj)
+    for vm, host_name, data_store_name in plan:
+        print('{}: {} / {}'.format(vm, host_name or '-', data_store_name))
+    return plan
+
+
+def template_replica(connection, template, data_store, timeout):
+    """
+    Get the replica of a template on a datastore, so clones there do not copy
+    the disks across datastores. The replica is a template named
+    "<template>-replica-<datastore>" created on demand, and its annotation
+    records the source template instance uuid and change version, so it is
+    created again when the source template changes. The replica is checked,
+    destroyed and created under a lock file shared by all the processes of
+    this machine
+    :param connection: A vcenter connection
+    :param template: The template name
+    :param data_store: The datastore (vim.Datastore)
+    :param timeout: The timeout for the replica tasks
+
+    :return: The template itself if it is already on the datastore, or else
+    its replica
+    """
+    template_object = get_vcenter_object_by_name(
+        connection, vim.VirtualMachine, template
+    )
+    properties = get_properties(
+        connection,
+        [template_object],
+        vim.VirtualMachine,
+        ['config.instanceUuid', 'config.changeVersion', 'datastore', 'parent']
+    )[0]
+    if data_store in properties.get('datastore', []):
+        return template_object
+    name = '{}-replica-{}'.format(template, get_properties(
+        connection, [data_store], vim.Datastore, ['name']
+    )[0]['name'])
+    fingerprint = 'Replica of template "{}" {} {}'.format(
+        template,
+        properties.get('config.instanceUuid'),
+        properties.get('config.changeVersion')
+    )
+    with _replica_locks_lock:
+        lock = _replica_locks.setdefault(name, threading.Lock())
+    with lock, file_lock(os.path.join(
+        tempfile.gettempdir(),
+        'vcdriver-{}.lock'.format(re.sub(r'[^\w.-]', '-', name))
+    )):
+        try:
+            replica = get_vcenter_object_by_name(
+                connection, vim.VirtualMachine, name
+            )
+        except NoObjectFound:
+            replica = None
+        if replica is not None:
+            annotation = get_properties(
+                connection,
+                [replica],
+                vim.VirtualMachine,
+                ['config.annotation']
+            )[0].get('config.annotation')
+            if annotation == fingerprint:
+                return replica
+            wait_for_vcenter_task(
+                replica.Destroy_Task(),
+                'Destroy outdated template replica "{}"'.format(name),
+                timeout
+            )
+        with admit('clone', data_store=data_store):
+            return wait_for_vcenter_task(
+                template_object.CloneVM_Task(
+                    folder=properties['parent'],
+                    name=name,
+                    spec=vim.vm.CloneSpec(
+                        location=vim.vm.RelocateSpec(datastore=data_store),
+                        config=vim.vm.ConfigSpec(annotation=fingerprint),
+                        powerOn=False,
+                        template=True
+                    )
+                ),
+                'Create template replica "{}"'.format(name),
+                timeout
+            )
+
+
+def _release(obj):
+    """
+    Stop counting a clone in flight on a datastore or a host
+    :param obj: The datastore or host
+    """
+    with _in_flight_lock:
+        _in_flight[obj] -= 1
+        if not _in_flight[obj]:
+            del _in_flight[obj]
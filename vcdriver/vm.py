@@ -3,14 +3,20 @@ from __future__ import print_function
 import base64
 import contextlib
 import datetime
+import ntpath
 import os
+import posixpath
 import sys
+import tempfile
 import time
 import uuid
+import zipfile
 
 from colorama import Style, Fore
 from fabric.api import sudo, run, get, put, hide
-from pyVmomi import vim
+from pyVmomi import vim, vmodl
+import requests
+from six.moves import shlex_quote
 import winrm
 
 from vcdriver.config import configurable
@@ -19,46 +25,127 @@ from vcdriver.exceptions import (
     WinRmError,
     UploadError,
     DownloadError,
+    GuestError,
+    HandleError,
     NoObjectFound,
     TooManyObjectsFound,
-    NotEnoughDiskSpace,
     TimeoutError
 )
+from vcdriver.admission import admit, get_controller
 from vcdriver.helpers import (
-    get_all_vcenter_objects,
+    CANCEL_GRACE,
+    call_timeout,
+    diff_manifests,
+    get_inventory_properties,
+    get_local_manifest,
+    get_properties,
     get_vcenter_object_by_name,
+    grace_period,
+    guest_file_url,
+    parse_manifest,
+    remaining_time,
     styled_print,
     timeout_loop,
     validate_ip,
+    wait_for_properties,
     wait_for_vcenter_task,
     fabric_context,
     check_ssh_service,
     check_winrm_service,
 )
+from vcdriver.network import IpPool, customization_ip, release_leases
+from vcdriver.placement import (
+    data_store_placement,
+    host_placement,
+    template_replica,
+)
 from vcdriver.session import (
     connection,
     close,
     )
 
+try:
+    from collections.abc import Mapping
+except ImportError:  # pragma: no cover
+    from collections import Mapping
+
+
+# The longest command line accepted by cmd.exe, which runs winrm scripts
+_WINRM_COMMAND_LIMIT = 8191
+
+# The guest operations faults that retrying does not fix
+_GUEST_AUTH_FAULTS = (
+    vim.fault.InvalidGuestLogin,
+    vim.fault.GuestPermissionDenied,
+)
+
+# The properties retrieved by VirtualMachine.state by default
+STATE_PROPERTIES = [
+    'name',
+    'runtime.powerState',
+    'runtime.host',
+    'guest.ipAddress',
+    'guest.toolsRunningStatus',
+    'config.guestId',
+    'config.changeVersion',
+]
+
+
+class VirtualMachineState(Mapping):
+    def __init__(self, properties):
+        """
+        A read-only record of some properties of a virtual machine, retrieved
+        together. It maps each property path to its value, the unset
+        properties being missing
+        :param properties: The dictionary of property paths and values
+        """
+        self._properties = dict(properties)
+
+    def __getitem__(self, path):
+        return self._properties[path]
+
+    def __iter__(self):
+        return iter(self._properties)
+
+    def __len__(self):
+        return len(self._properties)
+
+    def __str__(self):
+        return str(self._properties)
+
+    def __repr__(self):
+        return str(self)
+
 
 class VirtualMachine(object):
     def __init__(
             self,
             name=None,
             template=None,
-            timeout=3600
+            timeout=3600,
+            cancel_on_timeout=False
     ):
         """
         :param name: The virtual machine name
         :param template: The virtual machine template name to be cloned
         :param timeout: The timeout for the tasks
+        :param cancel_on_timeout: Whether to cancel the clone and snapshot
+        tasks that time out, instead of leaving them running on vcenter. A
+        clone that completes anyway is destroyed
 
         _vm_object: An internal instance of the vcenter vm object
+        _snapshots: An internal cache of the snapshot tree index
+        _ip: The static ip assigned by the guest customization, if any
+        _ip_pool: The ip pool the static ip was leased from, if any
         """
         self.name = name or str(uuid.uuid4())
         self.template = template
         self.timeout = timeout
+        self.cancel_on_timeout = cancel_on_timeout
         self._vm_object = None
+        self._snapshots = None
+        self._ip = None
+        self._ip_pool = None
 
     @configurable([
         ('Virtual Machine Deployment', 'vcdriver_resource_pool'),
@@ -66,50 +153,93 @@ class VirtualMachine(object):
         ('Virtual Machine Deployment', 'vcdriver_data_store_threshold'),
         ('Virtual Machine Deployment', 'vcdriver_folder')
     ])
-    def create(self, **kwargs):
-        """ Create the virtual machine and update the vm object """
+    def create(
+            self,
+            host_score=None,
+            replicate_template=False,
+            customization=None,
+            **kwargs
+    ):
+        """
+        Create the virtual machine and update the vm object. The datastore
+        setting accepts a comma separated list of names, glob patterns or
+        datastore clusters, or a list of them, and the best datastore of the
+        resource pool compute resource is chosen for each clone, see
+        vcdriver.placement.find_data_stores
+        :param host_score: A host scoring function to choose the host of the
+        clone in the resource pool cluster, like
+        vcdriver.placement.default_host_score. By default vcenter chooses
+        :param replicate_template: Whether to clone from a replica of the
+        template on the chosen datastore, see
+        vcdriver.placement.template_replica
+        :param customization: A guest customization spec, or an ip pool
+        (vcdriver.network.IpPool) to lease a static ip from. With a static ip,
+        the ip function returns it without waiting for the Vmware tools
+        """
         conn = connection()
         if not self._vm_object:
-            data_store_name = kwargs['vcdriver_data_store']
-            data_store = get_vcenter_object_by_name(
-                conn,
-                vim.Datastore,
-                data_store_name
-            )
-            capacity = float(data_store.summary.capacity)
-            free_space = float(data_store.summary.freeSpace)
-            free_percentage = 100 * free_space / capacity
-            threshold = kwargs['vcdriver_data_store_threshold']
-            if free_percentage < float(threshold):
-                raise NotEnoughDiskSpace(
-                    data_store_name, threshold, free_percentage
+            if isinstance(customization, IpPool):
+                self._ip_pool = customization
+                customization = customization.customization(
+                    customization.allocate(self.name), self.name
                 )
-            self._vm_object = wait_for_vcenter_task(
-                get_vcenter_object_by_name(
-                    conn, vim.VirtualMachine, self.template
-                ).CloneVM_Task(
-                    folder=get_vcenter_object_by_name(
-                        conn, vim.Folder, kwargs['vcdriver_folder']
-                    ),
-                    name=self.name,
-                    spec=vim.vm.CloneSpec(
-                        location=vim.vm.RelocateSpec(
-                            datastore=data_store,
-                            pool=get_vcenter_object_by_name(
-                                conn,
-                                vim.ResourcePool,
-                                kwargs['vcdriver_resource_pool']
-                            )
+            self._ip = customization and customization_ip(customization)
+            try:
+                self._clone(
+                    conn, host_score, replicate_template, customization, kwargs
+                )
+            except Exception:
+                self._release_ip()
+                raise
+
+    def reuse(self, baseline='vcdriver-baseline', **kwargs):
+        """
+        Reuse the virtual machine with the same name by reverting it to its
+        baseline snapshot and powering it on. If it does not exist, its
+        baseline is missing or the template changed since the baseline was
+        taken, the virtual machine is created again with a new baseline
+        :param baseline: The name of the baseline snapshot
+
+        :return: True if the virtual machine was reused, False if created
+        """
+        conn = connection()
+        template_properties = get_properties(
+            conn,
+            [get_vcenter_object_by_name(
+                conn, vim.VirtualMachine, self.template
+            )],
+            vim.VirtualMachine,
+            ['config.instanceUuid', 'config.changeVersion']
+        )[0]
+        fingerprint = 'Template "{}" {} {}'.format(
+            self.template,
+            template_properties.get('config.instanceUuid'),
+            template_properties.get('config.changeVersion')
+        )
+        if not self._vm_object:
+            try:
+                self.find()
+            except NoObjectFound:
+                pass
+        if self._vm_object:
+            trees = self._snapshot_index()[0].get(baseline, [])
+            if len(trees) == 1 and trees[0].description == fingerprint:
+                with self._admit('snapshot'):
+                    wait_for_vcenter_task(
+                        trees[0].snapshot.RevertToSnapshot_Task(),
+                        'Restoring snapshot "{}" on "{}"'.format(
+                            baseline, self.name
                         ),
-                        powerOn=True,
-                        template=False
+                        self.timeout
                     )
-                ),
-                'Create virtual machine "{}" from template "{}"'.format(
-                    self.name, self.template
-                ),
-                self.timeout
-            )
+                self.power_on()
+                return True
+            self.destroy()
+        self.create(**kwargs)
+        self.power_off()
+        self.create_snapshot(baseline, False, fingerprint)
+        self.power_on()
+        return False
 
     def find(self):
         """ Find and update the vm object based on the name """
@@ -122,31 +252,180 @@ class VirtualMachine(object):
         """ Close session and create a new session """
         if self._vm_object:
             close()
+            self._snapshots = None
             # Refresh object with updated data (connection id changed)
             self._vm_object = get_vcenter_object_by_name(
                 connection(), vim.VirtualMachine, self.name
                 )
 
+    @classmethod
+    def find_by_inventory_path(cls, path, **kwargs):
+        """
+        Find a virtual machine by its inventory path with a single indexed
+        call, instead of scanning the inventory
+        :param path: The inventory path, like "datacenter/vm/folder/name"
+        :param kwargs: The other virtual machine arguments, like the timeout
+
+        :return: The virtual machine (VirtualMachine)
+
+        :raise: NoObjectFound: If no virtual machine is found
+        """
+        return cls._bind(
+            cls._search_index().FindByInventoryPath(path), path, kwargs
+        )
+
+    @classmethod
+    def find_by_uuid(cls, vm_uuid, instance_uuid=False, **kwargs):
+        """
+        Find a virtual machine by its uuid with a single indexed call
+        :param vm_uuid: The uuid
+        :param instance_uuid: Whether it is the vcenter instance uuid, or
+        the BIOS uuid
+        :param kwargs: The other virtual machine arguments, like the timeout
+
+        :return: The virtual machine (VirtualMachine)
+
+        :raise: TooManyObjectsFound: If more than one is found
+        :raise: NoObjectFound: If no virtual machine is found
+        """
+        return cls._bind_one(
+            cls._search_index().FindAllByUuid(
+                uuid=vm_uuid, vmSearch=True, instanceUuid=instance_uuid
+            ),
+            vm_uuid,
+            kwargs
+        )
+
+    @classmethod
+    def find_by_ip(cls, ip, **kwargs):
+        """
+        Find a virtual machine by its guest ip with a single indexed call.
+        The Vmware tools must be running on the guest
+        :param ip: The ip
+        :param kwargs: The other virtual machine arguments, like the timeout
+
+        :return: The virtual machine (VirtualMachine)
+
+        :raise: TooManyObjectsFound: If more than one is found
+        :raise: NoObjectFound: If no virtual machine is found
+        """
+        return cls._bind_one(
+            cls._search_index().FindAllByIp(ip=ip, vmSearch=True), ip, kwargs
+        )
+
+    @classmethod
+    def find_by_dns_name(cls, dns_name, **kwargs):
+        """
+        Find a virtual machine by its guest dns name with a single indexed
+        call. The Vmware tools must be running on the guest
+        :param dns_name: The fully qualified dns name
+        :param kwargs: The other virtual machine arguments, like the timeout
+
+        :return: The virtual machine (VirtualMachine)
+
+        :raise: TooManyObjectsFound: If more than one is found
+        :raise: NoObjectFound: If no virtual machine is found
+        """
+        return cls._bind_one(
+            cls._search_index().FindAllByDnsName(
+                dnsName=dns_name, vmSearch=True
+            ),
+            dns_name,
+            kwargs
+        )
+
+    @classmethod
+    def find_in_folder(cls, folder, name, **kwargs):
+        """
+        Find a virtual machine by its name among the children of a folder,
+        so virtual machines with the same name in other folders are ignored
+        :param folder: The inventory path of the folder, like
+        "datacenter/vm/folder"
+        :param name: The virtual machine name
+        :param kwargs: The other virtual machine arguments, like the timeout
+
+        :return: The virtual machine (VirtualMachine)
+
+        :raise: NoObjectFound: If the folder or the virtual machine are not
+        found
+        """
+        search_index = cls._search_index()
+        folder_object = search_index.FindByInventoryPath(folder)
+        if not isinstance(folder_object, vim.Folder):
+            raise NoObjectFound(vim.Folder, folder)
+        return cls._bind(
+            search_index.FindChild(folder_object, name), name, kwargs
+        )
+
+    @classmethod
+    @configurable([('Vsphere Session', 'vcdriver_host')])
+    def from_handle(cls, handle, **kwargs):
+        """
+        Rebind a virtual machine handle to the current session through its
+        managed object id, without searching the inventory. A single
+        property read checks that the id still refers to the same virtual
+        machine instance
+        :param handle: The handle, see handle
+        :param kwargs: The other virtual machine arguments, like the timeout
+
+        :return: The virtual machine (VirtualMachine)
+
+        :raise: HandleError: If the handle belongs to another vcenter, or its
+        virtual machine was removed or replaced
+        """
+        host = kwargs.pop('vcdriver_host')
+        if handle['vcenter'] != host:
+            raise HandleError(
+                handle['name'],
+                'it belongs to vcenter "{}", not "{}"'.format(
+                    handle['vcenter'], host
+                )
+            )
+        vm = cls(handle['name'], handle['template'], **kwargs)
+        vm._vm_object = vim.VirtualMachine(
+            handle['moid'], stub=connection()._stub
+        )
+        try:
+            instance_uuid = vm._property('config.instanceUuid')
+        except vmodl.fault.ManagedObjectNotFound:
+            instance_uuid = None
+        if instance_uuid != handle['instance_uuid']:
+            raise HandleError(
+                handle['name'],
+                '"{}" is not the instance "{}" anymore'.format(
+                    handle['moid'], handle['instance_uuid']
+                )
+            )
+        return vm
+
     def destroy(self):
-        """ Destroy the virtual machine and set the vm object to None """
+        """
+        Destroy the virtual machine and set the vm object to None. Its static
+        ip leases are released, even if another object or process leased them
+        """
         self.power_off()
         if self._vm_object:
-            wait_for_vcenter_task(
-                self._vm_object.Destroy_Task(),
-                'Destroy virtual machine "{}"'.format(self.name),
-                self.timeout
-            )
+            with self._admit('destroy'):
+                wait_for_vcenter_task(
+                    self._vm_object.Destroy_Task(),
+                    'Destroy virtual machine "{}"'.format(self.name),
+                    self.timeout
+                )
             self._vm_object = None
+            self._snapshots = None
+            self._release_ip()
+            release_leases(self.name)
 
     def power_on(self):
         """ Power on the virtual machine """
         if self._vm_object:
             try:
-                wait_for_vcenter_task(
-                    self._vm_object.PowerOnVM_Task(),
-                    'Power on virtual machine "{}"'.format(self.name),
-                    self.timeout
-                )
+                with self._admit('power'):
+                    wait_for_vcenter_task(
+                        self._vm_object.PowerOnVM_Task(),
+                        'Power on virtual machine "{}"'.format(self.name),
+                        self.timeout
+                    )
             except vim.fault.InvalidPowerState:
                 pass
 
@@ -154,11 +433,12 @@ class VirtualMachine(object):
         """ Power off the virtual machine """
         if self._vm_object:
             try:
-                wait_for_vcenter_task(
-                    self._vm_object.PowerOffVM_Task(),
-                    'Power off virtual machine "{}"'.format(self.name),
-                    self.timeout
-                )
+                with self._admit('power'):
+                    wait_for_vcenter_task(
+                        self._vm_object.PowerOffVM_Task(),
+                        'Power off virtual machine "{}"'.format(self.name),
+                        self.timeout
+                    )
             except vim.fault.InvalidPowerState:
                 pass
 
@@ -166,11 +446,12 @@ class VirtualMachine(object):
         """ Reset the virtual machine """
         if self._vm_object:
             try:
-                wait_for_vcenter_task(
-                    self._vm_object.ResetVM_Task(),
-                    'Reset virtual machine "{}"'.format(self.name),
-                    self.timeout
-                )
+                with self._admit('power'):
+                    wait_for_vcenter_task(
+                        self._vm_object.ResetVM_Task(),
+                        'Reset virtual machine "{}"'.format(self.name),
+                        self.timeout
+                    )
             except vim.fault.InvalidPowerState:
                 pass
 
@@ -180,7 +461,7 @@ class VirtualMachine(object):
         Need Vmware tools installed in the virtual machine
         """
         if self._vm_object:
-            if self._vm_object.summary.runtime.powerState == 'poweredOn':
+            if self._property('runtime.powerState') == 'poweredOn':
                 self._wait_for_vmware_tools()
                 self._vm_object.RebootGuest()
 
@@ -190,23 +471,32 @@ class VirtualMachine(object):
         Need Vmware tools installed in the virtual machine
         """
         if self._vm_object:
-            if self._vm_object.summary.runtime.powerState == 'poweredOn':
+            if self._property('runtime.powerState') == 'poweredOn':
                 self._wait_for_vmware_tools()
                 self._vm_object.ShutdownGuest()
 
     def ip(self):
         """
-        Poll vcenter to get the virtual machine IP
+        Poll vcenter to get the virtual machine IP, unless a static ip was
+        assigned by the guest customization
 
         :return: Return the ip
         """
         if self._vm_object:
-            if not self._vm_object.summary.guest.ipAddress:
-                timeout_loop(
-                    self.timeout, 'Get IP', 1, False,
-                    lambda: self._vm_object.summary.guest.ipAddress
-                )
-            ip = self._vm_object.summary.guest.ipAddress
+            if self._ip:
+                validate_ip(self._ip)
+                return self._ip
+            ip = self._property('guest.ipAddress')
+            if not ip:
+                ip = wait_for_properties(
+                    connection(),
+                    [self._vm_object],
+                    vim.VirtualMachine,
+                    ['guest.ipAddress'],
+                    lambda properties: properties.get('guest.ipAddress'),
+                    'Get IP',
+                    self.timeout
+                )[0]['guest.ipAddress']
             validate_ip(ip)
             return ip
 
@@ -219,7 +509,7 @@ class VirtualMachine(object):
         """
         # TODO: https://www.virtuallyghetto.com/2018/04/vm-creation-date-now-available-in-vsphere-6-7.html # noqa
         return datetime.datetime.strptime(
-            self._vm_object.config.changeVersion, '%Y-%m-%dT%H:%M:%S.%fZ'
+            self._property('config.changeVersion'), '%Y-%m-%dT%H:%M:%S.%fZ'
         )
 
     @configurable([
@@ -410,16 +700,28 @@ class VirtualMachine(object):
             **kwargs
     ):
         """
-        Copy a file through winrm
+        Copy a file or directory through winrm. Directories are zipped
+        locally, uploaded as a single archive and expanded remotely
         :param remote_path: The remote location
         :param local_path: The local local
         :param step: Number of bytes to send in each chunk
         :param winrm_kwargs: The pywinrm Protocol class kwargs
         :param quiet: Whether to hide the stdout/stderr output or not
 
-        :return: A tuple with the status code, the stdout and the stderr
+        :return: For directories, a dictionary with the seconds spent in the
+        zip, upload and expand phases
         """
-        if self._vm_object:
+        if self._vm_object and os.path.isdir(local_path):
+            return self._winrm_upload_archive(
+                remote_path,
+                local_path,
+                sorted(get_local_manifest(local_path, checksum=False)),
+                step,
+                winrm_kwargs,
+                quiet,
+                **kwargs
+            )
+        elif self._vm_object:
             winrm_session = self._open_winrm_session(
                 kwargs['vcdriver_vm_winrm_username'],
                 kwargs['vcdriver_vm_winrm_password'],
@@ -427,8 +729,10 @@ class VirtualMachine(object):
             )
             self._run_winrm_ps(
                 winrm_session,
-                'if (Test-Path -path {0}) {{ Remove-Item -path {0} }}'.format(
-                    remote_path)
+                'if (Test-Path -literalPath {0}) '
+                '{{ Remove-Item -literalPath {0} }}'.format(
+                    _ps_quote(remote_path)
+                )
             )
             size = os.stat(local_path).st_size
             start = time.time()
@@ -437,16 +741,18 @@ class VirtualMachine(object):
                     script = (
                         'add-content -value '
                         '$([System.Convert]::FromBase64String("{}")) '
-                        '-encoding byte -path {}'.format(
+                        '-encoding byte -literalPath {}'.format(
                             base64.b64encode(f.read(step)).decode(),
-                            remote_path
+                            _ps_quote(remote_path)
                         )
                     )
                     while True:
                         code, stdout, stderr = self._run_winrm_ps(
                             winrm_session, script
                         )
-                        if time.time() - start >= self.timeout:
+                        if remaining_time(
+                            self.timeout - (time.time() - start)
+                        ) <= 0:
                             raise TimeoutError(
                                 'WinRM upload file transfer', self.timeout
                             )
@@ -484,6 +790,431 @@ class VirtualMachine(object):
             if not quiet:
                 print('')
 
+    @configurable([
+        ('Virtual Machine Remote Management', 'vcdriver_vm_ssh_username'),
+        ('Virtual Machine Remote Management', 'vcdriver_vm_ssh_password')
+    ])
+    def ssh_sync(
+            self,
+            remote_path,
+            local_path,
+            use_sudo=False,
+            checksum=True,
+            delete=False,
+            quiet=False,
+            **kwargs
+    ):
+        """
+        Synchronize a local directory to the virtual machine, uploading only
+        the files that are missing or different on the remote side
+        :param remote_path: The remote directory
+        :param local_path: The local directory
+        :param use_sudo: If True, it runs as sudo
+        :param checksum: If True, files are compared by md5 digest, otherwise
+        by size and modification time, which is copied to the uploaded files
+        :param delete: If True, remote files missing locally are deleted
+        :param quiet: Whether to hide the stdout/stderr output or not
+
+        :return: A dictionary with the uploaded and deleted relative paths
+
+        :raise: SshError: If a remote command fails
+        :raise: UploadError: If a file transfer fails
+        """
+        if self._vm_object:
+            self._wait_for_ssh_service(
+                kwargs['vcdriver_vm_ssh_username'],
+                kwargs['vcdriver_vm_ssh_password']
+            )
+            runner = sudo if use_sudo else run
+            with fabric_context(
+                    self.ip(),
+                    kwargs['vcdriver_vm_ssh_username'],
+                    kwargs['vcdriver_vm_ssh_password']
+            ):
+                def remote(command):
+                    with hide('everything'):
+                        result = runner(command)
+                    if result.failed:
+                        raise SshError(
+                            command, result.return_code, result.stdout
+                        )
+                    return result
+                if checksum:
+                    listing = (
+                        'find . -type f -exec md5sum {} + | '
+                        'sed "s/^\\([0-9a-f]*\\)  \\.\\//\\1\\t/"'
+                    )
+                else:
+                    listing = (
+                        'find . -type f -printf "%s-%T@\\t%P\\n" | '
+                        'sed "s/\\.[0-9]*\\t/\\t/"'
+                    )
+                local_manifest = get_local_manifest(local_path, checksum)
+                changed, stale = diff_manifests(
+                    local_manifest,
+                    parse_manifest(remote(
+                        'if [ -d {0} ]; then cd {0} && {1}; fi'.format(
+                            shlex_quote(remote_path), listing
+                        )
+                    ))
+                )
+                directories = sorted(set(
+                    posixpath.join(remote_path, posixpath.dirname(path))
+                    for path in changed
+                ))
+                if directories:
+                    remote('mkdir -p {}'.format(
+                        ' '.join(shlex_quote(d) for d in directories)
+                    ))
+                for path in changed:
+                    source = os.path.join(local_path, *path.split('/'))
+                    destination = posixpath.join(remote_path, path)
+                    if quiet:
+                        with hide('everything'):
+                            result = put(
+                                source, destination, use_sudo=use_sudo
+                            )
+                    else:
+                        result = put(source, destination, use_sudo=use_sudo)
+                    if result.failed:
+                        raise UploadError(
+                            local_path=source, remote_path=destination
+                        )
+                if changed and not checksum:
+                    remote(' && '.join(
+                        'touch -c -m -d @{} {}'.format(
+                            _signature_mtime(local_manifest[path]),
+                            shlex_quote(posixpath.join(remote_path, path))
+                        )
+                        for path in changed
+                    ))
+                if delete and stale:
+                    remote('rm -f {}'.format(' '.join(
+                        shlex_quote(posixpath.join(remote_path, path))
+                        for path in stale
+                    )))
+            return {'uploaded': changed, 'deleted': stale if delete else []}
+
+    @configurable([
+        ('Virtual Machine Remote Management', 'vcdriver_vm_winrm_username'),
+        ('Virtual Machine Remote Management', 'vcdriver_vm_winrm_password')
+    ])
+    def winrm_sync(
+            self,
+            remote_path,
+            local_path,
+            checksum=True,
+            delete=False,
+            step=1024,
+            winrm_kwargs=dict(),
+            quiet=False,
+            **kwargs
+    ):
+        """
+        Synchronize a local directory to the virtual machine through winrm,
+        uploading only the files that are missing or different on the remote
+        side
+        :param remote_path: The remote directory
+        :param local_path: The local directory
+        :param checksum: If True, files are compared by md5 digest, otherwise
+        by size and modification time, which is copied to the uploaded files
+        :param delete: If True, remote files missing locally are deleted
+        :param step: Number of bytes to send in each chunk
+        :param winrm_kwargs: The pywinrm Protocol class kwargs
+        :param quiet: Whether to hide the stdout/stderr output or not
+
+        :return: A dictionary with the uploaded and deleted relative paths
+
+        :raise: WinRmError: If a remote command fails
+        """
+        if self._vm_object:
+            self._wait_for_winrm_service(
+                kwargs['vcdriver_vm_winrm_username'],
+                kwargs['vcdriver_vm_winrm_password'],
+                **winrm_kwargs
+            )
+            winrm_session = self._open_winrm_session(
+                kwargs['vcdriver_vm_winrm_username'],
+                kwargs['vcdriver_vm_winrm_password'],
+                winrm_kwargs
+            )
+
+            def remote(script):
+                code, stdout, stderr = self._run_winrm_ps(
+                    winrm_session, script
+                )
+                if code != 0:
+                    raise WinRmError(script, code, stdout, stderr)
+                return stdout
+
+            if checksum:
+                signature = '(Get-FileHash -Algorithm MD5 $_.FullName).Hash'
+            else:
+                signature = (
+                    '("{0}-{1}" -f $_.Length, [int64][math]::Floor(('
+                    '$_.LastWriteTimeUtc - [datetime]"1970-01-01"'
+                    ').TotalSeconds))'
+                )
+            local_manifest = get_local_manifest(local_path, checksum)
+            changed, stale = diff_manifests(
+                local_manifest,
+                parse_manifest(remote(
+                    '[Console]::OutputEncoding = [Text.Encoding]::UTF8 ; '
+                    'if (Test-Path -path {0}) {{ '
+                    '$root = (Resolve-Path -path {0}).Path.TrimEnd("\\") ; '
+                    'Get-ChildItem -path {0} -recurse | '
+                    'Where-Object {{ -not $_.PSIsContainer }} | '
+                    'ForEach-Object {{ "{{0}}`t{{1}}" -f {1}, '
+                    '$_.FullName.Substring($root.Length + 1) }} }}'.format(
+                        _ps_quote(remote_path), signature
+                    )
+                ))
+            )
+            if changed:
+                self._winrm_upload_archive(
+                    remote_path,
+                    local_path,
+                    changed,
+                    step,
+                    winrm_kwargs,
+                    quiet,
+                    **kwargs
+                )
+                if not checksum:
+                    for script in _ps_batches('{}', ' ; ', [
+                        '(Get-Item -literalPath {}).LastWriteTimeUtc = '
+                        '([datetime]"1970-01-01").AddSeconds({})'.format(
+                            _ps_quote(_windows_path(remote_path, path)),
+                            _signature_mtime(local_manifest[path])
+                        )
+                        for path in changed
+                    ]):
+                        remote(script)
+            if delete and stale:
+                for script in _ps_batches(
+                        'Remove-Item -force -literalPath {}', ',', [
+                            _ps_quote(_windows_path(remote_path, path))
+                            for path in stale
+                        ]
+                ):
+                    remote(script)
+            return {'uploaded': changed, 'deleted': stale if delete else []}
+
+    @configurable([
+        ('Virtual Machine Remote Management', 'vcdriver_vm_guest_username'),
+        ('Virtual Machine Remote Management', 'vcdriver_vm_guest_password')
+    ])
+    def guest_upload(
+            self,
+            remote_path,
+            local_path,
+            overwrite=True,
+            quiet=False,
+            **kwargs
+    ):
+        """
+        Upload a file through the vsphere guest operations API. It only
+        needs Vmware tools running, not the guest network
+        :param remote_path: The remote location
+        :param local_path: The local location
+        :param overwrite: Whether to overwrite an existing remote file or not
+        :param quiet: Whether to hide the stdout/stderr output or not
+
+        :raise: UploadError: If the transfer fails
+        """
+        if self._vm_object:
+            self._wait_for_vmware_tools()
+            start = time.time()
+            file_manager = self._guest_operations().fileManager
+            url = file_manager.InitiateFileTransferToGuest(
+                vm=self._vm_object,
+                auth=self._guest_auth(
+                    kwargs['vcdriver_vm_guest_username'],
+                    kwargs['vcdriver_vm_guest_password']
+                ),
+                guestFilePath=remote_path,
+                fileAttributes=vim.vm.guest.FileManager.FileAttributes(),
+                fileSize=os.path.getsize(local_path),
+                overwrite=overwrite
+            )
+            with open(local_path, 'rb') as f:
+                response = requests.put(
+                    guest_file_url(url),
+                    data=f,
+                    verify=False,
+                    timeout=call_timeout(
+                        'Guest upload of "{}"'.format(remote_path),
+                        self.timeout
+                    )
+                )
+            if response.status_code != 200:
+                raise UploadError(
+                    local_path=local_path, remote_path=remote_path
+                )
+            if not quiet:
+                print('Guest upload "{}" to "{}" ... {}'.format(
+                    local_path,
+                    remote_path,
+                    datetime.timedelta(seconds=time.time() - start)
+                ))
+
+    @configurable([
+        ('Virtual Machine Remote Management', 'vcdriver_vm_guest_username'),
+        ('Virtual Machine Remote Management', 'vcdriver_vm_guest_password')
+    ])
+    def guest_download(
+            self,
+            remote_path,
+            local_path,
+            chunk_size=1024 * 1024,
+            quiet=False,
+            **kwargs
+    ):
+        """
+        Download a file through the vsphere guest operations API. It only
+        needs Vmware tools running, not the guest network
+        :param remote_path: The remote location
+        :param local_path: The local location
+        :param chunk_size: Number of bytes to write in each chunk
+        :param quiet: Whether to hide the stdout/stderr output or not
+
+        :raise: DownloadError: If the transfer fails
+        """
+        if self._vm_object:
+            self._wait_for_vmware_tools()
+            start = time.time()
+            response = self._guest_file_response(
+                self._guest_auth(
+                    kwargs['vcdriver_vm_guest_username'],
+                    kwargs['vcdriver_vm_guest_password']
+                ),
+                remote_path,
+                local_path
+            )
+            try:
+                with open(local_path, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size):
+                        f.write(chunk)
+            finally:
+                response.close()
+            if not quiet:
+                print('Guest download "{}" to "{}" ... {}'.format(
+                    remote_path,
+                    local_path,
+                    datetime.timedelta(seconds=time.time() - start)
+                ))
+
+    @configurable([
+        ('Virtual Machine Remote Management', 'vcdriver_vm_guest_username'),
+        ('Virtual Machine Remote Management', 'vcdriver_vm_guest_password')
+    ])
+    def guest_run(self, command, windows=None, quiet=False, **kwargs):
+        """
+        Executes a command through the vsphere guest operations API. It only
+        needs Vmware tools running, not the guest network. The command runs
+        in /bin/sh or cmd.exe and its output is fetched from temporary files
+        :param command: The command to be executed
+        :param windows: Whether the guest is a windows machine or not. If
+        None, it is guessed from the guest id
+        :param quiet: Whether to hide the stdout/stderr output or not
+
+        :return: A tuple with the status code, the stdout and the stderr
+
+        :raise: GuestError: If the command fails
+        """
+        if self._vm_object:
+            self._wait_for_vmware_tools()
+            if windows is None:
+                windows = (
+                    self._property('config.guestId') or ''
+                ).startswith('win')
+            auth = self._guest_auth(
+                kwargs['vcdriver_vm_guest_username'],
+                kwargs['vcdriver_vm_guest_password']
+            )
+            file_manager = self._guest_operations().fileManager
+            process_manager = self._guest_operations().processManager
+            directory = file_manager.CreateTemporaryDirectoryInGuest(
+                vm=self._vm_object, auth=auth, prefix='vcdriver', suffix=''
+            )
+            try:
+                if windows:
+                    stdout_path = '{}\\stdout'.format(directory)
+                    stderr_path = '{}\\stderr'.format(directory)
+                    spec = vim.vm.guest.ProcessManager.ProgramSpec(
+                        programPath='C:\\Windows\\System32\\cmd.exe',
+                        arguments='/s /c "({}) > "{}" 2> "{}""'.format(
+                            command, stdout_path, stderr_path
+                        )
+                    )
+                else:
+                    stdout_path = '{}/stdout'.format(directory)
+                    stderr_path = '{}/stderr'.format(directory)
+                    spec = vim.vm.guest.ProcessManager.ProgramSpec(
+                        programPath='/bin/sh',
+                        arguments='-c {}'.format(shlex_quote(
+                            '({}) > {} 2> {}'.format(
+                                command,
+                                shlex_quote(stdout_path),
+                                shlex_quote(stderr_path)
+                            )
+                        ))
+                    )
+                if not quiet:
+                    print('Executing in the guest of {} ...'.format(self.name))
+                    styled_print(Style.DIM)(command)
+                pid = process_manager.StartProgramInGuest(
+                    vm=self._vm_object, auth=auth, spec=spec
+                )
+                processes = []
+                # The errors that must stop the wait instead of being retried
+                fatal = []
+
+                def finished():
+                    try:
+                        processes[:] = process_manager.ListProcessesInGuest(
+                            vm=self._vm_object, auth=auth, pids=[pid]
+                        )
+                    except _GUEST_AUTH_FAULTS as e:
+                        fatal.append(e)
+                        return True
+                    if not processes:
+                        fatal.append(GuestError(
+                            command, None, '',
+                            'The guest process {} is not listed'.format(pid)
+                        ))
+                        return True
+                    return processes[0].endTime is not None
+
+                timeout_loop(
+                    self.timeout, 'Guest run', 1, True, finished
+                )
+                if fatal:
+                    raise fatal[0]
+                status = processes[0].exitCode
+                stdout, stderr = [
+                    self._guest_file_response(auth, path).content.decode(
+                        'utf-8', 'replace'
+                    )
+                    for path in (stdout_path, stderr_path)
+                ]
+            finally:
+                file_manager.DeleteDirectoryInGuest(
+                    vm=self._vm_object,
+                    auth=auth,
+                    directoryPath=directory,
+                    recursive=True
+                )
+            if not quiet:
+                styled_print(Style.BRIGHT)('CODE: {}'.format(status))
+                styled_print(Fore.GREEN)(stdout)
+            if status != 0:
+                if not quiet:
+                    styled_print(Fore.RED)(stderr)
+                raise GuestError(command, status, stdout, stderr)
+            else:
+                return status, stdout, stderr
+
     def find_snapshot(self, name):
         """
         Find a snapshot by name
@@ -495,12 +1226,7 @@ class VirtualMachine(object):
         :raise: NoObjectFound: If no results are found
         """
         if self._vm_object:
-            if self._vm_object.snapshot is not None:
-                found_snapshots = self._get_snapshots_by_name(
-                    self._vm_object.snapshot.rootSnapshotList, name
-                )
-            else:
-                found_snapshots = []
+            found_snapshots = self._snapshot_index()[0].get(name, [])
             if len(found_snapshots) > 1:
                 raise TooManyObjectsFound(vim.vm.Snapshot, name)
             elif len(found_snapshots) == 0:
@@ -508,22 +1234,48 @@ class VirtualMachine(object):
             else:
                 return found_snapshots[0].snapshot
 
-    def create_snapshot(self, name, dump_memory, description=''):
+    def find_snapshot_by_id(self, snapshot_id):
+        """
+        Find a snapshot by its id
+        :param snapshot_id: The id of the snapshot
+
+        :return: The given snapshot
+
+        :raise: NoObjectFound: If no results are found
+        """
+        if self._vm_object:
+            try:
+                return self._snapshot_index()[1][snapshot_id].snapshot
+            except KeyError:
+                raise NoObjectFound(vim.vm.Snapshot, snapshot_id)
+
+    def create_snapshot(
+            self, name, dump_memory, description='', quiesce=False
+    ):
         """
         Create a snapshot of the virtual machine
         :param name: The name of the snapshot to create
         :param dump_memory: Whether to dump the memory of the vm
         :param description: A description of the snapshot
+        :param quiesce: Whether to quiesce the guest file systems first (Needs
+        Vmware tools and no memory dump)
         """
         if self._vm_object:
             try:
                 self.find_snapshot(name)
             except NoObjectFound:
-                wait_for_vcenter_task(self._vm_object.CreateSnapshot(
-                    name, description, dump_memory, False),
-                    'Creating snapshot "{}" on "{}"'.format(name, self.name),
-                    self.timeout
-                )
+                try:
+                    with self._admit('snapshot'):
+                        wait_for_vcenter_task(self._vm_object.CreateSnapshot(
+                            name, description, dump_memory, quiesce),
+                            'Creating snapshot "{}" on "{}"'.format(
+                                name, self.name
+                            ),
+                            self.timeout,
+                            cancel_on_timeout=self.cancel_on_timeout
+                        )
+                finally:
+                    self._snapshots = None
             else:
                 raise TooManyObjectsFound(vim.vm.Snapshot, name)
 
@@ -533,11 +1285,12 @@ class VirtualMachine(object):
         :param name: The name of the snapshot to revert to
         """
         if self._vm_object:
-            wait_for_vcenter_task(
-                self.find_snapshot(name).RevertToSnapshot_Task(),
-                'Restoring snapshot "{}" on "{}"'.format(name, self.name),
-                self.timeout
-            )
+            with self._admit('snapshot'):
+                wait_for_vcenter_task(
+                    self.find_snapshot(name).RevertToSnapshot_Task(),
+                    'Restoring snapshot "{}" on "{}"'.format(name, self.name),
+                    self.timeout
+                )
 
     def remove_snapshot(self, name, remove_children=False):
         """
@@ -546,11 +1299,19 @@ class VirtualMachine(object):
         :param remove_children: Whether to remove the children snapshots or not
         """
         if self._vm_object:
-            wait_for_vcenter_task(
-                self.find_snapshot(name).RemoveSnapshot_Task(remove_children),
-                'Delete snapshot "{}" from "{}"'.format(name, self.name),
-                self.timeout
-            )
+            try:
+                with self._admit('snapshot'):
+                    wait_for_vcenter_task(
+                        self.find_snapshot(name).RemoveSnapshot_Task(
+                            remove_children
+                        ),
+                        'Delete snapshot "{}" from "{}"'.format(
+                            name, self.name
+                        ),
+                        self.timeout
+                    )
+            finally:
+                self._snapshots = None
 
     def set_autostart(self, start_delay=10):
         """ Set virtual machine ESXI autostart in a random order """
@@ -558,7 +1319,7 @@ class VirtualMachine(object):
             host_default_settings = vim.host.AutoStartManager.SystemDefaults()
             host_default_settings.enabled = True
             host_default_settings.startDelay = start_delay
-            esxi_host = self._vm_object.summary.runtime.host
+            esxi_host = self._property('runtime.host')
             spec = esxi_host.configManager.autoStartManager.config
             spec.defaults = host_default_settings
             auto_power_info = vim.host.AutoStartManager.AutoPowerInfo()
@@ -572,6 +1333,45 @@ class VirtualMachine(object):
             spec.powerInfo = [auto_power_info]
             esxi_host.configManager.autoStartManager.ReconfigureAutostart(spec)
 
+    def state(self, property_paths=STATE_PROPERTIES):
+        """
+        Retrieve some properties of the virtual machine in a single call,
+        instead of the whole summary or config objects
+        :param property_paths: The property paths, like "runtime.powerState"
+
+        :return: A read-only record of the properties (VirtualMachineState),
+        or None if the virtual machine is not deployed
+        """
+        if self._vm_object:
+            return VirtualMachineState(get_properties(
+                connection(),
+                [self._vm_object],
+                vim.VirtualMachine,
+                list(property_paths)
+            )[0])
+
+    @configurable([('Vsphere Session', 'vcdriver_host')])
+    def handle(self, **kwargs):
+        """
+        Build a compact handle of the virtual machine, to pass it to other
+        processes and rebind it there with from_handle
+
+        :return: A json serializable dictionary with the vcenter host
+        (vcenter), the managed object id (moid), the instance uuid
+        (instance_uuid), the name and the template, or None if the virtual
+        machine is not deployed. The vcenter host is the configured
+        vcdriver_host, as from_handle compares it with its own
+        """
+        if self._vm_object:
+            state = self.state(['name', 'config.instanceUuid'])
+            return {
+                'vcenter': kwargs['vcdriver_host'],
+                'moid': self._vm_object._moId,
+                'instance_uuid': state.get('config.instanceUuid'),
+                'name': state['name'],
+                'template': self.template
+            }
+
     def summary(self):
         """ Return a string summary of the virtual machine in markdown/reST """
         ip = self.ip()
@@ -591,6 +1391,119 @@ class VirtualMachine(object):
             )
         )
 
+    def _clone(
+            self, conn, host_score, replicate_template, customization, kwargs
+    ):
+        """
+        Clone the virtual machine and update the vm object, see create
+        :param conn: A vcenter connection
+        :param host_score: The host scoring function, or None
+        :param replicate_template: Whether to clone from a template replica
+        :param customization: The guest customization spec, or None
+        :param kwargs: The deployment configuration
+        """
+        resource_pool = get_vcenter_object_by_name(
+            conn, vim.ResourcePool, kwargs['vcdriver_resource_pool']
+        )
+        with data_store_placement(
+            conn,
+            kwargs['vcdriver_data_store'],
+            kwargs['vcdriver_data_store_threshold'],
+            resource_pool
+        ) as data_store, host_placement(
+            conn, resource_pool, host_score, data_store
+        ) as host:
+            if replicate_template:
+                source = template_replica(
+                    conn, self.template, data_store, self.timeout
+                )
+            else:
+                source = get_vcenter_object_by_name(
+                    conn, vim.VirtualMachine, self.template
+                )
+            task = None
+            try:
+                with admit('clone', host, data_store):
+                    task = source.CloneVM_Task(
+                        folder=get_vcenter_object_by_name(
+                            conn, vim.Folder, kwargs['vcdriver_folder']
+                        ),
+                        name=self.name,
+                        spec=vim.vm.CloneSpec(
+                            location=vim.vm.RelocateSpec(
+                                datastore=data_store,
+                                host=host,
+                                pool=resource_pool
+                            ),
+                            customization=customization,
+                            powerOn=True,
+                            template=False
+                        )
+                    )
+                    self._vm_object = wait_for_vcenter_task(
+                        task,
+                        'Create virtual machine "{}" from template '
+                        '"{}"'.format(self.name, self.template),
+                        self.timeout,
+                        cancel_on_timeout=self.cancel_on_timeout
+                    )
+            except TimeoutError:
+                if self.cancel_on_timeout and task:
+                    self._destroy_partial_clone(task)
+                raise
+
+    def _admit(self, operation):
+        """
+        Hold a slot of the admission controller for a task of the virtual
+        machine, see vcdriver.admission.admit. Its host and datastore are
+        only retrieved when the controller limits them
+        :param operation: The operation type, like "power"
+
+        :return: The admission context
+        """
+        host = data_store = None
+        controller = get_controller()
+        if controller and (
+            controller.host_limit or controller.data_store_limit
+        ):
+            properties = get_properties(
+                connection(),
+                [self._vm_object],
+                vim.VirtualMachine,
+                ['runtime.host', 'datastore']
+            )[0]
+            host = properties.get('runtime.host')
+            data_store = (properties.get('datastore') or [None])[0]
+        return admit(operation, host, data_store)
+
+    def _destroy_partial_clone(self, task):
+        """
+        Destroy the clone of a cancelled clone task if it completed anyway,
+        within the cancellation grace period
+        :param task: The clone task
+        """
+        info = task.info
+        if info.state == vim.TaskInfo.State.success:
+            with grace_period(CANCEL_GRACE):
+                self._vm_object = info.result
+                self.destroy()
+
+    def _property(self, property_path):
+        """
+        Retrieve a single property of the virtual machine, see state
+        :param property_path: The property path, like "guest.ipAddress"
+
+        :return: The value, or None if it is unset
+        """
+        return self.state([property_path]).get(property_path)
+
+    def _release_ip(self):
+        """ Forget the static ip, giving it back to its ip pool if any """
+        if self._ip_pool:
+            self._ip_pool.release(self._ip)
+        self._ip = None
+        self._ip_pool = None
+
     def _open_winrm_session(self, username, password, winrm_kwargs):
         """
         Open a WinRM session
@@ -600,14 +1513,217 @@ class VirtualMachine(object):
 
         :return: Return the winrm session
         """
+        timeout = max(int(call_timeout('WinRM session', self.timeout)), 1)
         return winrm.Session(
             target=self.ip(),
             auth=(username, password),
-            read_timeout_sec=self.timeout + 1,
-            operation_timeout_sec=self.timeout,
+            read_timeout_sec=timeout + 1,
+            operation_timeout_sec=timeout,
             **winrm_kwargs
         )
 
+    def _winrm_upload_archive(
+            self,
+            remote_path,
+            local_path,
+            relative_paths,
+            step,
+            winrm_kwargs,
+            quiet,
+            **kwargs
+    ):
+        """
+        Zip some files of a local directory, upload the archive through winrm
+        and expand it remotely, cleaning up the archives afterwards
+        :param remote_path: The remote directory
+        :param local_path: The local directory
+        :param relative_paths: The "/" separated paths of the files to send
+        :param step: Number of bytes to send in each chunk
+        :param winrm_kwargs: The pywinrm Protocol class kwargs
+        :param quiet: Whether to hide the stdout/stderr output or not
+
+        :return: A dictionary with the seconds spent in each phase
+
+        :raise: WinRmError: If the archive cannot be expanded
+        """
+        timings = {}
+        directory, name = ntpath.split(ntpath.normpath(remote_path))
+        remote_archive = ntpath.join(
+            directory, '{}.{}.zip'.format(name or 'vcdriver', uuid.uuid4())
+        )
+        winrm_session = self._open_winrm_session(
+            kwargs['vcdriver_vm_winrm_username'],
+            kwargs['vcdriver_vm_winrm_password'],
+            winrm_kwargs
+        )
+        expanded = False
+        try:
+            handle, local_archive = tempfile.mkstemp(suffix='.zip')
+            os.close(handle)
+            try:
+                start = time.time()
+                with zipfile.ZipFile(
+                        local_archive, 'w', zipfile.ZIP_DEFLATED, True
+                ) as archive:
+                    for path in relative_paths:
+                        archive.write(
+                            os.path.join(local_path, *path.split('/')), path
+                        )
+                timings['zip'] = time.time() - start
+                start = time.time()
+                self.winrm_upload(
+                    remote_archive,
+                    local_archive,
+                    step=step,
+                    winrm_kwargs=winrm_kwargs,
+                    quiet=quiet,
+                    **kwargs
+                )
+                timings['upload'] = time.time() - start
+            finally:
+                os.remove(local_archive)
+            script = (
+                'try {{ '
+                'if (Get-Command Expand-Archive '
+                '-errorAction SilentlyContinue) '
+                '{{ Expand-Archive -path {0} -destinationPath {1} -force }} '
+                'else {{ '
+                'Add-Type -assemblyName System.IO.Compression.FileSystem ; '
+                '$zip = [System.IO.Compression.ZipFile]::OpenRead({0}) ; '
+                'try {{ foreach ($entry in $zip.Entries) {{ '
+                '$target = Join-Path {1} $entry.FullName ; '
+                'New-Item -itemtype directory -force '
+                '-path (Split-Path $target) | Out-Null ; '
+                '[System.IO.Compression.ZipFileExtensions]::'
+                'ExtractToFile($entry, $target, $true) }} }} '
+                'finally {{ $zip.Dispose() }} }} }} '
+                'finally {{ Remove-Item -force -path {0} }}'.format(
+                    _ps_quote(remote_archive), _ps_quote(remote_path)
+                )
+            )
+            start = time.time()
+            code, stdout, stderr = self._run_winrm_ps(winrm_session, script)
+            expanded = True
+            timings['expand'] = time.time() - start
+        finally:
+            # The expand script removes the archive itself once it runs
+            if not expanded:
+                try:
+                    self._run_winrm_ps(
+                        winrm_session,
+                        'Remove-Item -force -errorAction SilentlyContinue '
+                        '-path {}'.format(_ps_quote(remote_archive))
+                    )
+                except Exception:
+                    pass
+        if code != 0:
+            raise WinRmError(script, code, stdout, stderr)
+        if not quiet:
+            for phase in ('zip', 'upload', 'expand'):
+                print('{} "{}" to "{}" ... {}'.format(
+                    phase.capitalize(),
+                    local_path,
+                    remote_path,
+                    datetime.timedelta(seconds=timings[phase])
+                ))
+        return timings
+
+    @classmethod
+    def _bind(cls, vm_object, key, kwargs):
+        """
+        Build a virtual machine bound to a search result
+        :param vm_object: The vcenter object found, or None
+        :param key: The search key, for the error message
+        :param kwargs: The other virtual machine arguments
+
+        :return: The virtual machine (VirtualMachine)
+
+        :raise: NoObjectFound: If the object is not a virtual machine
+        """
+        if not isinstance(vm_object, vim.VirtualMachine):
+            raise NoObjectFound(vim.VirtualMachine, key)
+        vm = cls(vm_object.name, **kwargs)
+        vm._vm_object = vm_object
+        return vm
+
+    @classmethod
+    def _bind_one(cls, vm_objects, key, kwargs):
+        """
+        Build a virtual machine bound to the only result of a search
+        :param vm_objects: The vcenter objects found
+        :param key: The search key, for the error messages
+        :param kwargs: The other virtual machine arguments
+
+        :return: The virtual machine (VirtualMachine)
+
+        :raise: TooManyObjectsFound: If more than one object was found
+        :raise: NoObjectFound: If no virtual machine was found
+        """
+        if len(vm_objects) > 1:
+            raise TooManyObjectsFound(vim.VirtualMachine, key)
+        return cls._bind(vm_objects[0] if vm_objects else None, key, kwargs)
+
+    @staticmethod
+    def _search_index():
+        """
+        Get the search index
+
+        :return: The vcenter search index
+        """
+        return connection().content.searchIndex
+
+    @staticmethod
+    def _guest_operations():
+        """
+        Get the guest operations manager
+
+        :return: The vcenter guest operations manager
+        """
+        return connection().content.guestOperationsManager
+
+    @staticmethod
+    def _guest_auth(username, password):
+        """
+        Build the guest operations credentials
+        :param username: The guest username
+        :param password: The guest password
+
+        :return: The vcenter guest authentication object
+        """
+        return vim.vm.guest.NamePasswordAuthentication(
+            username=username, password=password
+        )
+
+    def _guest_file_response(self, auth, remote_path, local_path=None):
+        """
+        Start streaming a file from the guest operations file manager
+        :param auth: The guest authentication object
+        :param remote_path: The remote location
+        :param local_path: The local location, if any, for error reporting
+
+        :return: The streamed requests response
+
+        :raise: DownloadError: If the file cannot be fetched
+        """
+        file_manager = self._guest_operations().fileManager
+        transfer = file_manager.InitiateFileTransferFromGuest(
+            vm=self._vm_object, auth=auth, guestFilePath=remote_path
+        )
+        response = requests.get(
+            guest_file_url(transfer.url),
+            stream=True,
+            verify=False,
+            timeout=call_timeout(
+                'Guest download of "{}"'.format(remote_path), self.timeout
+            )
+        )
+        if response.status_code != 200:
+            response.close()
+            raise DownloadError(
+                local_path=local_path, remote_path=remote_path
+            )
+        return response
+
     def _wait_for_ssh_service(self, username, password):
         """
         Wait until ssh service is ready
@@ -633,30 +1749,45 @@ class VirtualMachine(object):
 
     def _wait_for_vmware_tools(self):
         """ Wait until vmware tools is ready """
-        timeout_loop(
-            self.timeout, 'Vmware tools readiness', 1, False,
-            lambda: self._vm_object.summary.guest.toolsRunningStatus ==
-            'guestToolsRunning'
-        )
+        status = self._property('guest.toolsRunningStatus')
+        if status != 'guestToolsRunning':
+            wait_for_properties(
+                connection(),
+                [self._vm_object],
+                vim.VirtualMachine,
+                ['guest.toolsRunningStatus'],
+                lambda properties: properties.get(
+                    'guest.toolsRunningStatus'
+                ) == 'guestToolsRunning',
+                'Vmware tools readiness',
+                self.timeout
+            )
 
-    @classmethod
-    def _get_snapshots_by_name(cls, snapshots, name):
+    def _snapshot_index(self):
         """
-        Filter the snapshots by name
-        :param snapshots: The list of the snapshots
-        :param name: The name
+        Get the snapshot tree index, retrieving the whole tree in a single
+        call the first time. It is cached until a snapshot is created or
+        removed through this object, or the object is refreshed
 
-        :return: The list of snapshots filtered
+        :return: A tuple with the dictionary mapping each name to the list of
+        snapshot trees with that name, and the one mapping each id to its tree
         """
-        found_snapshots = []
-        for snapshot in snapshots:
-            if name == snapshot.name:
-                found_snapshots.append(snapshot)
-            found_snapshots = (
-                found_snapshots +
-                cls._get_snapshots_by_name(snapshot.childSnapshotList, name)
-            )
-        return found_snapshots
+        if self._snapshots is None:
+            by_name = {}
+            by_id = {}
+            pending = list(reversed(get_properties(
+                connection(),
+                [self._vm_object],
+                vim.VirtualMachine,
+                ['snapshot.rootSnapshotList']
+            )[0].get('snapshot.rootSnapshotList', [])))
+            while pending:
+                tree = pending.pop()
+                by_name.setdefault(tree.name, []).append(tree)
+                by_id[tree.id] = tree
+                pending.extend(reversed(tree.childSnapshotList))
+            self._snapshots = (by_name, by_id)
+        return self._snapshots
 
     @staticmethod
     def _run_winrm_ps(pywinrm_session, script):
@@ -670,8 +1801,8 @@ class VirtualMachine(object):
         result = pywinrm_session.run_ps(script)
         return (
             result.status_code,
-            result.std_out.decode('ascii'),
-            result.std_err.decode('ascii')
+            result.std_out.decode('utf-8', 'replace'),
+            result.std_err.decode('utf-8', 'replace')
         )
 
     def __str__(self):
@@ -682,46 +1813,176 @@ class VirtualMachine(object):
 
 
 @contextlib.contextmanager
-def virtual_machines(vms):
+def virtual_machines(vms, reuse=False):
     """
     Ensure that a list of VMs are created and destroyed within a context
     :param vms: The list of virtual machines (VirtualMachine)
+    :param reuse: If True, the VMs are reused from their baseline snapshot
+    instead of cloned, and they are kept when leaving the context
     """
     for vm in vms:
-        vm.create()
+        if reuse:
+            vm.reuse()
+        else:
+            vm.create()
     try:
         yield
     finally:
-        for vm in vms:
-            vm.destroy()
+        if not reuse:
+            for vm in vms:
+                vm.destroy()
+
+
+# The snapshot options of each strategy accepted by snapshot
+SNAPSHOT_STRATEGIES = {
+    'memory': {'dump_memory': True, 'quiesce': False},
+    'disk': {'dump_memory': False, 'quiesce': False},
+    'quiesced': {'dump_memory': False, 'quiesce': True}
+}
 
 
 @contextlib.contextmanager
-def snapshot(vm):
+def snapshot(vm, strategy='memory', keep=False, name=None):
     """
     Ensure that you run something and restore the VM to its initial state
     :param vm: The vm object (VirtualMachine)
+    :param strategy: "memory" dumps the vm memory, so it is restored running.
+    "disk" only snapshots the disks, which is much faster and does not stun
+    the guest, and "quiesced" also flushes the guest file systems first. With
+    disk snapshots a running vm is powered on again after the revert
+    :param keep: If True, the snapshot is only reverted when leaving the
+    context and kept, so later contexts with the same name reuse it
+    :param name: The snapshot name. A random one is used by default, or
+    "vcdriver-<strategy>" when keeping the snapshot
+
+    :yield: A dictionary with the seconds spent creating, reverting and
+    removing the snapshot, filled in as the phases happen
     """
-    snapshot_name = str(uuid.uuid4())
-    vm.create_snapshot(snapshot_name, True)
+    options = SNAPSHOT_STRATEGIES[strategy]
+    if name is None:
+        if keep:
+            name = 'vcdriver-{}'.format(strategy)
+        else:
+            name = str(uuid.uuid4())
+    powered_on = vm._vm_object is not None and (
+        vm.state(['runtime.powerState']).get('runtime.powerState') ==
+        'poweredOn'
+    )
+    timings = {}
+    exists = False
+    if keep:
+        try:
+            vm.find_snapshot(name)
+            exists = True
+        except NoObjectFound:
+            pass
+    if exists and vm._vm_object:
+        # The revert restores the power state recorded in the snapshot
+        powered_on = (
+            vm._snapshot_index()[0][name][0].state ==
+            vim.VirtualMachine.PowerState.poweredOn
+        )
+    if not exists:
+        start = time.time()
+        vm.create_snapshot(name, **options)
+        timings['create'] = time.time() - start
     try:
-        yield
+        yield timings
     finally:
-        vm.revert_snapshot(snapshot_name)
-        vm.remove_snapshot(snapshot_name, False)
+        start = time.time()
+        vm.revert_snapshot(name)
+        if powered_on and not options['dump_memory']:
+            vm.power_on()
+        timings['revert'] = time.time() - start
+        if not keep:
+            start = time.time()
+            vm.remove_snapshot(name, False)
+            timings['remove'] = time.time() - start
+
+
+def _ps_quote(value):
+    """
+    Quote a value as a powershell literal string
+    :param value: The value to be quoted
+
+    :return: The quoted value
+    """
+    return "'{}'".format(value.replace("'", "''"))
+
+
+def _ps_command_length(script):
+    """
+    Get the length of the command line that runs a powershell script
+    through winrm, which encodes it as base64 UTF-16
+    :param script: The script
+
+    :return: The number of characters of the command line
+    """
+    return len('powershell -encodedcommand ') + len(
+        base64.b64encode(script.encode('utf_16_le'))
+    )
+
+
+def _ps_batches(template, separator, items):
+    """
+    Split the items of a powershell script into several scripts, so that the
+    command line of each one fits in the cmd.exe limit
+    :param template: The script, formatted with the joined items
+    :param separator: The separator of the items
+    :param items: The items, at least one
+
+    :return: The list of scripts
+    """
+    scripts = []
+    batch = []
+    for item in items:
+        if batch and _ps_command_length(template.format(
+                separator.join(batch + [item])
+        )) > _WINRM_COMMAND_LIMIT:
+            scripts.append(template.format(separator.join(batch)))
+            batch = []
+        batch.append(item)
+    scripts.append(template.format(separator.join(batch)))
+    return scripts
+
+
+def _signature_mtime(signature):
+    """
+    Get the modification time of a "size-mtime" manifest signature
+    :param signature: The signature
+
+    :return: The modification time, in whole seconds since the epoch
+    """
+    return signature.rsplit('-', 1)[1]
+
+
+def _windows_path(remote_path, relative_path):
+    """
+    Join a remote windows directory and a "/" separated relative path
+    :param remote_path: The remote directory
+    :param relative_path: The relative path
+
+    :return: The windows path
+    """
+    return '{}\\{}'.format(
+        remote_path.rstrip('\\'), relative_path.replace('/', '\\')
+    )
 
 
 def get_all_virtual_machines():
     """
     Get all the virtual machines from your Vcenter Instance.
-    It will update both the internal _vm_object and the name.
+    It will update both the internal _vm_object and the name, retrieving the
+    names of all of them in a single call.
 
     :return: A list with all the VirtualMachine objects
     """
     machines = []
-    for vm_object in get_all_vcenter_objects(connection(), vim.VirtualMachine):
+    for vm_object, properties in get_inventory_properties(
+            connection(), [(vim.VirtualMachine, ['name'])]
+    ):
         machine = VirtualMachine()
         machine.__setattr__('_vm_object', vm_object)
-        machine.name = vm_object.summary.config.name
+        machine.name = properties.get('name')
         machines.append(machine)
     return machines